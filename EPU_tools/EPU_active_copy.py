@@ -28,10 +28,14 @@ def usage():
     print(" ")
     print(" -----------------------------------------------------------------------------------------------")
     print(" Options (default in brackets): ")
-    # print("           --j (2) : Attempt multiprocessing over given cores (remember speed is limited by HDD!)")
+    print("              --j (2) : Concurrent transfers of movies (and other large files)")
+    print("        --j_small (4) : Concurrent transfers of small files (e.g. .xml, .jpg), so they do not wait on movies")
     print("  --movies (*EER.eer) : Change the glob string that identifies movie files uniquely")
     # print("                              if possible, also copy .JPGs for manual curation later")
     print("            --dry-run : Give an example of what the copy command will do without copying")
+    print("           --checksum : Record the CRC32 checksum of each copied file in the copy manifest")
+    print("     --quiet_period (30) : Seconds a file must stay unchanged before it is copied, unless the .xml")
+    print("                           EPU writes once a movie is complete appears first")
     print("            --n (300) : Delay time in seconds between copy loops; -1 or 0 == dont loop")
     print("         --reorganize : Copy EPU project into a simpler directory structure, keeping only movies")
     print("                        metadata files and any screening notes in 'Screening' or 'Misc' folders: ")
@@ -80,109 +84,130 @@ def copytree(src, dst, symlinks = False, ignore = None, DRY_RUN = False):
             else:
                 shutil.copy2(s, d)
 
-def copy_project(source, dest, movie_string, glob_string = '**', DRY_RUN = False, DEBUG = False):
+def copy_project(source, dest, movie_string, engine, manifest, stability, DRY_RUN = False, DEBUG = False):
     """
         This is the base copying function used to mirror an EPU folder into another location without making any changes. 
+        Files to copy are passed to the COPY_ENGINE, which copies them concurrently while the rest of the tree is checked.
+        Directories and files that did not change since the last loop (according to the MANIFEST) are skipped without
+        listing them or comparing them against the destination, and files still being written (according to the 
+        STABILITY_TRACKER) are left for a later loop.
     """
     ## get the name of the root folder we want to copy 
     root_dir_name = os.path.basename(os.path.normpath(source))
+    dest_root = os.path.join(dest, root_dir_name)
     ## prepare the metrics for the user to evaluate at the end of each loop
-    total_files = 0
-    skipped_files = 0
-    movies_skipped = 0
-    total_movies = 0 
+    copied_files = 0
+    copied_movies = 0
+    files_in_progress = 0
+    dirs_checked = 0
+    dirs_listed = 0
     ## strip out any asterixs from the input movie string if they exist 
     movie_string = movie_string.replace("*", "")
+    scan_time = time.time()
+
+    ## walk the source directory tree, directories are given relative to the source
+    dirs_to_check = ['']
+    while len(dirs_to_check) > 0:
+        rel_dir = dirs_to_check.pop()
+        source_dir = os.path.join(source, rel_dir)
+        dest_dir = os.path.join(dest_root, rel_dir)
+        dirs_checked += 1
+        try:
+            dir_mtime = os.stat(source_dir).st_mtime_ns
+        except FileNotFoundError:
+            continue
+
+        ## an unchanged directory does not need to be listed again, only its subdirectories need to be checked
+        sub_dirs = manifest.get_sub_dirs(rel_dir, dir_mtime)
+        if sub_dirs != None:
+            dirs_to_check.extend(sub_dirs)
+            continue
+
+        if DEBUG: print(" 1. Listing changed directory at source :: ", source_dir)
+        dirs_listed += 1
+        if not os.path.exists(dest_dir):
+            print(" create dir :: %s" % (dest_dir))
+            if not DRY_RUN:
+                os.makedirs(dest_dir, exist_ok=True)
+
+        sub_dirs = []
+        SETTLED = True
+        for entry in os.scandir(source_dir):
+            ## hidden files are not copied (as with glob)
+            if entry.name.startswith('.'):
+                continue
+            rel_path = os.path.join(rel_dir, entry.name)
 
-    ## glob all files in the source directory and deal with each in turn
-    for source_file in glob.glob(os.path.join(source, glob_string), recursive = True):
-        ## discover each file sequentially and reset metrics 
-        if DEBUG: print(" 1. Discovered file at source :: ", source_file)
-        IS_MOVIE = False
-        initial_time = time.time()
-        source_file_basename = source_file[len(source):]
-        ## generate the output file we expect to make
-        dest_file = os.path.join(dest, os.path.join(root_dir_name, source_file_basename))
-
-        ## treat files and directories differently 
-        if os.path.isdir(source_file):
-            if not os.path.exists(dest_file):
-                if DRY_RUN:
-                    print(" create dir :: %s" % (dest_file))
-                else:
-                    print(" create dir :: %s" % (dest_file))
-                    os.makedirs(dest_file, exist_ok=True)
-            else:
-                continue 
-
-        if os.path.isfile(source_file):
             ## reject symlinks 
-            if(os.path.islink(source_file)):
-                print(" Symlink skipped (%s)" % source_file)
+            if entry.is_symlink():
+                print(" Symlink skipped (%s)" % entry.path)
                 continue 
-
-            total_files += 1
+            if entry.is_dir():
+                sub_dirs.append(rel_path)
+                continue
+            if not entry.is_file():
+                continue
+
+            stats = entry.stat()
+            if scan_time - stats.st_mtime < manifest.settle_time:
+                SETTLED = False
+            ## skip files that did not change since they were copied
+            if manifest.file_unchanged(rel_path, stats.st_size, stats.st_mtime_ns):
+                continue
 
             ## determine if the file is a movie (i.e. expected large file size) 
-            if len(source_file_basename) > len(movie_string):
-                ## use string matching to determine if we have a movie 
-                if source_file_basename[-len(movie_string):] == movie_string:
-                    IS_MOVIE = True
-                    total_movies += 1
-
-            ## if the target file we wish to make does not exist copy the source file to the target location
-            if not os.path.exists(dest_file):
-                dest_path = os.path.dirname(dest_file)
-                if DRY_RUN:
-                    print(" copy :: %s -> %s" % (source_file, dest_path))
-                else:
-                    print(" copy :: %s -> %s" % (source_file, dest_path), end='\r')
-                    shutil.copy2(source_file, dest_path)
-                    total_time_taken = time.time() - initial_time
-                    print(" copy :: %s -> %s (%.2f sec)" % (source_file, dest_path, total_time_taken))
-            
-            else:
-                ## if the target exists, we should figure out if we should copy over the existing file at the destination...
-
-                ## treat movies separately from regular files to avoid sluggish filecmp.cmp check for large file 
+            IS_MOVIE = len(entry.name) > len(movie_string) and entry.name[-len(movie_string):] == movie_string
+
+            ## leave files that are still being written for a later loop, rather than copying them over and over as they grow 
+            companion = fast_copy.get_companion_xml(entry.path) if IS_MOVIE else None
+            if not stability.is_complete(entry.path, stats.st_size, stats.st_mtime_ns, companion = companion):
+                if DEBUG: print(" ... file is still being written: %s" % entry.path)
+                files_in_progress += 1
+                SETTLED = False
+                continue
+            dest_file = os.path.join(dest_dir, entry.name)
+            label = " copy"
+
+            ## if the target exists (e.g. copied before the manifest was made), we should figure out if we should copy over the existing file at the destination...
+            if os.path.exists(dest_file):
+                ## treat movies separately from regular files to avoid sluggish filecmp.cmp check for large file, only compare file size for movies 
                 if IS_MOVIE:
-                    ## only compare file size for movies, not time/changes 
-                    source_size = os.stat(source_file).st_size
-                    dest_size = os.stat(dest_file).st_size
-                    if not source_size == dest_size:
-                        dest_path = os.path.dirname(dest_file)
-                        if DRY_RUN:
-                            print(" .. file exists but appears different, copy :: %s -> %s" % (source_file, dest_path))
-                        else:
-                            print(" .. file exists but appears different, copy :: %s -> %s " % (source_file, dest_path), end='\r')
-                            shutil.copy2(source_file, dest_path)
-                            total_time_taken = time.time() - initial_time
-                            print(" .. file exists but appears different, copy :: %s -> %s (%.2f sec)" % (source_file, dest_path, total_time_taken))
-                    ## if movie exists and is the same size, skip it 
-                    else:
-                        skipped_files += 1
-                        movies_skipped += 1
-                        if DEBUG: print(" ... file exists already: %s" % dest_file)
-                        continue 
-
+                    SAME = stats.st_size == os.stat(dest_file).st_size
                 ## for all non-movies, do a regular (slower) shallow check 
-                elif not filecmp.cmp(source_file, dest_file, shallow=True):
-                    if DEBUG: print(" 2. Comparison of file from source and dest complete ::")
-                    dest_path = os.path.dirname(dest_file)
-                    if DRY_RUN:
-                        print(" .. file exists but appears different, copy :: %s -> %s" % (source_file, dest_path))
-                    else:
-                        print(" .. file exists but appears different, copy :: %s -> %s " % (source_file, dest_path), end='\r')
-                        shutil.copy2(source_file, dest_path)
-                        total_time_taken = time.time() - initial_time
-                        print(" .. file exists but appears different, copy :: %s -> %s (%.2f sec)" % (source_file, dest_path, total_time_taken))
                 else:
-                    skipped_files += 1
+                    SAME = filecmp.cmp(entry.path, dest_file, shallow=True)
+                if SAME:
                     if DEBUG: print(" ... file exists already: %s" % dest_file)
-                    continue 
+                    if not DRY_RUN:
+                        manifest.record_file(rel_path, stats.st_size, stats.st_mtime_ns, dest_file)
+                    continue
+                label = " .. file exists but appears different, copy"
 
-    ## report a summary of all actions taken this loop 
-    print_stats(total_files, movie_string, total_movies, skipped_files, movies_skipped, DRY_RUN)
+            copied_files += 1
+            if IS_MOVIE:
+                copied_movies += 1
+            if DRY_RUN:
+                print("%s :: %s -> %s" % (label, entry.path, dest_dir))
+            else:
+                engine.submit(entry.path, dest_dir, IS_MOVIE = IS_MOVIE, label = label, callback = manifest.file_callback(rel_path, stats.st_size, stats.st_mtime_ns, dest_file))
+
+        dirs_to_check.extend(sub_dirs)
+        ## files written in place do not change the directory modification time, so keep listing the directory until its files have settled
+        if SETTLED and not DRY_RUN:
+            manifest.set_dir(rel_dir, dir_mtime, sub_dirs)
+
+    ## let the remaining transfers finish before reporting a summary of all actions taken this loop 
+    if not DRY_RUN:
+        engine.wait()
+        manifest.save()
+    print(" ... %s of %s directories changed since the last loop" % (dirs_listed, dirs_checked))
+    if files_in_progress > 0:
+        print(" ... %s files are still being written, they will be copied on a later loop" % files_in_progress)
+    total_files, total_movies = manifest.count_files(movie_string)
+    if DRY_RUN:
+        total_files += copied_files
+        total_movies += copied_movies
+    print_stats(total_files, movie_string, total_movies, total_files - copied_files, total_movies - copied_movies, DRY_RUN)
     return 
 
 def print_stats(num_files, movie_string, num_movies, num_skipped, num_movies_skipped, DRY_RUN = False):
@@ -197,17 +222,16 @@ def print_stats(num_files, movie_string, num_movies, num_skipped, num_movies_ski
 
     return 
 
-def copy_file(file_path, dest_path, SIZE_ONLY = False, DRY_RUN = False):
+def copy_file(file_path, dest_path, engine, SIZE_ONLY = False, DRY_RUN = False):
     """
+    Check if a file needs to be copied into the dest_path directory and, if so, queue it on the COPY_ENGINE
     RETURNS 
-         1 = file was copied to the destination
+         1 = file was (queued to be) copied to the destination
          0 = was was skipped since it was a symlink  
         -1 = file was skipped since it was already presenet at the destination directory 
     """
     EXIT_CODE = 0 ## pass 
 
-    initial_time = time.time()
-
     if os.path.isfile(file_path):
         ## reject symlinks 
         if(os.path.islink(file_path)):
@@ -221,10 +245,7 @@ def copy_file(file_path, dest_path, SIZE_ONLY = False, DRY_RUN = False):
             print(" copy :: %s -> %s" % (file_path, dest_path))
             EXIT_CODE = 1
         else:
-            print(" copy :: %s -> %s" % (file_path, dest_path), end='\r')
-            shutil.copy2(file_path, dest_path)
-            total_time_taken = time.time() - initial_time
-            print(" copy :: %s -> %s (%.2f sec)" % (file_path, dest_path, total_time_taken))
+            engine.submit(file_path, dest_path, IS_MOVIE = SIZE_ONLY)
             EXIT_CODE = 1
     else:
         ## the file exists, evaluate if it is different than the source file?
@@ -237,10 +258,7 @@ def copy_file(file_path, dest_path, SIZE_ONLY = False, DRY_RUN = False):
                     print(" .. file exists but appears different, copy :: %s -> %s" % (file_path, dest_path))
                     EXIT_CODE = 1
                 else:
-                    print(" .. file exists but appears different, copy :: %s -> %s " % (file_path, dest_path), end='\r')
-                    shutil.copy2(file_path, dest_path)
-                    total_time_taken = time.time() - initial_time
-                    print(" .. file exists but appears different, copy :: %s -> %s (%.2f sec)" % (file_path, dest_path, total_time_taken))
+                    engine.submit(file_path, dest_path, IS_MOVIE = SIZE_ONLY, label = " .. file exists but appears different, copy")
                     EXIT_CODE = 1
             ## if movie exists and is the same size, skip it 
             else:
@@ -253,14 +271,11 @@ def copy_file(file_path, dest_path, SIZE_ONLY = False, DRY_RUN = False):
                     print(" file exists but appears different, copy :: %s -> %s" % (file_path, dest_path))
                     EXIT_CODE = 1
                 else:
-                    print(" file exists but appears different, copy :: %s -> %s" % (file_path, dest_path), end='\r')
-                    shutil.copy2(file_path, dest_path)
-                    total_time_taken = time.time() - initial_time
-                    print(" file exists but appears different, copy :: %s -> %s (%.2f sec)" % (file_path, dest_path, total_time_taken))
+                    engine.submit(file_path, dest_path, label = " file exists but appears different, copy")
 
     return EXIT_CODE
 
-def copy_reorganized(source, dest, glob_string, DRY_RUN = False):
+def copy_reorganized(source, dest, glob_string, engine, DRY_RUN = False):
     """
         A function to copy an EPU project into a simpler structure while preserving important metadata relationships.
             EPU_project_dir/ (dest)
@@ -340,47 +355,295 @@ def copy_reorganized(source, dest, glob_string, DRY_RUN = False):
     movies_skipped = 0
     total_files = len(atlas_files) + len(xml_files) + len(jpg_files) + len(other_files) + len(movie_files)
     for f in atlas_files:
-        EXIT_CODE = copy_file(f,atlas_dir, DRY_RUN = DRY_RUN )
+        EXIT_CODE = copy_file(f,atlas_dir, engine, DRY_RUN = DRY_RUN )
         if EXIT_CODE == -1:
             skipped_files += 1
         elif EXIT_CODE == 1:
             copied_files += 1
 
     for f in xml_files:
-        EXIT_CODE = copy_file(f,xml_dir, DRY_RUN = DRY_RUN )
+        EXIT_CODE = copy_file(f,xml_dir, engine, DRY_RUN = DRY_RUN )
         if EXIT_CODE == -1:
             skipped_files += 1
         elif EXIT_CODE == 1:
             copied_files += 1
 
     for f in jpg_files:
-        EXIT_CODE = copy_file(f,jpgs_dir, DRY_RUN = DRY_RUN )
+        EXIT_CODE = copy_file(f,jpgs_dir, engine, DRY_RUN = DRY_RUN )
         if EXIT_CODE == -1:
             skipped_files += 1
         elif EXIT_CODE == 1:
             copied_files += 1
 
     for f in other_files:
-        EXIT_CODE = copy_file(f, other_dir, DRY_RUN = DRY_RUN)
+        EXIT_CODE = copy_file(f, other_dir, engine, DRY_RUN = DRY_RUN)
         if EXIT_CODE == -1:
             skipped_files += 1
         elif EXIT_CODE == 1:
             copied_files += 1
 
     for f in movie_files:
-        EXIT_CODE = copy_file(f,movies_dir, DRY_RUN = DRY_RUN, SIZE_ONLY= True)
+        EXIT_CODE = copy_file(f,movies_dir, engine, DRY_RUN = DRY_RUN, SIZE_ONLY= True)
         if EXIT_CODE == -1:
             skipped_files += 1
             movies_skipped += 1
         elif EXIT_CODE == 1:
             copied_files += 1
     
+    if not DRY_RUN:
+        engine.wait()
     #endregion
 
     print_stats(total_files, glob_string, len(movie_files), skipped_files, movies_skipped, DRY_RUN = DRY_RUN)
 
     return 
 
+class COPY_ENGINE():
+    """
+    Copy files with a pool of concurrent transfers, keeping large files (movies) and small files (.xml, .jpg, ...) in separate
+    queues with their own workers, so small files are never stuck behind multi-GB movies. Files are submitted as they are
+    discovered and copied in the background, while wait() shows the aggregate throughput of the transfers live.
+    ---------------------------------------------------------------
+    PARAMETERS
+    ---------------------------------------------------------------
+        movie_streams = int(); concurrent transfers of large files \n
+        file_streams = int(); concurrent transfers of small files \n
+        large_file_size = int(); files of at least this many bytes are treated as large, even if they are not movies \n
+    """
+    def __init__(self, movie_streams = 2, file_streams = 4, large_file_size = 64 * 1024 * 1024):
+        self.large_file_size = large_file_size
+        self.large_queue = queue.Queue()
+        self.small_queue = queue.Queue()
+        self.stopping = False
+        ## transfers submitted but not yet finished, and totals of the current batch of transfers (i.e. since the last wait())
+        self.pending = 0
+        self.pending_movies = 0
+        self.NEW_BATCH = True
+        self.batch_start = time.time()
+        self.batch_bytes = 0
+        self.batch_files = 0
+        self.errors = 0
+        self.status_line = ''
+        ## lock for the counters above, and for printing so messages do not interleave with the status line
+        self.lock = threading.Lock()
+
+        self.threads = []
+        for i in range(movie_streams):
+            self.threads.append(threading.Thread(target = self.worker, args = (self.large_queue,), daemon = True))
+        for i in range(file_streams):
+            self.threads.append(threading.Thread(target = self.worker, args = (self.small_queue,), daemon = True))
+        for thread in self.threads:
+            thread.start()
+        return
+
+    def submit(self, source_file, dest_path, IS_MOVIE = False, label = " copy", callback = None):
+        """ Queue a file to be copied into the dest_path directory, the label is printed along with the finished transfer.
+            The optional callback is called with the outcome of the transfer, i.e. callback(SUCCESS)
+        """
+        LARGE = IS_MOVIE or os.path.getsize(source_file) >= self.large_file_size
+        with self.lock:
+            if self.NEW_BATCH:
+                ## reset the throughput metrics for the first transfer of a new batch
+                self.NEW_BATCH = False
+                self.batch_start = time.time()
+                self.batch_bytes = 0
+                self.batch_files = 0
+            self.pending += 1
+            if IS_MOVIE:
+                self.pending_movies += 1
+        if LARGE:
+            self.large_queue.put((source_file, dest_path, IS_MOVIE, label, callback))
+        else:
+            self.small_queue.put((source_file, dest_path, IS_MOVIE, label, callback))
+        return
+
+    def worker(self, work_queue):
+        while True:
+            source_file, dest_path, IS_MOVIE, label, callback = work_queue.get()
+            if not self.stopping:
+                SUCCESS = self.copy(source_file, dest_path, label)
+                if callback != None:
+                    callback(SUCCESS)
+            with self.lock:
+                self.pending -= 1
+                if IS_MOVIE:
+                    self.pending_movies -= 1
+            work_queue.task_done()
+
+    def copy(self, source_file, dest_path, label):
+        initial_time = time.time()
+        try:
+            fast_copy.copy2(source_file, dest_path)
+        except OSError as e:
+            with self.lock:
+                self.errors += 1
+            self.print_message(" !! ERROR :: Could not copy %s -> %s (%s)" % (source_file, dest_path, e))
+            return False
+        total_time_taken = time.time() - initial_time
+        with self.lock:
+            self.batch_bytes += os.path.getsize(source_file)
+            self.batch_files += 1
+        self.print_message("%s :: %s -> %s (%.2f sec)" % (label, source_file, dest_path, total_time_taken))
+        return True
+
+    def print_message(self, message):
+        """ Print a message on its own line, then redraw the status line below it
+        """
+        with self.lock:
+            print("\r" + " " * len(self.status_line) + "\r" + message)
+            print(self.status_line, end = '\r', flush = True)
+        return
+
+    def status(self):
+        elapsed_time = max(time.time() - self.batch_start, 1e-6)
+        return "  ... %s files copied (%.1f MB/s, %.1f files/s), %s remaining (%s movies)" % (self.batch_files, self.batch_bytes / (1024 * 1024) / elapsed_time, self.batch_files / elapsed_time, self.pending, self.pending_movies)
+
+    def wait(self):
+        """ Block until all submitted files are copied, updating the throughput on the status line every second
+        """
+        while True:
+            with self.lock:
+                finished = self.pending == 0
+                self.status_line = self.status()
+                print("\r" + self.status_line, end = '', flush = True)
+            if finished:
+                break
+            time.sleep(1)
+        print()
+        with self.lock:
+            self.status_line = ''
+            self.NEW_BATCH = True
+        return
+
+    def stop(self):
+        """ Drop any queued files and let the transfers in progress finish, so no partial files are left at the destination
+        """
+        self.stopping = True
+        with self.lock:
+            self.status_line = ''
+        if self.pending > 0:
+            print(" ... waiting for transfers in progress to finish")
+        self.large_queue.join()
+        self.small_queue.join()
+        return
+
+class MANIFEST():
+    """
+    Index of the mirrored EPU session, saved as a .JSON file next to it at the destination, i.e.:
+        { 'dirs' : { rel_dir : [ mtime_ns, [ rel_sub_dir, ... ] ], ... },
+          'files' : { rel_path : [ size, mtime_ns, copied_at, checksum ], ... } }
+    A directory's modification time only changes when entries are added, removed or renamed, so a directory whose mtime 
+    matches its entry does not need to be listed again. Likewise, a file whose size & mtime match its entry does not need 
+    to be compared against the destination, so the cost of each loop scales with the new data rather than the session size.
+    ---------------------------------------------------------------
+    PARAMETERS
+    ---------------------------------------------------------------
+        fname = str(); path of the manifest file \n
+        settle_time = float(); seconds since the last file modification before a directory is no longer listed on each loop \n
+        CHECKSUM = bool(); record the CRC32 checksum of each copied file (requires reading it back from the destination) \n
+    """
+    def __init__(self, fname, settle_time = 120, CHECKSUM = False):
+        self.fname = fname
+        self.settle_time = settle_time
+        self.CHECKSUM = CHECKSUM
+        self.dirs = dict()
+        self.files = dict()
+        ## directories with a file that could not be copied, these are listed again on the next loop
+        self.failed_dirs = set()
+        self.changed = False
+        ## files are recorded from the COPY_ENGINE worker threads
+        self.lock = threading.Lock()
+        self.load()
+        return
+
+    def load(self):
+        if not os.path.isfile(self.fname):
+            return
+        try:
+            with open(self.fname, 'r') as f:
+                manifest = json.load(f)
+            self.dirs = manifest['dirs']
+            self.files = manifest['files']
+            print(" Loaded copy manifest :: %s (%s files)" % (self.fname, len(self.files)))
+        except (ValueError, KeyError):
+            ## a damaged manifest only means the session is compared against the destination again
+            print(" !! WARNING :: Could not read copy manifest, starting a new one (%s)" % self.fname)
+            self.dirs = dict()
+            self.files = dict()
+        return
+
+    def save(self):
+        """ Write the manifest to a temporary file and rename it over the old one, so it is never left half-written
+        """
+        with self.lock:
+            for rel_dir in self.failed_dirs:
+                self.dirs.pop(rel_dir, None)
+            self.failed_dirs = set()
+            if not self.changed:
+                return
+            temp_file = self.fname + ".tmp"
+            with open(temp_file, 'w') as f:
+                json.dump({'dirs' : self.dirs, 'files' : self.files}, f)
+            os.replace(temp_file, self.fname)
+            self.changed = False
+        return
+
+    def get_sub_dirs(self, rel_dir, mtime_ns):
+        """ Return the subdirectories of a directory if it is unchanged since it was last listed, otherwise None
+        """
+        entry = self.dirs.get(rel_dir)
+        if entry == None or entry[0] != mtime_ns:
+            return None
+        return entry[1]
+
+    def set_dir(self, rel_dir, mtime_ns, sub_dirs):
+        with self.lock:
+            self.dirs[rel_dir] = [mtime_ns, sub_dirs]
+            self.changed = True
+        return
+
+    def file_unchanged(self, rel_path, size, mtime_ns):
+        entry = self.files.get(rel_path)
+        return entry != None and entry[0] == size and entry[1] == mtime_ns
+
+    def record_file(self, rel_path, size, mtime_ns, dest_file):
+        checksum = get_checksum(dest_file) if self.CHECKSUM else None
+        with self.lock:
+            self.files[rel_path] = [size, mtime_ns, time.time(), checksum]
+            self.changed = True
+        return
+
+    def file_callback(self, rel_path, size, mtime_ns, dest_file):
+        """ Return a COPY_ENGINE callback that records the file once it is copied
+        """
+        def callback(SUCCESS):
+            if SUCCESS:
+                self.record_file(rel_path, size, mtime_ns, dest_file)
+            else:
+                with self.lock:
+                    self.failed_dirs.add(os.path.dirname(rel_path))
+            return
+        return callback
+
+    def count_files(self, movie_string):
+        """ RETURNS the number of files and movies in the manifest
+        """
+        with self.lock:
+            num_movies = len([rel_path for rel_path in self.files if rel_path.endswith(movie_string)])
+            return len(self.files), num_movies
+
+def get_checksum(fname, chunk_size = 8 * 1024 * 1024):
+    """ Calculate the CRC32 checksum of a file
+    """
+    checksum = 0
+    with open(fname, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            checksum = zlib.crc32(chunk, checksum)
+    return checksum
+
 #endregion
 
 class PARAMETERS():
@@ -393,6 +656,10 @@ class PARAMETERS():
         self.seconds_delay = 300
         self.REORGANIZE = False
         self.movie_glob_string = "*EER.eer"
+        self.movie_streams = 2
+        self.file_streams = 4
+        self.CHECKSUM = False
+        self.quiet_period = 30
         self.source = None 
         self.dest = None
 
@@ -421,6 +688,15 @@ class PARAMETERS():
             if cmdline[i] in ['--dry-run', '--dry_run', '--dryrun']:
                 self.DRY_RUN = True
 
+            if cmdline[i] in ['--quiet_period']:
+                try:
+                    self.quiet_period = max(0, int(cmdline[i+1]))
+                except:
+                    print(" Could not parse # of seconds given (--quiet_period flag), using default: %s" % self.quiet_period)
+
+            if cmdline[i] in ['--checksum']:
+                self.CHECKSUM = True
+
             if cmdline[i] in ['--reorganize']:
                 self.REORGANIZE = True
 
@@ -430,6 +706,18 @@ class PARAMETERS():
                 except:
                     print(" Could not parse # of seconds delay given (--n flag), using default: %s" % self.seconds_delay)
 
+            if cmdline[i] in ['--j']:
+                try:
+                    self.movie_streams = max(1, int(cmdline[i+1]))
+                except:
+                    print(" Could not parse # of concurrent movie transfers given (--j flag), using default: %s" % self.movie_streams)
+
+            if cmdline[i] in ['--j_small']:
+                try:
+                    self.file_streams = max(1, int(cmdline[i+1]))
+                except:
+                    print(" Could not parse # of concurrent small file transfers given (--j_small flag), using default: %s" % self.file_streams)
+
             if cmdline[i] in ['--movies']:
                 try:
                     movie_glob_string = str(cmdline[i+1])
@@ -489,6 +777,9 @@ class PARAMETERS():
         print("  seconds delay = %s" % self.seconds_delay)
         print("  REORGANIZE output dir = %s" % self.REORGANIZE)
         print("  movie glob string = '%s'" % self.movie_glob_string)
+        print("  concurrent transfers = %s movies, %s small files" % (self.movie_streams, self.file_streams))
+        print("  CHECKSUM copied files = %s" % self.CHECKSUM)
+        print("  quiet period = %s sec" % self.quiet_period)
         print("=============================")
 
         return ''
@@ -505,17 +796,34 @@ if __name__ == '__main__':
     import sys 
     import time
     import filecmp
+    import threading
+    import queue
+    import json
+    import zlib
+
+    ## Get the execution path of this script so we can find local modules
+    script_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    try:
+        sys.path.append(script_path)
+        import fast_copy
+    except :
+        print(" ERROR :: Check if fast_copy.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
 
     PARAMS = PARAMETERS(sys.argv)
+    ENGINE = COPY_ENGINE(movie_streams = PARAMS.movie_streams, file_streams = PARAMS.file_streams)
+    ## the manifest of the mirrored session is kept next to it at the destination
+    MANIFEST_FILE = os.path.join(PARAMS.dest, os.path.basename(os.path.normpath(PARAMS.source)) + "_copy_manifest.json")
+    COPY_MANIFEST = MANIFEST(MANIFEST_FILE, CHECKSUM = PARAMS.CHECKSUM)
+    STABILITY = fast_copy.STABILITY_TRACKER(quiet_period = PARAMS.quiet_period)
 
     if PARAMS.seconds_delay <= 0:
         ## no loop
         try:
             start_time = time.time()
             if PARAMS.REORGANIZE:
-                copy_reorganized(PARAMS.source, PARAMS.dest, PARAMS.movie_glob_string, DRY_RUN = PARAMS.DRY_RUN)
+                copy_reorganized(PARAMS.source, PARAMS.dest, PARAMS.movie_glob_string, ENGINE, DRY_RUN = PARAMS.DRY_RUN)
             else:
-                copy_project(PARAMS.source, PARAMS.dest, PARAMS.movie_glob_string, DRY_RUN= PARAMS.DRY_RUN, DEBUG=DEBUG)
+                copy_project(PARAMS.source, PARAMS.dest, PARAMS.movie_glob_string, ENGINE, COPY_MANIFEST, STABILITY, DRY_RUN= PARAMS.DRY_RUN, DEBUG=DEBUG)
             end_time = time.time()
             total_time_taken = end_time - start_time
             print(" ... copy runtime = %.2f sec" % total_time_taken)
@@ -523,6 +831,8 @@ if __name__ == '__main__':
         except KeyboardInterrupt:
             print()
             print(" Terminating ...")
+            ENGINE.stop()
+            if not PARAMS.DRY_RUN: COPY_MANIFEST.save()
 
             sys.exit()
     else:
@@ -531,9 +841,9 @@ if __name__ == '__main__':
             try:
                 start_time = time.time()
                 if PARAMS.REORGANIZE:
-                    copy_reorganized(PARAMS.source, PARAMS.dest, PARAMS.movie_glob_string, DRY_RUN= PARAMS.DRY_RUN)
+                    copy_reorganized(PARAMS.source, PARAMS.dest, PARAMS.movie_glob_string, ENGINE, DRY_RUN= PARAMS.DRY_RUN)
                 else:
-                    copy_project(PARAMS.source, PARAMS.dest, PARAMS.movie_glob_string, DRY_RUN= PARAMS.DRY_RUN, DEBUG=DEBUG)
+                    copy_project(PARAMS.source, PARAMS.dest, PARAMS.movie_glob_string, ENGINE, COPY_MANIFEST, STABILITY, DRY_RUN= PARAMS.DRY_RUN, DEBUG=DEBUG)
                 end_time = time.time()
                 total_time_taken = end_time - start_time
                 print(" ... copy runtime = %.2f sec" % total_time_taken)
@@ -545,6 +855,8 @@ if __name__ == '__main__':
 
             except KeyboardInterrupt:
                 print(" Terminating ...")
+                ENGINE.stop()
+                if not PARAMS.DRY_RUN: COPY_MANIFEST.save()
 
                 sys.exit()
 
@@ -13,7 +13,7 @@ def usage():
     print(
 """
     ## Dependencies: 
-        $ pip install panel hvplot starfile
+        $ pip install panel hvplot
     ## Run this script from the output directory of EPU_on-the-fly.py (containing ctf.star file) using panel:
         $ panel serve /programs/akeszei/bin/EPU_curate_otf.py 
     ## The webapp can be found at the address written in the terminal, typically at: localhost:5006/EPU_curate_otf
@@ -50,21 +50,39 @@ RAW_CSS="""
 #endregion 
 ######################################
 
-import os 
+import os, sys 
 import hvplot.pandas
 import holoviews as hv
 import numpy as np
 import pandas as pd
-import starfile as sf 
 from functools import partial # REF: https://docs.python.org/3/library/functools.html
 import panel as pn
 from PIL import Image as PIL_Image 
 
+## Get the path of this script so we can find local modules (under `panel serve' sys.argv[0] is the panel executable)
+script_path = os.path.dirname(os.path.abspath(__file__))
+try:
+    sys.path.append(script_path)
+    import ctf_logfile
+except :
+    print(" ERROR :: Check if ctf_logfile.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
+
+## followers of each logfile, which keep their position in the file between reads 
+LOGFILE_TAILS = {}
+
+def get_logfile_tail(star_file):
+    if star_file not in LOGFILE_TAILS:
+        LOGFILE_TAILS[star_file] = ctf_logfile.LOGFILE_TAIL(star_file)
+    return LOGFILE_TAILS[star_file]
+
 @pn.cache
 def get_data(star_file, VERBOSE = True):
-    """ Unpact the .STAR file into an easily manipulated data frame object
+    """ Unpack the rows of the .STAR file written so far into an easily manipulated data frame object
     """
-    df = sf.read(star_file)
+    tail = get_logfile_tail(star_file)
+    tail.poll()
+    mic_names, dZs, ctf_fits = tail.get_columns()
+    df = pd.DataFrame({'MicrographName' : mic_names, 'dZ' : dZs, 'CtfFit' : ctf_fits})
     df, reject_list, approve_list = assign_point_colors(df)
 
     if VERBOSE: 
@@ -278,12 +296,11 @@ def update():
     if not switch_continuous.value:
         return 
 
-    ## read the star file and load it into a fresh DataFrame 
-    new_df = sf.read(STAR_FILE)
+    ## read only the rows added to the star file since the last check 
+    new_rows = get_logfile_tail(STAR_FILE).poll()
 
-    ## get the size of the new DataFrame and compare it to the active one in cache  
-    if len(new_df.index) != len(df.index):
-        ## there is a difference in size, so we should run a refresh  
+    if len(new_rows) > 0:
+        ## there are new (or updated) micrographs, so we should run a refresh  
         empty_event = ""
         reload_data(empty_event)        
 
@@ -49,7 +49,15 @@ class PARAMETERS():
         self.logfile = "ctf.star"
         self.atlas_dir = False    
         self.epu_dir = False
-        self.gpu_id = 0
+        self.gpu_ids = [0]
+        self.copy_threads = 2
+        self.cpu_threads = 4
+        self.ctf_jobs = 2
+        self.ctf_threads = False
+        self.ctffind = "ctffind"
+        self.queue_size = 4
+        self.retries = 3
+        self.quiet_period = 30
 
 
         self.parse_cmdline(cmdline)
@@ -96,15 +104,55 @@ class PARAMETERS():
                     print(" Could not parse --total_dose entry or none given")
             if cmdline[i] == '--gpu':
                 try:
-                    self.gpu_id = int(cmdline[i+1])
+                    ## allow a comma-separated list of GPU ids, e.g. --gpu 0,1 
+                    self.gpu_ids = [int(gpu_id) for gpu_id in cmdline[i+1].split(',')]
                 except:
                     print(" Could not parse --gpu entry or none given")
+            if cmdline[i] == '--copy_threads':
+                try:
+                    self.copy_threads = max(1, int(cmdline[i+1]))
+                except:
+                    print(" Could not parse --copy_threads entry or none given")
+            if cmdline[i] == '--cpu_threads':
+                try:
+                    self.cpu_threads = max(1, int(cmdline[i+1]))
+                except:
+                    print(" Could not parse --cpu_threads entry or none given")
+            if cmdline[i] == '--ctf_jobs':
+                try:
+                    self.ctf_jobs = max(1, int(cmdline[i+1]))
+                except:
+                    print(" Could not parse --ctf_jobs entry or none given")
+            if cmdline[i] == '--ctf_threads':
+                try:
+                    self.ctf_threads = max(1, int(cmdline[i+1]))
+                except:
+                    print(" Could not parse --ctf_threads entry or none given")
+            if cmdline[i] == '--ctffind':
+                try:
+                    self.ctffind = cmdline[i+1]
+                except:
+                    print(" Could not parse --ctffind entry or none given")
+            if cmdline[i] == '--retries':
+                try:
+                    self.retries = max(1, int(cmdline[i+1]))
+                except:
+                    print(" Could not parse --retries entry or none given")
+            if cmdline[i] == '--quiet_period':
+                try:
+                    self.quiet_period = max(0, int(cmdline[i+1]))
+                except:
+                    print(" Could not parse --quiet_period entry or none given")
 
 
 
             if "*" in cmdline[i]:
                 self.movie_glob = cmdline[i]
 
+        ## by default, split the available cores evenly between the concurrent CTFFIND4 jobs 
+        if self.ctf_threads == False:
+            self.ctf_threads = max(1, (os.cpu_count() or 1) // self.ctf_jobs)
+
         if self.frames != False and self.total_dose != False:
             self.frame_dose = self.total_dose / float(self.frames) 
         else:
@@ -119,6 +167,10 @@ class PARAMETERS():
             if i == 0:
                 continue 
 
+            ## skip the value of flags that take a path 
+            if cmdline[i-1] == '--ctffind':
+                continue 
+
             if '/' in cmdline[i] or '\\' in cmdline[i]:
                 if self.epu_dir == False:
                     if self.check_if_EPU_directory(cmdline[i]):
@@ -158,7 +210,14 @@ class PARAMETERS():
             print("   frame dose = %s e/A**2/frame" % self.frame_dose)
         if self.save_movies != False:
             print("   Save movies = %s " % self.save_movies)
-        print("   GPU to use = %s" % self.gpu_id)
+        print("   GPU(s) to use = %s" % ",".join([str(gpu_id) for gpu_id in self.gpu_ids]))
+        if self.save_movies != False:
+            print("   Copy threads = %s" % self.copy_threads)
+        print("   CPU threads (jpg) = %s" % self.cpu_threads)
+        if self.kV != False:
+            print("   CTFFIND4 = %s (%s jobs x %s threads)" % (self.ctffind, self.ctf_jobs, self.ctf_threads))
+            if shutil.which(self.ctffind) == None:
+                print(" !! WARNING :: CTFFIND4 executable not found: %s" % self.ctffind)
         print(h_bar)
 
         return 
@@ -304,6 +363,8 @@ class DATASET():
     def __init__(self):
         ## initialize the object with an empty dictionary that will contain all micrograph log data 
         self.data = dict()
+        ## entries are added from several CTFFIND workers at once, hold the lock while changing or writing out the data 
+        self.lock = threading.Lock()
         return 
 
     def __str__(self):
@@ -352,37 +413,783 @@ class DATASET():
         ## first check if a log file even exists yet 
         if not os.path.isfile(fname):
             return 
-        
-        HEADER_START, DATA_START, DATA_END = get_table_position(fname, 'data_micrographs', DEBUG=DEBUG)
-        COLUMN_MIC_NAME = find_star_column(fname, '_MicrographName', HEADER_START, DATA_START, DEBUG=DEBUG)
-        COLUMN_dZ = find_star_column(fname, '_dZ', HEADER_START, DATA_START, DEBUG=DEBUG)
-        COLUMN_CTFFIT = find_star_column(fname, '_CtfFit', HEADER_START, DATA_START, DEBUG=DEBUG)
-
-        ## iterate over each data point and extract the information, then parse it into a desired data structure:
-        with open(fname, 'r') as f :
-            line_num = 0
-            parsed = 0
-            for line in f :
-                line_num += 1
-                ## ignore empty lines
-                if len(line.strip()) == 0 :
-                    continue
-                ## start working only after the header length
-                if DATA_END >= line_num > DATA_START - 1:
-
-                    mic_name = get_star_data(line, COLUMN_MIC_NAME)
-                    dZ = float(get_star_data(line, COLUMN_dZ))
-                    ctf_fit = float(get_star_data(line, COLUMN_CTFFIT))
 
-                    self.add_entry(mic_name, dZ, ctf_fit)
-                    parsed += 1
+        ## read only the complete rows of the logfile, keeping the latest values of any micrograph written more than once 
+        tail = ctf_logfile.LOGFILE_TAIL(fname)
+        tail.poll()
+        for mic_name in tail.data:
+            dZ, ctf_fit = tail.data[mic_name]
+            self.add_entry(mic_name, dZ, ctf_fit)
 
-        print(" ... %s entries parsed from logfile (%s)" % (parsed, fname))
+        print(" ... %s entries parsed from logfile (%s)" % (len(tail.data), fname))
         return 
 
+    def open_logfile(self, fname):
+        """ Start a fresh logfile from the current entries, new entries are then appended to it with log_entry
+        """
+        self.logfile = ctf_logfile.LOGFILE_WRITER(fname, data = self.data)
+        return
+
+    def log_entry(self, mic_name, dZ, ctf_fit):
+        with self.lock:
+            self.add_entry(mic_name, dZ, ctf_fit)
+            self.logfile.append(mic_name, dZ, ctf_fit)
+        return
+
+    def close_logfile(self):
+        with self.lock:
+            self.logfile.close()
+        return
+
     def size(self):
         return len(self.data)
 
+class STATE_DB():
+    """
+    Persistent record of how far each movie got through the pipeline, kept in an SQLite database in the working directory.
+    Each processing step of a movie has a status ('running', 'done' or 'failed'), its number of attempts, start & finish 
+    times, its output and any error message, and the CTF estimate is recorded for each movie. The step table is cached in 
+    memory when the session starts, so checking whether a movie still needs work does not touch the filesystem
+    """
+    def __init__(self, fname = "otf_state.db"):
+        self.fname = fname
+        ## workers update the state from several threads, serialize all access through a single connection
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(fname, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS steps (movie TEXT, step TEXT, status TEXT, attempts INTEGER, started REAL, finished REAL, output TEXT, error TEXT, PRIMARY KEY (movie, step))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS ctf (movie TEXT PRIMARY KEY, micrograph TEXT, dZ REAL, ctf_fit REAL)")
+        self.connection.commit()
+
+        ## cache of the form: { movie : { step : [status, attempts] }, ... }
+        self.steps = dict()
+        for movie, step, status, attempts in self.connection.execute("SELECT movie, step, status, attempts FROM steps"):
+            self.steps.setdefault(movie, dict())[step] = [status, attempts]
+        return
+
+    def __str__(self):
+        print("=============================")
+        print("  STATE DATABASE (%s)" % self.fname)
+        print("-----------------------------")
+        print("   # movies = %s" % len(self.steps))
+        counts = dict()
+        for movie in self.steps:
+            for step in self.steps[movie]:
+                key = (step, self.steps[movie][step][0])
+                counts[key] = counts.get(key, 0) + 1
+        for step, status in sorted(counts):
+            print("     %s :: %s = %s" % (step, status, counts[(step, status)]))
+        print("=============================")
+        return ''
+
+    def get_status(self, movie, step):
+        if movie in self.steps and step in self.steps[movie]:
+            return self.steps[movie][step][0]
+        return None
+
+    def is_done(self, movie, steps):
+        for step in steps:
+            if self.get_status(movie, step) != 'done':
+                return False
+        return True
+
+    def start_step(self, movie, step):
+        with self.lock:
+            entry = self.steps.setdefault(movie, dict()).setdefault(step, [None, 0])
+            entry[0] = 'running'
+            entry[1] += 1
+            self.connection.execute("INSERT INTO steps (movie, step, status, attempts, started) VALUES (?, ?, 'running', ?, ?) ON CONFLICT (movie, step) DO UPDATE SET status = 'running', attempts = excluded.attempts, started = excluded.started, finished = NULL, error = NULL", (movie, step, entry[1], time.time()))
+            self.connection.commit()
+        return
+
+    def finish_step(self, movie, step, output = None):
+        with self.lock:
+            self.steps[movie][step][0] = 'done'
+            self.connection.execute("UPDATE steps SET status = 'done', finished = ?, output = ? WHERE movie = ? AND step = ?", (time.time(), output, movie, step))
+            self.connection.commit()
+        return
+
+    def fail_step(self, movie, step, error):
+        with self.lock:
+            self.steps[movie][step][0] = 'failed'
+            self.connection.execute("UPDATE steps SET status = 'failed', finished = ?, error = ? WHERE movie = ? AND step = ?", (time.time(), error, movie, step))
+            self.connection.commit()
+        return
+
+    def set_ctf(self, movie, micrograph_name, dZ, ctf_fit):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO ctf (movie, micrograph, dZ, ctf_fit) VALUES (?, ?, ?, ?)", (movie, micrograph_name, dZ, ctf_fit))
+            self.connection.commit()
+        return
+
+    def get_failed(self, max_attempts):
+        """ Return the movies with a failed step that has been attempted fewer than max_attempts times
+        """
+        failed = []
+        with self.lock:
+            for movie in self.steps:
+                for status, attempts in self.steps[movie].values():
+                    if status == 'failed' and attempts < max_attempts:
+                        failed.append(movie)
+                        break
+        return failed
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+        return
+
+class PIPELINE():
+    """
+    Run each movie through the processing steps independently, with bounded queues between the stages so the GPU(s) keep
+    motion correcting new movies while copies, .JPG rendering and CTFFIND run on earlier movies:
+        save movie (copy pool) -> motion correction (one worker per GPU id) -> .JPGs (CPU pool)
+                                                                           -> CTFFIND4 (pool of concurrent CTFFIND4 jobs)
+    A full queue blocks the stage that feeds it, so no stage can run far ahead of the others.
+    Each step is recorded in the state database, so movies enter the pipeline at their first unfinished step and completed 
+    movies are skipped without checking their outputs on disk
+    """
+    def __init__(self, PARAMS, ctf_dataset, state):
+        self.params = PARAMS
+        self.ctf_dataset = ctf_dataset
+        self.state = state
+        ## movies currently queued or being processed, so a movie is never queued twice
+        self.in_flight = set()
+        ## movies EPU may still be writing, these are submitted again on each loop until they are complete
+        self.waiting = set()
+        self.stability = fast_copy.STABILITY_TRACKER(quiet_period = PARAMS.quiet_period)
+        ## number of branches (.JPG & CTFFIND4) each movie in flight still has to finish, and movies with a failed branch
+        self.branches = dict()
+        self.failed_branches = set()
+        self.processed = 0
+        self.previously_processed = 0
+        ## movies whose last attempt failed, a movie is dropped from it once a retry succeeds
+        self.failed_movies = set()
+        self.start_time = time.time()
+        self.stopping = False
+        self.threads = []
+        ## lock for the counters & set above
+        self.lock = threading.Lock()
+        ## GridSquare & atlas .JPGs are shared between movies, render each of them once per session
+        self.render_cache = RENDER_CACHE(PARAMS.jpg_dir, PARAMS.atlas_dir)
+
+        self.copy_queue = queue.Queue(maxsize = PARAMS.queue_size)
+        self.motioncor_queue = queue.Queue(maxsize = PARAMS.queue_size)
+        self.jpg_queue = queue.Queue(maxsize = PARAMS.queue_size)
+        self.ctf_queue = queue.Queue(maxsize = PARAMS.queue_size)
+
+        ## CTFFIND4 cannot run without a --kV value
+        self.RUN_CTF = PARAMS.kV != False
+        ## wall time of each CTFFIND4 job
+        self.ctf_jobs_run = 0
+        self.ctf_wall_time = 0
+        return
+
+    def start(self):
+        """ Start the worker threads for each stage (they only wait on their external programs, so threads are sufficient)
+        """
+        ## micrographs go to the .JPG and CTFFIND4 pools as soon as they are motion corrected
+        branch_queues = [self.jpg_queue]
+        if self.RUN_CTF:
+            branch_queues.append(self.ctf_queue)
+
+        if self.params.save_movies:
+            for i in range(self.params.copy_threads):
+                self.add_worker('save movie', self.save_stage, self.copy_queue, [self.motioncor_queue])
+        for gpu_id in self.params.gpu_ids:
+            self.add_worker('motion correction', self.motioncor_stage, self.motioncor_queue, branch_queues, stage_args = (gpu_id,))
+        for i in range(self.params.cpu_threads):
+            self.add_worker('jpg', self.jpg_stage, self.jpg_queue, [])
+        if self.RUN_CTF:
+            for i in range(self.params.ctf_jobs):
+                self.add_worker('CTFFIND4', self.ctf_stage, self.ctf_queue, [])
+        return
+
+    def add_worker(self, stage_name, stage, in_queue, out_queues, stage_args = ()):
+        thread = threading.Thread(target = self.worker, args = (stage_name, stage, stage_args, in_queue, out_queues), daemon = True)
+        thread.start()
+        self.threads.append(thread)
+        return
+
+    def get_first_queues(self, movie):
+        """ Find the queue(s) of the first stage the movie has not yet completed, an empty list if the movie is fully processed
+        """
+        if self.params.save_movies and not self.state.is_done(movie, ['save']):
+            return [self.copy_queue]
+        if not self.state.is_done(movie, ['motioncor']):
+            return [self.motioncor_queue]
+        first_queues = []
+        if not self.state.is_done(movie, ['jpg']):
+            first_queues.append(self.jpg_queue)
+        if self.RUN_CTF and not self.state.is_done(movie, ['ctf']):
+            first_queues.append(self.ctf_queue)
+        return first_queues
+
+    def submit(self, movie):
+        """ Queue a movie at its first unfinished stage, returns False if the movie is already queued or fully processed
+        """
+        with self.lock:
+            if movie in self.in_flight:
+                return False
+            first_queues = self.get_first_queues(movie)
+            if len(first_queues) == 0:
+                self.waiting.discard(movie)
+                self.previously_processed += 1
+                return False
+
+        ## hold back movies that are still being written, so no stage works on a partial movie
+        if not self.stability.is_complete(movie, companion = fast_copy.get_companion_xml(movie)):
+            if os.path.isfile(movie):
+                self.waiting.add(movie)
+            else:
+                self.waiting.discard(movie)
+            return False
+
+        with self.lock:
+            self.waiting.discard(movie)
+            self.in_flight.add(movie)
+        self.fan_out(movie, first_queues)
+        return True
+
+    def submit_waiting(self):
+        """ Submit the movies that were still being written when they were discovered, if they are complete by now
+        """
+        submitted = 0
+        for movie in sorted(self.waiting):
+            if self.submit(movie):
+                submitted += 1
+        return submitted
+
+    def fan_out(self, movie, target_queues):
+        ## the movie is finished once each queue it is passed to has processed it
+        with self.lock:
+            self.branches[movie] = len(target_queues)
+        for target_queue in target_queues:
+            self.put(target_queue, movie)
+        return
+
+    def finish_branch(self, movie, failed = False):
+        with self.lock:
+            self.branches[movie] -= 1
+            if failed:
+                self.failed_branches.add(movie)
+            if self.branches[movie] > 0:
+                return
+            del self.branches[movie]
+            self.in_flight.discard(movie)
+            if movie in self.failed_branches:
+                self.failed_branches.discard(movie)
+                self.failed_movies.add(movie)
+            else:
+                self.failed_movies.discard(movie)
+                self.processed += 1
+        return
+
+    def retry_failed(self):
+        """ Queue any movies with a failed step again, until they reach the maximum number of attempts
+        """
+        retried = 0
+        for movie in self.state.get_failed(self.params.retries):
+            if self.submit(movie):
+                retried += 1
+        return retried
+
+    def put(self, target_queue, movie):
+        ## wait for space on the queue, but give up if the pipeline is stopped in the meantime
+        while not self.stopping:
+            try:
+                target_queue.put(movie, timeout = 1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker(self, stage_name, stage, stage_args, in_queue, out_queues):
+        while not self.stopping:
+            try:
+                movie = in_queue.get(timeout = 1)
+            except queue.Empty:
+                continue
+
+            try:
+                stage(movie, *stage_args)
+            except Exception as e:
+                if not self.stopping:
+                    print(" !! WARNING :: %s failed for %s (%s)" % (stage_name, movie, e))
+                    self.finish_branch(movie, failed = True)
+                continue
+
+            if self.stopping:
+                ## the external program was likely interrupted along with this script, remove its potentially partial output
+                self.remove_partial_outputs(stage, movie)
+                break
+
+            if len(out_queues) > 0:
+                self.fan_out(movie, out_queues)
+            else:
+                self.finish_branch(movie)
+        return
+
+    def run_step(self, movie, step, function, output = None):
+        """ Run one processing step of a movie unless the state database has it as done, and record the outcome
+        """
+        if DRY_RUN:
+            function()
+            return
+        if self.state.get_status(movie, step) == 'done':
+            return
+
+        self.state.start_step(movie, step)
+        try:
+            function()
+            if output != None and not os.path.isfile(output):
+                raise RuntimeError("expected output was not written: %s" % output)
+        except Exception as e:
+            if not self.stopping:
+                self.state.fail_step(movie, step, str(e))
+            raise
+
+        ## leave interrupted steps as 'running' so they are redone on the next start
+        if not self.stopping:
+            self.state.finish_step(movie, step, output)
+        return
+
+    def save_stage(self, movie):
+        save_path = self.params.movie_save_string(movie)
+        self.run_step(movie, 'save', lambda: save_movie(movie, save_path, DRY_RUN = DRY_RUN), output = save_path)
+        return
+
+    def motioncor_stage(self, movie, gpu_id):
+        PARAMS = self.params
+        out_micrograph = PARAMS.mrc_save_string(movie)
+        self.run_step(movie, 'motioncor', lambda: run_motioncor2(movie, out_micrograph, pixel_size = PARAMS.angpix, kV = PARAMS.kV, frame_dose = PARAMS.frame_dose, gpu_id = gpu_id, DRY_RUN = DRY_RUN), output = out_micrograph)
+        return
+
+    def jpg_stage(self, movie):
+        ## write out a compressed .JPG file for analysis later
+        self.run_step(movie, 'jpg', lambda: self.write_jpgs(movie), output = self.params.jpg_save_string(movie))
+        return
+
+    def ctf_stage(self, movie):
+        ## calculate CTF estimate of micrograph
+        self.run_step(movie, 'ctf', lambda: self.estimate_ctf(movie))
+        return
+
+    def write_jpgs(self, movie):
+        PARAMS = self.params
+        write_jpg(PARAMS.mrc_save_string(movie), PARAMS.jpg_save_string(movie), DRY_RUN = DRY_RUN)
+        ## if not yet, write out the GridSquare image of the micrograph, the atlas and the marked location of the GridSquare on it
+        self.render_cache.render(movie)
+        return
+
+    def estimate_ctf(self, movie):
+        PARAMS = self.params
+        start_time = time.time()
+        dZ, ctf_fit, micrograph_name = run_ctffind(PARAMS.mrc_save_string(movie), PARAMS.ctf_dir, PARAMS.angpix, PARAMS.kV, self.ctf_dataset, threads = PARAMS.ctf_threads, ctffind = PARAMS.ctffind)
+        if micrograph_name != None:
+            wall_time = time.time() - start_time
+            with self.lock:
+                self.ctf_jobs_run += 1
+                self.ctf_wall_time += wall_time
+            print("  %s :: dZ = %s, ctf_fit = %s (%.1f sec)" % (micrograph_name, dZ, ctf_fit, wall_time))
+        elif DRY_RUN:
+            return
+        else:
+            ## the micrograph already had an entry in the logfile
+            micrograph_name = os.path.split(PARAMS.mrc_save_string(movie))[1]
+            if not self.ctf_dataset.entry_exists(micrograph_name):
+                raise RuntimeError("no CTFFIND4 result for %s" % micrograph_name)
+            dZ = self.ctf_dataset.get_dZ(micrograph_name)
+            ctf_fit = self.ctf_dataset.get_ctf_fit(micrograph_name)
+        self.state.set_ctf(movie, micrograph_name, dZ, ctf_fit)
+        return
+
+    def remove_partial_outputs(self, stage, movie):
+        PARAMS = self.params
+        if stage == self.save_stage:
+            ## save_movie copies under a temporary name before renaming it
+            partial_files = [fast_copy.get_temp_name(PARAMS.movie_save_string(movie))]
+        elif stage == self.motioncor_stage:
+            out_micrograph = PARAMS.mrc_save_string(movie)
+            partial_files = [out_micrograph, os.path.splitext(out_micrograph)[0] + "_DW.mrc"]
+        elif stage == self.jpg_stage:
+            partial_files = [PARAMS.jpg_save_string(movie)]
+        else:
+            ## CTFFIND4 outputs are overwritten when the step is redone
+            partial_files = []
+
+        for partial_file in partial_files:
+            if os.path.isfile(partial_file):
+                os.remove(partial_file)
+        return
+
+    def stop(self):
+        """ Let each worker finish (or abandon) its current movie, then wait for all workers to exit
+        """
+        self.stopping = True
+        for thread in self.threads:
+            thread.join()
+        return
+
+    def status(self):
+        """ Summarize the progress of the pipeline, the processing rate should keep up with the acquisition rate for the queues to stay short
+        """
+        elapsed_minutes = (time.time() - self.start_time) / 60
+        rate = self.processed / elapsed_minutes if elapsed_minutes > 0 else 0
+        status_string = "%s movies processed (%.1f movies/min), %s in progress (queued :: " % (self.processed + self.previously_processed, rate, len(self.in_flight))
+        if self.params.save_movies:
+            status_string += "save = %s, " % self.copy_queue.qsize()
+        status_string += "motion correction = %s, jpg = %s" % (self.motioncor_queue.qsize(), self.jpg_queue.qsize())
+        if self.RUN_CTF:
+            status_string += ", CTFFIND4 = %s" % self.ctf_queue.qsize()
+        status_string += ")"
+        if len(self.waiting) > 0:
+            status_string += ", %s being written" % len(self.waiting)
+        if self.ctf_jobs_run > 0:
+            status_string += ", %.1f sec/CTFFIND4 job" % (self.ctf_wall_time / self.ctf_jobs_run)
+        if len(self.failed_movies) > 0:
+            status_string += ", %s failed" % len(self.failed_movies)
+        return status_string
+
+class RENDER_CACHE():
+    """
+    Per-session cache of the images shared between movies (GridSquare, atlas & GridSquare-on-atlas .JPGs). Each GridSquare
+    is rendered and marked on the atlas once, while the atlas image and the basis vectors parsed from its Tile .XML files are
+    kept in memory, keyed by the atlas file and its modification time, so the atlas is only decoded again if EPU rewrites it
+    """
+    def __init__(self, jpg_dir, atlas_dir = False):
+        self.jpg_dir = jpg_dir
+        self.atlas_dir = atlas_dir
+        ## GridSquare ids (e.g. 'GridSquare_1234') that were rendered, and those marked on the current atlas
+        self.gridsquares_rendered = set()
+        self.gridsquares_marked = set()
+        ## latest atlas .MRC file, only searched for again when the atlas directory is modified
+        self.atlas_dir_mtime = None
+        self.atlas_mrc_path = None
+        ## (atlas .MRC path, modification time) of the atlas loaded below
+        self.atlas_key = None
+        self.atlas_image = None
+        self.atlas_basis = None
+        ## only one worker at a time may check/render the shared images
+        self.lock = threading.Lock()
+        return
+
+    def render(self, movie):
+        grid_square_str = splitall(movie)[-3] # by convention the GridSquare directory is 2 folders behind
+        with self.lock:
+            if grid_square_str not in self.gridsquares_rendered:
+                self.render_gridsquare(movie, grid_square_str)
+            if self.atlas_dir != False:
+                self.update_atlas()
+                if self.atlas_key != None and grid_square_str not in self.gridsquares_marked:
+                    self.markup_gridsquare(movie, grid_square_str)
+        return
+
+    def render_gridsquare(self, movie, grid_square_str):
+        gridsquare_files = glob.glob(os.path.join(get_gridsquare_dir(movie), 'GridSquare*mrc'))
+        if len(gridsquare_files) == 0:
+            ## EPU has not written the GridSquare image yet, try again with the next movie
+            return
+        write_jpg(gridsquare_files[0], os.path.join(self.jpg_dir, grid_square_str + '.jpg'), DRY_RUN = DRY_RUN)
+        self.gridsquares_rendered.add(grid_square_str)
+        return
+
+    def update_atlas(self):
+        """ Load the latest atlas if it is new or was modified since it was loaded
+        """
+        dir_mtime = os.stat(self.atlas_dir).st_mtime
+        if dir_mtime != self.atlas_dir_mtime:
+            ## take the match with the highest alpha numeric match
+            atlas_files = sorted(glob.glob(os.path.join(self.atlas_dir, 'Atlas*mrc')))
+            if len(atlas_files) > 0:
+                self.atlas_mrc_path = atlas_files[-1]
+            self.atlas_dir_mtime = dir_mtime
+        if self.atlas_mrc_path == None:
+            return
+
+        try:
+            atlas_key = (self.atlas_mrc_path, os.stat(self.atlas_mrc_path).st_mtime)
+        except FileNotFoundError:
+            ## atlas was removed, search the directory again next time
+            self.atlas_dir_mtime = None
+            self.atlas_mrc_path = None
+            return
+        if atlas_key != self.atlas_key:
+            self.load_atlas(atlas_key)
+        return
+
+    def load_atlas(self, atlas_key):
+        atlas_mrc_path, atlas_mtime = atlas_key
+        atlas_name = os.path.splitext(os.path.split(atlas_mrc_path)[-1])[0]
+        atlas_jpg_path = os.path.join(self.jpg_dir, atlas_name + ".jpg")
+        ## Tile .XML files of the atlas share its id, i.e. Atlas_1.mrc -> Tile_..._1.xml
+        atlas_id = atlas_name.split("_")[-1]
+        tile_files = sorted(glob.glob(os.path.join(self.atlas_dir, "Tile*" + atlas_id + ".xml")))
+
+        if DRY_RUN:
+            print("  load atlas %s (%s tiles) and write %s" % (atlas_mrc_path, len(tile_files), atlas_jpg_path))
+        else:
+            self.atlas_image = mrc_render.sigma_contrast(mrc_render.load_mrc(atlas_mrc_path, bin = 2), 3)
+            ## the atlas .JPG may already be up to date from a previous run
+            if not os.path.isfile(atlas_jpg_path) or os.stat(atlas_jpg_path).st_mtime < atlas_mtime:
+                mrc_render.save_jpg(self.atlas_image, atlas_jpg_path)
+            self.atlas_basis = get_atlas_basis(tile_files, self.atlas_image.shape)
+            if self.atlas_basis == None:
+                print(" !! WARNING :: Could not find the Tile_..._%s.xml files of the atlas, GridSquare locations will not be marked (%s)" % (atlas_id, self.atlas_dir))
+
+        self.atlas_key = atlas_key
+        ## GridSquares are marked again on the new atlas
+        self.gridsquares_marked = set()
+        return
+
+    def markup_gridsquare(self, movie, grid_square_str):
+        gridsquare_markup_jpg_path = os.path.join(self.jpg_dir, grid_square_str + '_Atlas.jpg')
+        ## a markup written after the atlas was last modified (e.g. in a previous run) is still valid
+        if os.path.isfile(gridsquare_markup_jpg_path) and os.stat(gridsquare_markup_jpg_path).st_mtime >= self.atlas_key[1]:
+            self.gridsquares_marked.add(grid_square_str)
+            return
+        if self.atlas_basis == None and not DRY_RUN:
+            self.gridsquares_marked.add(grid_square_str)
+            return
+
+        gridsquare_xml_files = glob.glob(os.path.join(get_gridsquare_dir(movie), 'GridSquare*xml'))
+        if len(gridsquare_xml_files) == 0:
+            ## EPU has not written the GridSquare metadata yet, try again with the next movie
+            return
+
+        if DRY_RUN:
+            print("  mark %s on atlas :: %s" % (gridsquare_xml_files[0], gridsquare_markup_jpg_path))
+        else:
+            stage_position = get_stage_position(gridsquare_xml_files[0])
+            if None in stage_position:
+                print(" !! WARNING :: Could not read the stage position of %s" % gridsquare_xml_files[0])
+            else:
+                x, y = atlas_pixel_position(stage_position, self.atlas_basis, self.atlas_image.shape)
+                mrc_render.save_jpg(self.atlas_image, gridsquare_markup_jpg_path, markers = [(x, y)])
+        self.gridsquares_marked.add(grid_square_str)
+        return
+
+class MOVIE_DISCOVERY():
+    """
+    Incrementally find movies in the EPU session (equivalent to a recursive glob of '**/Data/**/<movie_glob>') without
+    re-reading the whole directory tree on each loop. A directory's modification time changes only when entries are added
+    to (or removed from) it, so an index of each directory's mtime, subdirectories and movies lets unchanged directories be
+    skipped with a single stat call. The index is saved in the working directory so restarts do not need a full rescan.
+    If inotify is available, changed directories are reported directly by the kernel and not even the stat calls are needed.
+    Since inotify does not see changes made by other hosts on network filesystems, a full mtime sweep still runs every
+    few loops, and inotify is turned off if a sweep finds changes it missed
+    """
+    ## inotify event flags, see: man 7 inotify
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+
+    def __init__(self, epu_dir, movie_glob, index_file = "movie_index.json", sweep_interval = 12):
+        self.epu_dir = os.path.normpath(epu_dir)
+        self.movie_glob = movie_glob
+        self.index_file = index_file
+        self.sweep_interval = sweep_interval
+        ## index of the form: { 'relative/dir/path' : { 'mtime' : int(ns), 'dirs' : [names], 'movies' : [names] }, ... }
+        self.index = self.load_index()
+        ## movies already returned in this session
+        self.seen = set()
+        self.passes = 0
+        self.index_changed = False
+
+        ## inotify watch descriptors to relative directory paths, and directories with events since the last pass
+        self.inotify_fd = None
+        self.watches = dict()
+        self.watched = set()
+        self.dirty_dirs = set()
+        self.init_inotify()
+        return
+
+    def load_index(self):
+        if not os.path.isfile(self.index_file):
+            return dict()
+        try:
+            with open(self.index_file, 'r') as f:
+                saved = json.load(f)
+        except ValueError:
+            print(" !! WARNING :: Could not read movie index (%s), rescanning the EPU directory" % self.index_file)
+            return dict()
+        ## only reuse the index for the same session and movie glob
+        if saved.get('epu_dir') != self.epu_dir or saved.get('movie_glob') != self.movie_glob:
+            return dict()
+        return saved['dirs']
+
+    def save_index(self):
+        if not self.index_changed:
+            return
+        ## write to a temporary file and rename it over the old index so it is never left half-written
+        temp_file = self.index_file + ".tmp"
+        with open(temp_file, 'w') as f:
+            json.dump({'epu_dir' : self.epu_dir, 'movie_glob' : self.movie_glob, 'dirs' : self.index}, f)
+        os.replace(temp_file, self.index_file)
+        self.index_changed = False
+        return
+
+    def init_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            ## not on Linux (or no inotify support in libc), use the mtime index alone
+            return
+        if fd < 0:
+            return
+        self.libc = libc
+        self.inotify_fd = fd
+        return
+
+    def stop_inotify(self, reason):
+        print(" ... %s, discovering movies by directory modification times instead" % reason)
+        os.close(self.inotify_fd)
+        self.inotify_fd = None
+        self.watches = dict()
+        self.watched = set()
+        self.dirty_dirs = set()
+        return
+
+    def add_watch(self, rel_dir):
+        if self.inotify_fd == None:
+            return
+        wd = self.libc.inotify_add_watch(self.inotify_fd, os.path.join(self.epu_dir, rel_dir).encode(), self.IN_CREATE | self.IN_MOVED_TO)
+        if wd < 0:
+            ## typically the limit on watches was reached (fs.inotify.max_user_watches)
+            self.stop_inotify("Could not add inotify watch (errno %s)" % ctypes.get_errno())
+            return
+        self.watches[wd] = rel_dir
+        self.watched.add(rel_dir)
+        return
+
+    def read_events(self):
+        """ Drain the inotify event queue and mark the directories with new entries for rescanning,
+            returns False if the kernel dropped events and a full sweep is needed
+        """
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 65536)
+            except BlockingIOError:
+                return True
+            offset = 0
+            while offset < len(data):
+                ## struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                offset += 16 + length
+                if mask & self.IN_Q_OVERFLOW:
+                    return False
+                if wd in self.watches:
+                    self.dirty_dirs.add(self.watches[wd])
+
+    def is_data_dir(self, rel_dir):
+        ## movies are only taken from within a 'Data' directory at any depth of the EPU session
+        return 'Data' in rel_dir.split(os.sep)
+
+    def scan_dir(self, rel_dir, mtime):
+        """ List a directory and update its entry in the index
+        """
+        dirs = []
+        movies = []
+        IS_DATA_DIR = self.is_data_dir(rel_dir)
+        with os.scandir(os.path.join(self.epu_dir, rel_dir)) as entries:
+            for entry in entries:
+                ## match glob behavior and ignore hidden files and directories
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif IS_DATA_DIR and fnmatch.fnmatchcase(entry.name, self.movie_glob):
+                    movies.append(entry.name)
+        self.index[rel_dir] = {'mtime' : mtime, 'dirs' : dirs, 'movies' : movies}
+        self.index_changed = True
+        return
+
+    def sweep(self, rel_dir = '', changed_dirs = None):
+        """ Walk the directory tree from rel_dir, only listing directories that were never seen or whose mtime has changed
+        """
+        stack = [rel_dir]
+        while len(stack) > 0:
+            rel_dir = stack.pop()
+            ## watch before reading the mtime, so no change can fall between the two
+            if rel_dir not in self.watched:
+                self.add_watch(rel_dir)
+            try:
+                mtime = os.stat(os.path.join(self.epu_dir, rel_dir)).st_mtime_ns
+            except FileNotFoundError:
+                self.remove_dir(rel_dir)
+                continue
+
+            if rel_dir not in self.index:
+                self.scan_dir(rel_dir, mtime)
+            elif self.index[rel_dir]['mtime'] != mtime:
+                if changed_dirs != None:
+                    changed_dirs.append(rel_dir)
+                self.scan_dir(rel_dir, mtime)
+
+            for subdir in self.index[rel_dir]['dirs']:
+                stack.append(os.path.join(rel_dir, subdir))
+        return
+
+    def rescan(self, rel_dir):
+        """ List a directory reported by inotify and walk only its new subdirectories
+        """
+        known_dirs = set()
+        if rel_dir in self.index:
+            known_dirs = set(self.index[rel_dir]['dirs'])
+        try:
+            mtime = os.stat(os.path.join(self.epu_dir, rel_dir)).st_mtime_ns
+        except FileNotFoundError:
+            self.remove_dir(rel_dir)
+            return
+        self.scan_dir(rel_dir, mtime)
+        for subdir in self.index[rel_dir]['dirs']:
+            if subdir not in known_dirs:
+                self.sweep(os.path.join(rel_dir, subdir))
+        return
+
+    def remove_dir(self, rel_dir):
+        if rel_dir in self.index:
+            del self.index[rel_dir]
+            self.index_changed = True
+        return
+
+    def discover(self):
+        """ Return the movies that have not yet been returned in this session, in sorted order
+        """
+        self.passes += 1
+        if self.inotify_fd == None or len(self.watches) == 0:
+            self.sweep()
+        elif not self.read_events():
+            self.stop_inotify("inotify event queue overflowed")
+            self.sweep()
+        else:
+            ## rescan only the directories with new entries, new subdirectories are walked (and watched) as they are found
+            dirty_dirs = self.dirty_dirs
+            self.dirty_dirs = set()
+            for rel_dir in dirty_dirs:
+                self.rescan(rel_dir)
+            ## periodically check the inotify events are complete, since e.g. changes on network filesystems made by other hosts are not reported
+            if self.passes % self.sweep_interval == 0:
+                missed_dirs = []
+                self.sweep(changed_dirs = missed_dirs)
+                if len(missed_dirs) > 0:
+                    self.stop_inotify("inotify missed changes to %s directories (e.g. %s)" % (len(missed_dirs), os.path.join(self.epu_dir, missed_dirs[0])))
+
+        new_movies = []
+        for rel_dir in self.index:
+            for movie in self.index[rel_dir]['movies']:
+                movie_path = os.path.join(self.epu_dir, rel_dir, movie)
+                if movie_path not in self.seen:
+                    new_movies.append(movie_path)
+        self.seen.update(new_movies)
+        self.save_index()
+        return sorted(new_movies)
+
+    def size(self):
+        return len(self.seen)
+
 #endregion
 #############################
 
@@ -410,39 +1217,29 @@ def usage():
     print("       --frames (-1) : total frames in each movie" )
     print("       --total_dose (-1) : e/squared angstroms for entire movie" )
     print("       --gpu (0) : if you have a specific GPU you want to use, set this flag with the id number" )
+    print("                   give a comma-separated list (e.g. 0,1) to motion correct on several GPUs at once" )
+    print("       --copy_threads (2) : movies copied at once when using --save_movies" )
+    print("       --cpu_threads (4) : micrographs rendered to .JPG at once" )
+    print("       --ctf_jobs (2) : CTFFIND4 processes run at once" )
+    print("       --ctf_threads (cores / ctf_jobs) : threads given to each CTFFIND4 process" )
+    print("       --ctffind (ctffind) : CTFFIND4 executable to use (any program answering the same prompts on stdin works)" )
+    print("       --retries (3) : attempts made at each processing step of a movie before giving up on it" )
+    print("                       (the state of each movie is kept in otf_state.db in the working directory)" )
+    print("       --quiet_period (30) : seconds a movie must stay unchanged before it is processed, unless the .xml" )
+    print("                             EPU writes once the movie is complete appears first" )
     print("===================================================================================================")
     sys.exit()
 
-def get_all_movies(EPU_dir, movie_glob, VERBOSE = True):
-    """
-    PARAMETERS 
-        EPU_dir = path-like str() pointing to the main EPU Session directory
-        movie_glob = glob-like str(), i.e. containing *, that uniquely identifies a movie in the EPU session 
-    RETURNS 
-        movies = list() object containing all the movies found in the EPU session 
-    """
-    movies = list()
-
-    ## prepare the EPU dir with infinite recursion string appended (i.e. **)
-    search_dir = os.path.join(EPU_dir, "**/Data/**")
-    search_glob = os.path.join(search_dir, movie_glob)
-    # print(" Glob string to find movies: %s" % search_dir)
-    for match in glob.glob(search_glob, recursive = True):
-        movies.append(match)
-
-    if VERBOSE:
-        print(" %s movies found in EPU directory, e.g.: " % (len(movies)))
-        print(h_sub_bar)
-        if len(movies) > 0:
-            for i in range(len(movies)):
-                print("    %s" % movies[i])
-                if i == 2: 
-                    print("    ...")
-                    break 
-        
-        
-
-    return movies
+def print_movies(movies):
+    print(" %s movies found in EPU directory, e.g.: " % (len(movies)))
+    print(h_sub_bar)
+    if len(movies) > 0:
+        for i in range(len(movies)):
+            print("    %s" % movies[i])
+            if i == 2: 
+                print("    ...")
+                break 
+    return
 
 def splitall(path):
     """
@@ -579,22 +1376,15 @@ def save_movie(file, save_path, DRY_RUN = False):
 
     if DRY_RUN:
         print()
-        print(" shutil.copy2(%s, %s)" % (file, save_dir))
-        print(" shutil.move(%s, %s)" % (os.path.join(save_dir, os.path.split(file)[-1]), save_path ))
+        print(" fast_copy.copy2(%s, %s)" % (file, save_path))
     else:
         ## wrap in try statement to allow graceful exiting of program in case it is mid-copying 
         try:
-            ## write the target file to the save directory 
-            shutil.copy2(file, save_dir)
-            ## rename the output file to the desired final name 
-            shutil.move(os.path.join(save_dir, os.path.split(file)[-1]), save_path )
+            ## write the target file under a temporary name, which is renamed to the desired final name once complete 
+            fast_copy.copy2(file, save_path)
 
         except KeyboardInterrupt:
-            ## clean up partial copied file 
-            potential_partial_file = os.path.join(save_dir, os.path.split(file)[-1])
-            if os.path.isfile(potential_partial_file):
-                os.remove(potential_partial_file)
-
+            ## the partial copy is cleaned up by copy2 
             sys.exit()
 
     return 
@@ -675,107 +1465,81 @@ def write_jpg(input_mrc, output_jpg, bin = 4, DRY_RUN = False):
             # print(" .JPG already exists (%.1f kbs)" % (size_kb))    
             return 
 
-    command = "mrc2img.py %s %s " % (input_mrc, output_jpg)
-    command += "--bin %s" % bin
-
     if DRY_RUN:
-        print(" ", command)
+        print("  mrc_render.mrc2jpg(%s, %s, bin = %s)" % (input_mrc, output_jpg, bin))
     else:
-
-        try:
-            process = Popen(command, shell=True, stdout=PIPE)
-            process.wait()
-        except KeyboardInterrupt:
-            ## clean up partial files 
-            if os.path.isfile(output_jpg):
-                os.remove(output_jpg)
+        ## render in-process, the output is renamed into place once complete so no partial file is left on interrupt
+        mrc_render.mrc2jpg(input_mrc, output_jpg, bin = bin)
 
     return 
 
-def write_gridsquare_jpg(input_movie_path, jpg_dir):
-    ## get the GridSquare_##### identity for the movie
-    dirs = splitall(input_movie_path) 
-    grid_square_str = dirs[-3] # by convention the GridSquare directory is 2 folders behind 
-    
-    ## rebuild the path to the gridsquare directory 
-    grid_square_dir = ''
-    for step in dirs:
-        if 'GridSquare' in step:
-            grid_square_dir = os.path.join(grid_square_dir, step)
-            break
-        else:
-            grid_square_dir = os.path.join(grid_square_dir, step)
-    
-    ## find all GridSquare*mrc files 
-    search_glob = os.path.join(grid_square_dir, 'GridSquare*mrc')
-    ## take the first match 
-    gridsquare_file = glob.glob(search_glob)[0]
-    gridsquare_jpg_path = os.path.join(jpg_dir, grid_square_str + '.jpg')
-    
-    write_jpg(gridsquare_file, gridsquare_jpg_path)
-
-    return 
-
-def write_atlas_jpg(atlas_dir, jpg_dir):
-    ## get all Atlas files in the directory 
-    search_glob = os.path.join(atlas_dir, 'Atlas*mrc')
-    ## take the match with the highest alpha numeric match 
-    atlas_mrc_path = sorted(glob.glob(search_glob))[-1]
-
-    ## determine the output jpg name 
-    atlas_jpg_path = os.path.join(jpg_dir, os.path.splitext(os.path.split(atlas_mrc_path)[-1])[0] + ".jpg")
-    # print(" atlas found = %s, jpg = %s" % (atlas_mrc_path, atlas_jpg_path)) 
-
-    write_jpg(atlas_mrc_path, atlas_jpg_path, bin = 2)
-
-    return 
-
-def markup_gridsquare_on_atlas_jpg(input_movie_path, atlas_dir, jpg_dir, DRY_RUN = False):
-    ## 1. generate the expected gridsquare markedup output and check if it already exists 
-    dirs = splitall(input_movie_path) 
-    grid_square_str = dirs[-3] # by convention the GridSquare directory is 2 folders behind 
-    gridsquare_markup_jpg_path = os.path.join(jpg_dir, grid_square_str + '_Atlas.jpg')
-
-    # print(" .... Gridsquare mark up file name : ", gridsquare_markup_jpg_path)
-
-    if os.path.isfile(gridsquare_markup_jpg_path):
-        ## gridsquare markup already exists, we can skip remaking it 
-        # print(" .... Gridsquare atlas position is already made ")
-        return 
-
-    ## rebuild the path to the gridsquare directory 
+def get_gridsquare_dir(input_movie_path):
+    """ Rebuild the path to the GridSquare directory of a movie
+    """
     grid_square_dir = ''
-    for step in dirs:
+    for step in splitall(input_movie_path):
+        grid_square_dir = os.path.join(grid_square_dir, step)
         if 'GridSquare' in step:
-            grid_square_dir = os.path.join(grid_square_dir, step)
             break
-        else:
-            grid_square_dir = os.path.join(grid_square_dir, step)
-    
-    ## 2. find the corresponding .xml file for the gridsquare 
-    ## find all GridSquare*xml files 
-    search_glob = os.path.join(grid_square_dir, 'GridSquare*xml')
-    ## take the first match 
-    gridsquare_xml_file = glob.glob(search_glob)[0]
-
-    ## 3. figure out the expected location of the atlas.jpg file that should already exist 
-    search_glob = os.path.join(atlas_dir, 'Atlas*mrc')
-    atlas_mrc_path = sorted(glob.glob(search_glob))[-1]
-    atlas_jpg_path = os.path.join(jpg_dir, os.path.splitext(os.path.split(atlas_mrc_path)[-1])[0] + ".jpg")
-    if not os.path.isfile(atlas_jpg_path):
-        print(" !! WARNING :: Could not generate a GridSquare location file since no Atlas_<x>.jpg was found")
-        return 
+    return grid_square_dir
 
-    ## run the mark up script with the relevant input information 
-    command = "show_atlas_position.py %s %s %s %s " % (atlas_dir, atlas_jpg_path, gridsquare_xml_file, gridsquare_markup_jpg_path)
-
-    if DRY_RUN:
-        print(" ", command)
+def get_stage_position(xml_file):
+    """ For an input EPU .XML file, find the X and Y coordinates of the stage (microscopeData > stage > Position)
+    RETURNS
+        coords = tuple(x, y), with None for any coordinate that was not found
+    """
+    xml_data = ET.parse(xml_file).getroot()
+    position = xml_data.find('{*}microscopeData/{*}stage/{*}Position')
+    coords = []
+    for axis in ['X', 'Y']:
+        entry = position.find('{*}' + axis) if position != None else None
+        coords.append(float(entry.text) if entry != None else None)
+    return tuple(coords)
+
+def get_atlas_basis(tile_files, atlas_shape):
+    """ Determine the basis vectors that map a stage position onto the atlas image from the stage positions of its tiles,
+        using the same conventions as show_atlas_position.py, i.e. the first tiles are acquired as:
+             4 -- 3 -- 2
+             |         |
+             5    0 -- 1
+             |
+             6 -- 7
+        so the vectors from tile 0 -> 1 and 0 -> 3 define the x & y axes in real space
+    RETURNS
+        (x_basis_real, y_basis_real, basis_px), or None if the tiles are missing; where basis_px is the length of each basis vector on the image
+    """
+    if len(tile_files) < 4:
+        return None
+    tile_coordinates = [get_stage_position(tile_file) for tile_file in tile_files]
+    if None in tile_coordinates[0] + tile_coordinates[1] + tile_coordinates[3]:
+        return None
+    x_basis_real = np.array(tile_coordinates[1]) - np.array(tile_coordinates[0])
+    y_basis_real = np.array(tile_coordinates[3]) - np.array(tile_coordinates[0])
+
+    ## the number of tiles gives the number of basis lengths spanning from the center of the atlas to an edge
+    x = np.sqrt(len(tile_files)) / 2
+    if x == int(x):
+        scaling_factor = x
+    elif x <= int(x) + 0.5:
+        scaling_factor = int(x) + 0.5
     else:
-        process = Popen(command, shell=True, stdout=PIPE)
-        process.wait()
+        scaling_factor = int(x) + 1
+    basis_px = int(int(atlas_shape[0] / 2) / scaling_factor)
+    return (x_basis_real, y_basis_real, basis_px)
 
-    return 
+def atlas_pixel_position(stage_position, atlas_basis, atlas_shape):
+    """ Find the pixel position (x, y) on the atlas image of a stage position
+    """
+    x_basis_real, y_basis_real, basis_px = atlas_basis
+    point = np.array(stage_position)
+    ## how many basis lengths the point lies along each axis
+    relative_x = np.inner(point, x_basis_real) / np.inner(x_basis_real, x_basis_real)
+    relative_y = np.inner(point, y_basis_real) / np.inner(y_basis_real, y_basis_real)
+    ## image space has its origin at the center of the atlas with y pointing up, while pixel rows count down from the top
+    half_size = int(atlas_shape[0] / 2)
+    x = (basis_px * relative_x + half_size) * atlas_shape[1] / (2 * half_size)
+    y = (half_size - basis_px * relative_y) * atlas_shape[0] / (2 * half_size)
+    return x, y
 
 def copy_misc_files(epu_dir, misc_dir, allowed_extensions = ['.png', '.jpg', '.jpg', '.mrc']):
     """
@@ -806,7 +1570,7 @@ def copy_misc_files(epu_dir, misc_dir, allowed_extensions = ['.png', '.jpg', '.j
 
     return 
 
-def run_ctffind(micrograph_path, out_dir, pixel_size, kV, logfile, ctf_dataset):
+def run_ctffind(micrograph_path, out_dir, pixel_size, kV, ctf_dataset, threads = 1, ctffind = 'ctffind'):
     if not kV:
         print(" No --kV value supplied, cannot run CTFFIND4...")
         return -1, -1, None
@@ -839,7 +1603,7 @@ def run_ctffind(micrograph_path, out_dir, pixel_size, kV, logfile, ctf_dataset):
     ## if expert options yes
     resample_Q = "no"
     dZ_known_Q = "no"
-    threads = "20"
+    threads = str(threads)
     #################################
 
     cmds = [input_mrc, diagnostic_output_mrc, pixel_size, kV, Cs, amp_contrast, amplitude_spectrum_size, resolution_min, resolution_max, dZ_min, dZ_max, dZ_search_step, astig_known_Q, slower_more_exhaustive_Q, astig_restraint_Q, additional_phase_shift_Q, set_expert_options_Q, resample_Q, dZ_known_Q, threads]
@@ -847,14 +1611,21 @@ def run_ctffind(micrograph_path, out_dir, pixel_size, kV, logfile, ctf_dataset):
     # print(" CTFFIND4 command: ")
     # print( "    ", cmds)
 
+    ## remove the results of any previous attempt, so a failed job is never mistaken for a new estimate
+    data_file_name = os.path.splitext(micrograph_name)[0] + "_PS.txt"
+    data_file_path = os.path.join(out_dir, data_file_name)
+    if os.path.exists(data_file_path):
+        os.remove(data_file_path)
+
     try:
         ## REF: https://stackoverflow.com/questions/8475290/how-do-i-write-to-a-python-subprocess-stdin
-        p = Popen('ctffind', stdin=PIPE, stdout=DEVNULL)
+        p = Popen(ctffind, stdin=PIPE, stdout=DEVNULL)
         for x in cmds:
             p.stdin.write(x.encode() + b'\n')
 
         p.communicate()
-        p.wait()
+        if p.returncode != 0:
+            raise RuntimeError("CTFFIND4 exited with status %s for %s" % (p.returncode, micrograph_name))
 
         ## clean up undesired outputs 
         avrot_file_name = os.path.splitext(micrograph_name)[0] + "_PS_avrot.txt"
@@ -863,15 +1634,12 @@ def run_ctffind(micrograph_path, out_dir, pixel_size, kV, logfile, ctf_dataset):
             os.remove(avrot_file_path)
 
         ## parse the output text tile for dZ_1, dZ_2, ctf_fit
-        data_file_name = os.path.splitext(micrograph_name)[0] + "_PS.txt"
-        data_file_path = os.path.join(out_dir, data_file_name)
         dZ, ctf_fit = parse_ctffind_datafile(data_file_path)
         # print(" CTFFIND results: ")
         # print("    dZ =", dZ)
         # print("   fit =", ctf_fit)
         ## add this entry to the dataset 
-        ctf_dataset.add_entry(micrograph_name, dZ, ctf_fit)
-        write_logfile(logfile, ctf_dataset)
+        ctf_dataset.log_entry(micrograph_name, dZ, ctf_fit)
         return dZ, ctf_fit, micrograph_name
     
     except KeyboardInterrupt:
@@ -896,104 +1664,6 @@ def parse_ctffind_datafile(fname):
 
     return dZ_avg, ctf_fit
 
-def write_logfile(logfile, ctf_dataset):
-    ## overwrite any existing logfile by making a fresh file with headers 
-    # with open(logfile, 'w') as f:
-    #     f.write("mic_name  dZ  ctf_fit \n")
-    
-    # ## write the new entry to the logfile 
-    # with open(logfile, 'a') as f:
-    #     if len(ctf_dataset.data) > 0:
-    #         for mic in ctf_dataset.data:
-    #             dZ = ctf_dataset.get_dZ(mic)
-    #             ctf_fit = ctf_dataset.get_ctf_fit(mic)
-    #             f.write("%s  %s  %s  \n" % (mic, dZ, ctf_fit))
-
-    ## create an empty file with the target name (erase previous file if present)
-    f = open(logfile, 'w+')
-    f.write("\n")
-    f.write("data_micrographs\n")
-    f.write("\n")
-    f.write("loop_\n")
-    f.write("_MicrographName #1\n")
-    f.write("_dZ #2\n")
-    f.write("_CtfFit #3\n")
-    f.close()
-
-    ## write the entries to the logfile 
-    with open(logfile, 'a') as f:
-        if len(ctf_dataset.data) > 0:
-            for mic in ctf_dataset.data:
-                dZ = ctf_dataset.get_dZ(mic)
-                ctf_fit = ctf_dataset.get_ctf_fit(mic)
-                f.write("%s\t%s\t%s\n" % (mic, dZ, ctf_fit))
-
-
-    # print(" Written logfile: %s" % logfile )
-    return 
-
-def processing_pipeline(movie, i, PARAMS):
-    step_string = "  Processing movie #%s :: " % (i + 1)
-    print(step_string, end = "")
-    print("\r", end="")
-
-    ## 1. Check if we want to save the full movie
-    if PARAMS.save_movies:
-        print(" " * len(step_string), end = "")
-        print("\r", end="")
-        step_string = "  Processing movie #%s :: saving movie" % (i + 1)
-        print(step_string, end = "")
-        print("\r", end="")
-        save_movie(movie, PARAMS.movie_save_string(movie), DRY_RUN = DRY_RUN)
-
-    ## 2. Motion correct the movie to a single .MRC
-    print(" " * len(step_string), end = "")
-    print("\r", end="")
-    step_string = "  Processing movie #%s :: running motion correction" % (i + 1)
-    print(step_string, end = "")
-    print("\r", end="")
-    run_motioncor2(movie, PARAMS.mrc_save_string(movie), pixel_size = PARAMS.angpix, kV = PARAMS.kV, frame_dose = PARAMS.frame_dose, gpu_id = PARAMS.gpu_id, DRY_RUN = DRY_RUN)
-
-    ## 3. Write out a compressed .JPG file for analysis later 
-    print(" " * len(step_string), end = "")
-    print("\r", end="") 
-    step_string = "  Processing movie #%s :: writing jpgs" % (i + 1)
-    print(step_string, end = "")
-    print("\r", end="")
-    write_jpg(PARAMS.mrc_save_string(movie), PARAMS.jpg_save_string(movie), DRY_RUN = DRY_RUN)
-
-    ## 4. If not yet, write out a GridSquare image for the corresponding micrograph
-    write_gridsquare_jpg(movie, PARAMS.jpg_dir)
-
-    ## 5. If atlas directory was provided, write out the main atlas of the grid
-    if PARAMS.atlas_dir != False:
-        write_atlas_jpg(PARAMS.atlas_dir, PARAMS.jpg_dir)
-
-    ## 6. If atlas directory was provided, write out the marked location of the GridSquare on the atlas 
-    if PARAMS.atlas_dir != False:
-        markup_gridsquare_on_atlas_jpg(movie, PARAMS.atlas_dir, PARAMS.jpg_dir, DRY_RUN = DRY_RUN)
-
-    ## 7. Calculate CTF estimate of micrograph
-    print(" " * len(step_string), end = "")
-    print("\r", end="")
-    step_string = "  Processing movie #%s :: running CTFFIND4" % (i + 1)
-    print(step_string, end = "")
-    print("\r", end="")
-    dZ, ctf_fit, micrograph_name = run_ctffind(PARAMS.mrc_save_string(movie), PARAMS.ctf_dir, PARAMS.angpix, PARAMS.kV, PARAMS.logfile, CTF_DATA)
-
-    print(" " * len(step_string), end = "")
-    print("\r", end="")
-    if micrograph_name == None:
-        step_string = ""
-        pass
-    else:
-        step_string = "  Processing movie #%s :: running CTFFIND4 (dZ = %s, ctf_fit = %s)" % ((i + 1), dZ, ctf_fit)
-        print(step_string, end = "")
-        print("\r", end="")
-        print()
-    
-
-
 #region STAR handler functions
 def get_table_position(file, table_title, DEBUG = True):
     """ Find the line numbers for key elements in a relion .STAR table.
@@ -1142,10 +1812,22 @@ def remove_path(file_w_path):
 #############################
 
 if __name__ == "__main__":
-    import os, sys, time, glob, shutil
+    import os, sys, time, glob, shutil, threading, queue, json, struct, fnmatch
+    import ctypes, ctypes.util, sqlite3
     from subprocess import Popen, PIPE, DEVNULL
     import numpy as np
     import mrcfile 
+    import xml.etree.ElementTree as ET
+
+    ## Get the execution path of this script so we can find local modules
+    script_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    try:
+        sys.path.append(script_path)
+        import ctf_logfile
+        import mrc_render
+        import fast_copy
+    except :
+        print(" ERROR :: Check if ctf_logfile.py, mrc_render.py and fast_copy.py scripts are in same folder as this script and run without error (i.e. can be compiled)!")
 
     print(h_bar)
     print("    EPU ON-THE-FLY PROCESSING")
@@ -1155,20 +1837,38 @@ if __name__ == "__main__":
     PARAMS.prepare_directories()
     CTF_DATA = DATASET()
 
-    ## discover all movies in the EPU session 
-    movies_discovered = get_all_movies(PARAMS.epu_dir, PARAMS.movie_glob)
+    ## discover all movies in the EPU session, later loops only return movies that were not yet seen 
+    DISCOVERY = MOVIE_DISCOVERY(PARAMS.epu_dir, PARAMS.movie_glob)
+    movies_discovered = DISCOVERY.discover()
+    print_movies(movies_discovered)
 
-    ## parse any existing log file in the working directory 
+    ## parse any existing log file in the working directory, then continue it with new entries 
     CTF_DATA.parse_logfile(PARAMS.logfile)
+    CTF_DATA.open_logfile(PARAMS.logfile)
+
+    ## load the processing state of all movies seen in previous runs 
+    STATE = STATE_DB()
+    if DEBUG:
+        print(STATE)
+
+    ## start the worker threads of each processing stage 
+    pipeline = PIPELINE(PARAMS, CTF_DATA, STATE)
+    pipeline.start()
 
-    ## for each movie, determine the desired outputs 
+    ## for each movie, queue it to produce the desired outputs 
     print(h_bar)
-    print("  Processing :: ", end = "")
-    print("\r", end="")
+    print("  Processing :: ")
     # print(h_sub_bar)
     for i in range(len(movies_discovered)):
         movie = movies_discovered[i]
-        processing_pipeline(movie, i, PARAMS)
+        try:
+            pipeline.submit(movie)
+        except KeyboardInterrupt:
+            print(" Terminating ...")
+            pipeline.stop()
+            STATE.close()
+            CTF_DATA.close_logfile()
+            sys.exit()
         # step_string = "  Processing movie #%s :: " % (i + 1)
         # print(step_string, end = "")
         # print("\r", end="")
@@ -1285,12 +1985,14 @@ if __name__ == "__main__":
             copy_misc_files(PARAMS.epu_dir, PARAMS.misc_dir)
 
             ## discover all movies in the EPU session 
-            movies_discovered = get_all_movies(PARAMS.epu_dir, PARAMS.movie_glob, VERBOSE = False)
-            delta = len(movies_discovered) - CTF_DATA.size()
-            print("  %s movies processed, %s in queue" % (CTF_DATA.size(), delta))
-            for i in range(len(movies_discovered)):
-                movie = movies_discovered[i]
-                processing_pipeline(movie, i, PARAMS)
+            movies_discovered = DISCOVERY.discover()
+            for movie in movies_discovered:
+                pipeline.submit(movie)
+            ## movies still being written when discovered are submitted once they are complete 
+            pipeline.submit_waiting()
+            ## give movies with a failed step another attempt 
+            pipeline.retry_failed()
+            print("  %s" % pipeline.status())
 
             ## Add a live timer to display to the user the sleeping state is actively running 
             for i in range(PARAMS.seconds_delay,0,-1):
@@ -1299,7 +2001,9 @@ if __name__ == "__main__":
 
         except KeyboardInterrupt:
             print(" Terminating ...")
-
+            pipeline.stop()
+            STATE.close()
+            CTF_DATA.close_logfile()
             sys.exit()
 
 #endregion
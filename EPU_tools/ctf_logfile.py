@@ -0,0 +1,189 @@
+"""
+	A module to write and follow the CTF logfile (ctf.star) of EPU_on-the-fly.py while it is being written, i.e.:
+		data_micrographs
+		loop_
+		_MicrographName #1
+		_dZ #2
+		_CtfFit #3
+		GridSquare_###_FoilHole_###_Data_###_Fractions.mrc	1.23	4.56
+		...
+	The writer only appends one row per micrograph and periodically compacts the file by writing a fresh copy and renaming
+	it over the old one, so a reader never sees a half-written file:
+		import ctf_logfile
+		logfile = ctf_logfile.LOGFILE_WRITER('ctf.star')
+		logfile.append('mic_001.mrc', 1.23, 4.56)
+	The follower keeps its position in the file, so polling it only reads the rows added since the last poll:
+		tail = ctf_logfile.LOGFILE_TAIL('ctf.star')
+		new_rows = tail.poll() ## [ (mic_name, dZ, ctf_fit), ... ]
+		tail.data ## { mic_name : (dZ, ctf_fit), ... } for all micrographs read so far
+"""
+import os, time
+
+COLUMNS = ['_MicrographName', '_dZ', '_CtfFit']
+
+def get_header(table_title = 'data_micrographs'):
+    header = "\n%s\n\nloop_\n" % table_title
+    for i in range(len(COLUMNS)):
+        header += "%s #%s\n" % (COLUMNS[i], i + 1)
+    return header
+
+def format_row(mic_name, dZ, ctf_fit):
+    return "%s\t%s\t%s\n" % (mic_name, dZ, ctf_fit)
+
+class LOGFILE_WRITER():
+    """
+    Append-only writer of the CTF logfile. Each row is flushed as it is added so followers see it straight away, while the
+    (slower) fsync calls that make rows durable are batched. A micrograph that is written again adds a duplicate row, which
+    followers resolve by keeping the latest values; once enough duplicates accumulate the file is compacted.
+    ---------------------------------------------------------------
+    PARAMETERS
+    ---------------------------------------------------------------
+        fname = str(); path of the logfile \n
+        data = dict(); optional { mic_name : [dZ, ctf_fit] } of entries already known (e.g. parsed from an earlier logfile),
+               the logfile is rewritten from these entries when opened so it always starts from a clean, complete file \n
+        fsync_rows = int(); fsync after this many rows have been appended ... \n
+        fsync_seconds = float(); ... or after this much time has passed since the last fsync, whichever comes first \n
+    """
+    def __init__(self, fname, data = None, fsync_rows = 25, fsync_seconds = 10.0):
+        self.fname = fname
+        self.fsync_rows = fsync_rows
+        self.fsync_seconds = fsync_seconds
+        ## latest row written for each micrograph, in the order they were first written
+        self.rows = dict()
+        if data != None:
+            for mic_name in data:
+                self.rows[mic_name] = format_row(mic_name, data[mic_name][0], data[mic_name][1])
+        self.duplicates = 0
+        self.unsynced_rows = 0
+        self.last_sync = time.time()
+        self.f = None
+        self.compact()
+        return
+
+    def append(self, mic_name, dZ, ctf_fit):
+        row = format_row(mic_name, dZ, ctf_fit)
+        if mic_name in self.rows:
+            self.duplicates += 1
+        self.rows[mic_name] = row
+
+        ## rewrite the file once duplicates make up a sizeable part of it
+        if self.duplicates > max(100, len(self.rows) // 10):
+            self.compact()
+            return
+
+        self.f.write(row)
+        self.f.flush()
+        self.unsynced_rows += 1
+        if self.unsynced_rows >= self.fsync_rows or time.time() - self.last_sync > self.fsync_seconds:
+            self.sync()
+        return
+
+    def sync(self):
+        if self.unsynced_rows > 0:
+            os.fsync(self.f.fileno())
+        self.unsynced_rows = 0
+        self.last_sync = time.time()
+        return
+
+    def compact(self):
+        """ Write all current rows (without duplicates) to a temporary file and atomically rename it over the logfile
+        """
+        temp_file = self.fname + ".tmp"
+        with open(temp_file, 'w') as f:
+            f.write(get_header())
+            for row in self.rows.values():
+                f.write(row)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.fname)
+
+        ## continue appending to the new file
+        if self.f != None:
+            self.f.close()
+        self.f = open(self.fname, 'a')
+        self.duplicates = 0
+        self.unsynced_rows = 0
+        self.last_sync = time.time()
+        return
+
+    def close(self):
+        self.sync()
+        self.f.close()
+        return
+
+class LOGFILE_TAIL():
+    """
+    Follow a CTF logfile as it is written. Only complete lines are read, and the file is read again from the start if it
+    was replaced (e.g. by a compaction) or truncated since the last poll.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.reset()
+        return
+
+    def reset(self):
+        self.inode = None
+        self.offset = 0
+        self.column_names = []
+        self.data = dict()
+        return
+
+    def poll(self):
+        """ Read the rows added to the logfile since the last poll, returns a list of the form: [ (mic_name, dZ, ctf_fit), ... ]
+            If the file was replaced, all of its rows are returned again (i.e. any new rows mean the caller should refresh)
+        """
+        try:
+            f = open(self.fname, 'rb')
+        except FileNotFoundError:
+            return []
+
+        with f:
+            ## check the file we opened, not the path, since the path may be renamed over while we read
+            stats = os.fstat(f.fileno())
+            if stats.st_ino != self.inode or stats.st_size < self.offset:
+                self.reset()
+                self.inode = stats.st_ino
+            if stats.st_size == self.offset:
+                return []
+            f.seek(self.offset)
+            chunk = f.read(stats.st_size - self.offset)
+
+        ## leave any incomplete final line for the next poll
+        end = chunk.rfind(b'\n') + 1
+        self.offset += end
+        new_rows = []
+        for line in chunk[:end].decode().splitlines():
+            row = self.parse_line(line)
+            if row != None:
+                self.data[row[0]] = (row[1], row[2])
+                new_rows.append(row)
+        return new_rows
+
+    def parse_line(self, line):
+        fields = line.split()
+        if len(fields) == 0:
+            return None
+        if fields[0] == 'loop_':
+            self.column_names = []
+            return None
+        if fields[0].startswith('_'):
+            self.column_names.append(fields[0])
+            return None
+        if fields[0].startswith('data_') or len(self.column_names) == 0:
+            return None
+
+        try:
+            mic_name = fields[self.column_names.index('_MicrographName')]
+            dZ = float(fields[self.column_names.index('_dZ')])
+            ctf_fit = float(fields[self.column_names.index('_CtfFit')])
+        except (ValueError, IndexError):
+            return None
+        return (mic_name, dZ, ctf_fit)
+
+    def get_columns(self):
+        """ Return the data read so far as columns, i.e.: mic_names, dZs, ctf_fits
+        """
+        mic_names = list(self.data.keys())
+        dZs = [self.data[mic_name][0] for mic_name in mic_names]
+        ctf_fits = [self.data[mic_name][1] for mic_name in mic_names]
+        return mic_names, dZs, ctf_fits
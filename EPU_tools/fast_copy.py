@@ -0,0 +1,250 @@
+"""
+    Copy large files (e.g. movies) inside the kernel, without passing the data through user-space buffers, e.g.:
+        import fast_copy
+        fast_copy.copy2('/path/to/movie_EER.eer', '/target/dir/')
+    Equivalent to shutil.copy2 (the destination may be a directory, and the modification time is preserved), but:
+        - the destination file is preallocated (posix_fallocate) so it is written into contiguous space
+        - the data is copied in large chunks with os.copy_file_range, then os.sendfile, then plain reads/writes, falling
+          back to the next method if the filesystems involved do not support one
+        - on the first large file copied between two filesystems, each method copies a part of the file and the fastest
+          is used for all later copies between them
+        - the file is written under a temporary (hidden) name and renamed once complete, so the destination never holds
+          a partial file under its final name
+    Files that may still be written (e.g. movies EPU is acquiring) can be checked before copying them:
+        stability = fast_copy.STABILITY_TRACKER(quiet_period = 30)
+        if stability.is_complete(movie, companion = fast_copy.get_companion_xml(movie)):
+            fast_copy.copy2(movie, '/target/dir/')
+"""
+import os, shutil, threading, time
+
+## methods in order of preference, with the size of each chunk they copy
+METHODS = ['copy_file_range', 'sendfile', 'read_write']
+CHUNK_SIZES = {'copy_file_range' : 64 * 1024 * 1024, 'sendfile' : 64 * 1024 * 1024, 'read_write' : 8 * 1024 * 1024}
+## size of the part of the file copied by each method when benchmarking
+BENCHMARK_SIZE = 64 * 1024 * 1024
+
+## { (source device, destination device) : [ methods to use, fastest first ] }
+METHODS_BY_DEVICE = dict()
+## device pairs currently being benchmarked
+BENCHMARKS_RUNNING = set()
+LOCK = threading.Lock()
+
+def copy2(source_file, dest, VERBOSE = False):
+    """ Copy a file (and its permissions & modification time) to a destination file or directory
+    RETURNS
+        dest_file = str(); path of the copied file
+    """
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(source_file))
+    temp_file = get_temp_name(dest)
+    try:
+        copyfile(source_file, temp_file, VERBOSE = VERBOSE)
+        shutil.copystat(source_file, temp_file)
+        os.replace(temp_file, dest)
+    except BaseException:
+        ## clean up the partial file (also when interrupted)
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+        raise
+    return dest
+
+def get_temp_name(dest_file):
+    """ Name a file is written under until it is complete, i.e. /path/to/file -> /path/to/.file.partial
+    """
+    dest_dir, dest_name = os.path.split(dest_file)
+    return os.path.join(dest_dir, "." + dest_name + ".partial")
+
+def copyfile(source_file, dest_file, VERBOSE = False):
+    """ Copy the contents of a file, returns the method that finished the copy
+    """
+    with open(source_file, 'rb') as f_in, open(dest_file, 'wb') as f_out:
+        fd_in = f_in.fileno()
+        fd_out = f_out.fileno()
+        size = os.fstat(fd_in).st_size
+        preallocate(fd_out, size)
+
+        device_pair = (os.fstat(fd_in).st_dev, os.fstat(fd_out).st_dev)
+        offset = 0
+        with LOCK:
+            methods = METHODS_BY_DEVICE.get(device_pair)
+            BENCHMARK = methods == None and size >= len(METHODS) * BENCHMARK_SIZE and device_pair not in BENCHMARKS_RUNNING
+            if BENCHMARK:
+                BENCHMARKS_RUNNING.add(device_pair)
+        if BENCHMARK:
+            offset, methods = benchmark(fd_in, fd_out, device_pair, VERBOSE = VERBOSE)
+        elif methods == None:
+            methods = METHODS
+
+        method, offset = copy_range(fd_in, fd_out, offset, size, methods, device_pair)
+        ## drop any preallocated space left over if the source shrank while it was copied
+        if os.fstat(fd_out).st_size != offset:
+            os.ftruncate(fd_out, offset)
+    return method
+
+def preallocate(fd, size):
+    """ Reserve the space of the file on disk, not all filesystems support this, in which case the file is written as usual
+    """
+    if size == 0 or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        pass
+    return
+
+def copy_range(fd_in, fd_out, offset, end, methods, device_pair = None):
+    """ Copy the bytes between offset and end, starting with the first method in the list and falling back on the next
+        methods (and finally plain reads/writes) if it is not supported
+    RETURNS
+        method = str(); the method that finished the copy
+        offset = int(); the end of the copied data (before end if the source shrank)
+    """
+    for method in methods:
+        try:
+            return method, copy_chunks(fd_in, fd_out, offset, end, method)
+        except ChunkError as e:
+            ## continue where the method stopped, and skip it for later copies between these filesystems
+            offset = e.offset
+            if device_pair != None:
+                with LOCK:
+                    METHODS_BY_DEVICE[device_pair] = [m for m in METHODS_BY_DEVICE.get(device_pair, METHODS) if m != method]
+    return 'read_write', copy_chunks(fd_in, fd_out, offset, end, 'read_write')
+
+def copy_chunks(fd_in, fd_out, offset, end, method):
+    """ Copy the bytes between offset and end with one method, raises a ChunkError if the method is not supported
+    RETURNS
+        offset = int(); the end of the copied data
+    """
+    chunk_size = CHUNK_SIZES[method]
+    while offset < end:
+        count = min(chunk_size, end - offset)
+        if method == 'read_write':
+            data = os.pread(fd_in, count, offset)
+            copied = len(data)
+            view = memoryview(data)
+            written = 0
+            while written < copied:
+                written += os.pwrite(fd_out, view[written:], offset + written)
+        else:
+            try:
+                if method == 'copy_file_range':
+                    copied = os.copy_file_range(fd_in, fd_out, count, offset_src = offset, offset_dst = offset)
+                else:
+                    os.lseek(fd_out, offset, os.SEEK_SET)
+                    copied = os.sendfile(fd_out, fd_in, offset, count)
+            except (OSError, AttributeError) as e:
+                ## the method is missing on this platform, or not supported by the filesystems involved
+                raise ChunkError(offset) from e
+
+        if copied == 0:
+            ## either the source shrank while copying, or the method silently copies nothing on this filesystem
+            if method != 'read_write' and offset < os.fstat(fd_in).st_size:
+                raise ChunkError(offset)
+            break
+        offset += copied
+    return offset
+
+class ChunkError(OSError):
+    """ A method could not copy the chunk starting at offset
+    """
+    def __init__(self, offset):
+        super().__init__("could not copy chunk at offset %s" % offset)
+        self.offset = offset
+
+def benchmark(fd_in, fd_out, device_pair, VERBOSE = False):
+    """ Copy the first part of the file with each method in turn (each on a different part of the file, so none of them
+        reads data already cached by the previous one) and remember the fastest methods for this pair of filesystems.
+        RETURNS
+            offset = int(); the bytes copied so far
+            methods = list(); methods ordered fastest first
+    """
+    speeds = dict()
+    offset = 0
+    try:
+        for method in METHODS:
+            start_time = time.time()
+            try:
+                offset = copy_chunks(fd_in, fd_out, offset, offset + BENCHMARK_SIZE, method)
+            except ChunkError as e:
+                ## unsupported here, the rest of this part is copied by the next method
+                offset = e.offset
+                continue
+            speeds[method] = BENCHMARK_SIZE / max(time.time() - start_time, 1e-6)
+    finally:
+        methods = sorted(speeds, key = lambda method: speeds[method], reverse = True)
+        with LOCK:
+            METHODS_BY_DEVICE[device_pair] = methods
+            BENCHMARKS_RUNNING.discard(device_pair)
+
+    if VERBOSE:
+        print(" fast_copy benchmark :: " + ", ".join(["%s = %.0f MB/s" % (method, speeds[method] / (1024 * 1024)) for method in methods]))
+    return offset, methods
+
+class STABILITY_TRACKER():
+    """
+    Decide if a file is complete, i.e. no longer being written (e.g. a movie EPU is still acquiring). A file is complete once
+    it was not modified for the quiet period (judged by its modification time, so files written before the script started
+    are complete straight away), once its size & modification time stayed the same for the quiet period while being
+    watched, or as soon as its companion file (e.g. the .XML EPU writes once an acquisition is done) exists.
+    ---------------------------------------------------------------
+    PARAMETERS
+    ---------------------------------------------------------------
+        quiet_period = float(); seconds a file must go without changes before it is complete \n
+    """
+    def __init__(self, quiet_period = 30):
+        self.quiet_period = quiet_period
+        ## { fname : (size, mtime_ns, time first seen with this size & mtime) } of recently modified files
+        self.observed = dict()
+        self.lock = threading.Lock()
+        return
+
+    def is_complete(self, fname, size = None, mtime_ns = None, companion = None):
+        """ Check if a file is complete, its size & mtime can be given if they are known already (e.g. from os.scandir)
+        """
+        if size == None or mtime_ns == None:
+            try:
+                stats = os.stat(fname)
+            except FileNotFoundError:
+                self.forget(fname)
+                return False
+            size = stats.st_size
+            mtime_ns = stats.st_mtime_ns
+
+        now = time.time()
+        if now - mtime_ns / 1e9 >= self.quiet_period:
+            self.forget(fname)
+            return True
+        if companion != None and os.path.isfile(companion):
+            return True
+
+        with self.lock:
+            observed = self.observed.get(fname)
+            if observed == None or observed[0] != size or observed[1] != mtime_ns:
+                ## recently modified, new or still changing, restart the quiet period
+                if len(self.observed) > 1000:
+                    self.prune(now)
+                self.observed[fname] = (size, mtime_ns, now)
+                return False
+            return now - observed[2] >= self.quiet_period
+
+    def forget(self, fname):
+        with self.lock:
+            self.observed.pop(fname, None)
+        return
+
+    def prune(self, now):
+        """ Drop files that are complete by age anyway (called with the lock held)
+        """
+        for fname in [fname for fname, observed in self.observed.items() if now - observed[1] / 1e9 >= self.quiet_period]:
+            del self.observed[fname]
+        return
+
+def get_companion_xml(movie):
+    """ EPU writes the metadata .XML of an acquisition next to its movie once the acquisition is done, i.e.:
+            FoilHole_..._Data_..._<date>_<time>_EER.eer (or _Fractions.tiff, _Fractions.mrc) -> FoilHole_..._Data_..._<date>_<time>.xml
+        RETURNS the expected path of the .XML file, or None if the movie is not named by this convention
+    """
+    movie_dir, movie_name = os.path.split(movie)
+    if '_' not in movie_name:
+        return None
+    return os.path.join(movie_dir, movie_name.rsplit('_', 1)[0] + '.xml')
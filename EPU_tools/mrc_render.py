@@ -0,0 +1,81 @@
+"""
+    Render .MRC images (micrographs, GridSquares, atlases) to compressed .JPG files within the calling process, e.g.:
+        import mrc_render
+        mrc_render.mrc2jpg('micrograph.mrc', 'micrograph.jpg', bin = 4)
+    Avoids starting a new interpreter (and importing numpy & mrcfile) for each image, and is safe to call from several
+    threads at once (numpy and PIL release the GIL for the heavy steps)
+"""
+import os
+
+def load_mrc(fname, bin = 1):
+    """ Read a 2D image from an .MRC file through a memory map and bin it, so only the binned image is held in memory.
+        For a stack, the first section is used.
+    ---------------------------------------------------------------
+    RETURNS
+    ---------------------------------------------------------------
+        im_array = np.array(float32); binned image
+    """
+    import mrcfile
+    with mrcfile.mmap(fname, mode = 'r', permissive = True) as mrc:
+        data = mrc.data
+        if data.ndim == 3:
+            data = data[0]
+        ## bin while the file is open, since the memory map is invalid once it is closed
+        im_array = bin_image(data, bin)
+    return im_array
+
+def bin_image(im_array, bin):
+    """ Downsample an image by averaging blocks of bin x bin pixels (edges that do not fill a whole block are cropped)
+    """
+    import numpy as np
+    if bin <= 1:
+        return np.array(im_array, dtype = np.float32)
+    ny = im_array.shape[0] // bin
+    nx = im_array.shape[1] // bin
+    blocks = im_array[:ny * bin, :nx * bin].reshape(ny, bin, nx, bin)
+    return blocks.mean(axis = (1, 3), dtype = np.float32)
+
+def sigma_contrast(im_array, sigma):
+    """ Rescale the image intensity levels to a range defined by a sigma value (the # of
+        standard deviations to keep) and return it as 8-bit grayscale.
+    """
+    import numpy as np
+    stdev = np.std(im_array)
+    mean = np.mean(im_array)
+    minval = mean - (stdev * sigma)
+    maxval = mean + (stdev * sigma)
+    if maxval == minval:
+        ## flat image, avoid dividing by zero
+        return np.zeros(im_array.shape, dtype = np.uint8)
+
+    ## remove pixels above/below the defined limits
+    im_array = np.clip(im_array, minval, maxval)
+    ## rescale the image into the range 0 - 255
+    im_array = (im_array - minval) * (255 / (maxval - minval))
+    return im_array.astype(np.uint8)
+
+def save_jpg(im_array, output_jpg, quality = 90, markers = []):
+    """ Save an 8-bit grayscale image as a .JPG, optionally with red circles drawn around a list of (x, y) pixel positions.
+        The image is saved under a temporary name and renamed into place, so a reader never sees a partial file
+    """
+    from PIL import Image as PIL_Image
+    from PIL import ImageDraw
+    im = PIL_Image.fromarray(im_array)
+    if len(markers) > 0:
+        im = im.convert('RGB')
+        draw = ImageDraw.Draw(im)
+        radius = max(5, min(im_array.shape) // 50)
+        for x, y in markers:
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], outline = (214, 39, 40), width = max(2, radius // 5))
+
+    temp_file = output_jpg + ".tmp"
+    im.save(temp_file, format = 'JPEG', quality = quality)
+    os.replace(temp_file, output_jpg)
+    return
+
+def mrc2jpg(input_mrc, output_jpg, bin = 4, sigma = 3, quality = 90):
+    """ Write a binned, contrast-adjusted .JPG of an .MRC file
+    """
+    im_array = sigma_contrast(load_mrc(input_mrc, bin = bin), sigma)
+    save_jpg(im_array, output_jpg, quality = quality)
+    return
@@ -0,0 +1,247 @@
+"""
+	A module for commonly-needed functions when handling .CS files from cryoSPARC
+	A .cs file is a numpy structured array (recarray), so every header can be read as a whole column at once, e.g.:
+		import numpy as np
+		import cs_handler
+		cs_data = np.load('J###_particles.cs')
+		cs_data['blob/idx'] ## all particle indexes in their .MRC stacks, as one array
+		cs_handler.get_paths(cs_data, 'blob/path') ## all particle .MRC stack paths, as decoded strings
+		cs_handler.get_pixel_coordinates(cs_data) ## all particle coordinates on their micrographs, in pixels
+	Operating on columns rather than looping over each entry keeps parsing of large files (millions of particles) fast
+	For large files, memory-map the .cs file and only load the headers that are needed into memory:
+		cs_data = cs_handler.load_cs('J###_particles.cs', fields = ['blob/path', 'blob/idx'])
+		cs_handler.print_field_sizes('J###_particles.cs') ## show how much memory each header costs
+"""
+import os
+import sys
+## path helpers are shared with star_handler, which lives in the star_file_tools folder of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'star_file_tools'))
+import star_handler
+
+def get_cs_headers(dataset):
+    """ Unpack the recarray headers into a dictionary of the form: { 'header_name' : index/column, ... }
+    """
+    headers = dataset.dtype.names ## 'headers' for each index position can be retrieved from the main array
+    header_dict = {}
+    for i in range(len(headers)):
+        header_dict[headers[i]] = i
+    return header_dict
+
+def load_cs(fname, fields = None, DEBUG = False):
+    """ Open a .cs file as a read-only memory map and load only the requested headers into memory.
+    ---------------------------------------------------------------
+    PARAMETERS
+    ---------------------------------------------------------------
+        fname = str(); path to the .cs file \n
+        fields = list(); headers to load, missing headers are skipped (useful for fallback headers that only exist in 
+                 some files). If None, the memory-mapped dataset is returned and pages are only read from disk on access \n
+    ---------------------------------------------------------------
+    RETURNS
+    ---------------------------------------------------------------
+        dataset = numpy structured array with only the requested headers
+    """
+    import numpy as np
+    try:
+        dataset = np.load(fname, mmap_mode = 'r')
+    except ValueError:
+        ## datasets with object-type headers cannot be memory-mapped, fall back to a full read 
+        if DEBUG: print(" ... could not memory-map %s, loading the full file instead" % fname)
+        dataset = np.load(fname)
+
+    if fields == None:
+        return dataset
+
+    fields = [field for field in dict.fromkeys(fields) if field in dataset.dtype.names]
+    projected = np.empty(len(dataset), dtype = [(field, dataset.dtype[field]) for field in fields])
+    ## copy one header at a time, so only the requested headers are ever held in memory 
+    for field in fields:
+        projected[field] = dataset[field]
+
+    if DEBUG:
+        print(" ... loaded %s of %s headers from %s (%.1f of %.1f MB)" % (len(fields), len(dataset.dtype.names), fname, projected.nbytes / 1024**2, dataset.nbytes / 1024**2))
+    return projected
+
+def get_field_sizes(dataset):
+    """ Return the memory cost of each header in a dataset (or .cs file), as a list of the form:
+            [ ('header_name', bytes per entry, bytes in total), ... ]
+    """
+    import numpy as np
+    if isinstance(dataset, str):
+        dataset = load_cs(dataset)
+    field_sizes = []
+    for field in dataset.dtype.names:
+        itemsize = dataset.dtype[field].itemsize
+        field_sizes.append((field, itemsize, itemsize * len(dataset)))
+    return field_sizes
+
+def print_field_sizes(dataset):
+    """ Print the memory cost of each header in a dataset (or .cs file), from largest to smallest
+    """
+    field_sizes = get_field_sizes(dataset)
+    total_bytes = sum(size[2] for size in field_sizes)
+    print(" ------------------------------------------------------------------")
+    print("  %-40s %10s %12s" % ('header', 'bytes/entry', 'total (MB)'))
+    print(" ------------------------------------------------------------------")
+    for field, itemsize, nbytes in sorted(field_sizes, key = lambda x: x[2], reverse = True):
+        print("  %-40s %10s %12.1f" % (field, itemsize, nbytes / 1024**2))
+    print(" ------------------------------------------------------------------")
+    print("  %-40s %10s %12.1f" % ('total', sum(size[1] for size in field_sizes), total_bytes / 1024**2))
+    return
+
+def has_fields(dataset, fields):
+    """ Check if all the given headers are present in the dataset
+    """
+    for field in fields:
+        if field not in dataset.dtype.names:
+            return False
+    return True
+
+def get_column(dataset, field):
+    """ Return a whole-column view of a header in the dataset, exits with an error message if the header is missing
+    """
+    if field not in dataset.dtype.names:
+        print(" ERROR :: Header '%s' not found in .CS dataset, available headers: " % field)
+        for header in dataset.dtype.names:
+            print("    %s" % header)
+        sys.exit()
+    return dataset[field]
+
+def decode_strings(column):
+    """ Cast a column of byte strings (fixed-width or object-type, depending on the cryoSPARC version) to an array of
+        str, with surrounding whitespace removed
+    """
+    import numpy as np
+    column = np.asarray(column)
+    if column.dtype.kind != 'U':
+        column = np.char.decode(column.astype(bytes), 'utf-8')
+    return np.char.strip(column)
+
+def apply_to_runs(column, func):
+    """ Apply a vectorized function once per run of repeated values in a column and expand the result back to the 
+        full column length. Particles from the same micrograph are typically stored contiguously, so string operations 
+        on path columns only need to be run on a small fraction of the entries 
+    """
+    import numpy as np
+    column = np.asarray(column)
+    if len(column) == 0:
+        return column.astype(str)
+    run_starts = np.flatnonzero(np.concatenate(([True], column[1:] != column[:-1])))
+    run_lengths = np.diff(np.append(run_starts, len(column)))
+    return np.repeat(func(column[run_starts]), run_lengths)
+
+def get_unique_codes(column, func = None):
+    """ Encode a column as its unique values and the integer code of each entry into them (e.g. the source stack of each 
+        particle), so that values[codes] restores the column. Runs of repeated values are collapsed first, so only a few 
+        entries need to be sorted for typical path columns.
+    ---------------------------------------------------------------
+    PARAMETERS
+    ---------------------------------------------------------------
+        column = np.array(); column to encode, e.g. dataset['blob/path'] \n
+        func = function; optional vectorized function applied to the unique values (e.g. clean_paths), values that 
+               become identical after func is applied share a code \n
+    ---------------------------------------------------------------
+    RETURNS
+    ---------------------------------------------------------------
+        values = np.array(); sorted unique values \n
+        codes = np.array(int); index of each entry's value in values
+    """
+    import numpy as np
+    column = np.asarray(column)
+    if len(column) == 0:
+        values = column if func == None else func(column)
+        return values, np.zeros(0, dtype = np.intp)
+    run_starts = np.flatnonzero(np.concatenate(([True], column[1:] != column[:-1])))
+    run_lengths = np.diff(np.append(run_starts, len(column)))
+    values, run_codes = np.unique(column[run_starts], return_inverse = True)
+    if func != None:
+        values, remap = np.unique(func(values), return_inverse = True)
+        run_codes = remap[run_codes]
+    return values, np.repeat(run_codes, run_lengths)
+
+def get_group_index(codes, num_groups = None, sort_keys = None):
+    """ Build an index to visit entries group by group (e.g. particles by micrograph) from the group code of each entry.
+        The order is stable, so entries keep their original order within each group unless sort keys are given.
+    ---------------------------------------------------------------
+    PARAMETERS
+    ---------------------------------------------------------------
+        codes = np.array(int); group code of each entry (e.g. from get_unique_codes) \n
+        num_groups = int(); optional total number of groups, including groups without entries \n
+        sort_keys = list( np.array() ); optional columns to sort entries by within each group, highest priority first \n
+    ---------------------------------------------------------------
+    RETURNS
+    ---------------------------------------------------------------
+        order = np.array(int); entry indexes sorted by group \n
+        offsets = np.array(int); entries of group i are order[offsets[i] : offsets[i + 1]]
+    """
+    import numpy as np
+    codes = np.asarray(codes)
+    if sort_keys != None and len(sort_keys) > 0:
+        ## np.lexsort uses its last key as the primary sort key
+        order = np.lexsort(tuple(reversed(sort_keys)) + (codes,))
+    else:
+        order = np.argsort(codes, kind = 'stable')
+    counts = np.bincount(codes, minlength = 0 if num_groups == None else num_groups)
+    offsets = np.zeros(len(counts) + 1, dtype = np.int64)
+    np.cumsum(counts, out = offsets[1:])
+    return order, offsets
+
+def get_paths(dataset, field = 'blob/path'):
+    """ Return the decoded paths of a path-type header (e.g. 'blob/path', 'location/micrograph_path') as an array of str.
+        cryoSPARC likes to add a chevron to indicate the start of the project in some files, it is removed if present
+    """
+    return apply_to_runs(get_column(dataset, field), clean_paths)
+
+def clean_paths(column):
+    """ Decode a column of paths and remove the leading chevron cryoSPARC uses to mark the project root 
+    """
+    import numpy as np
+    paths = decode_strings(column)
+    has_chevron = np.char.startswith(paths, '>')
+    if np.any(has_chevron):
+        paths = np.where(has_chevron, np.char.lstrip(paths, '>'), paths)
+    return paths
+
+def get_basenames(paths, remove_extension = False):
+    """ Vectorized equivalent of os.path.basename (and optionally os.path.splitext) over an array of paths,
+        see: star_handler.get_basenames (which removes the extension by default)
+    """
+    return star_handler.get_basenames(paths, remove_extension = remove_extension)
+
+def get_stack_fnames(paths, extension = '.mrcs'):
+    """ Map each particle stack path to a common stack name across extract jobs by removing the leading UID from the
+        basename and swapping the extension, e.g.: 'J12/extract/012345678_mic_001_particles.mrc' -> 'mic_001_particles.mrcs'
+    """
+    import numpy as np
+    def get_fnames(paths):
+        names = get_basenames(paths, remove_extension = True)
+        parts = np.char.partition(names, '_')
+        ## names without a UID prefix are kept whole
+        has_uid = np.char.str_len(parts[:, 1]) > 0
+        names = np.where(has_uid, parts[:, 2], names)
+        return np.char.add(names, extension)
+    return apply_to_runs(paths, get_fnames)
+
+def get_pixel_coordinates(dataset, recenter = True):
+    """ Convert the fractional particle locations of the dataset into pixel coordinates on their micrograph.
+        If 2D alignment data is present (and recenter = True), the coordinates are recentered using the 2D shifts scaled
+        to the micrograph pixel size (REF: https://tools.cryosparc.com/examples/recenter-particles.html)
+    ---------------------------------------------------------------
+    RETURNS
+    ---------------------------------------------------------------
+        x = np.array(); x-coordinate of each particle, in pixels
+        y = np.array(); y-coordinate of each particle, in pixels
+    """
+    ## micrograph shape is given as (ny, nx)
+    micrograph_shape = get_column(dataset, 'location/micrograph_shape')
+    x = get_column(dataset, 'location/center_x_frac') * micrograph_shape[:, 1]
+    y = get_column(dataset, 'location/center_y_frac') * micrograph_shape[:, 0]
+
+    if recenter and has_fields(dataset, ['alignments2D/shift', 'alignments2D/psize_A', 'blob/psize_A']):
+        ## transform the pixel shifts from the 2D classification scale to the micrograph scale
+        class2D_shift = dataset['alignments2D/shift']
+        class2D_pixel_size = dataset['alignments2D/psize_A']
+        micrograph_pixel_size = dataset['blob/psize_A']
+        x = x - class2D_shift[:, 0] * class2D_pixel_size / micrograph_pixel_size
+        y = y - class2D_shift[:, 1] * class2D_pixel_size / micrograph_pixel_size
+
+    return x, y
@@ -14,6 +14,17 @@
 #############################
 DEBUG = True
 DRY_RUN = False
+WORKER_ARGS = None ## per-process copy of the dataset for parallel workers (see: init_worker)
+MANIFEST_FNAME = 'export_manifest.jsonl' ## record of each completed .MRCS stack, kept in the output folder (see: --resume)
+VERIFY = False ## when resuming, also compare the CRC32 checksum of each completed stack against the manifest (see: --verify)
+## optional processing of the particles during export (see: --norm, --float16)
+NORMALIZE = False
+BG_RADIUS = None ## background radius in pixels, defaults to 0.37 * box size
+SUBTRACT_RAMP = True
+OUTPUT_MODE = 2 ## MRC mode of the output stacks, 2 = float32, 12 = float16
+## optionally write all particles into one preallocated .MRCS (or a few shards of at most SHARD_SIZE GB) instead of one per micrograph
+SINGLE_STACK = False
+SHARD_SIZE = 0 ## GB, 0 = no limit (i.e. a single stack)
 
 ## Pair each header list from one program to another such that their indexes correspond with the equivalent expected entry 
 RELION_OPTICS_HEADERS = [
@@ -85,6 +96,20 @@ RELION_PARTICLE_HEADERS = (
 #     # "_rlnOriginY",
 # ]
 
+## all headers read from the .cs file (besides the optics headers), any other headers are never loaded into memory 
+CS_PARTICLE_FIELDS = [
+    "blob/path",
+    "blob/idx",
+    "ctf/df1_A",
+    "ctf/df2_A",
+    "ctf/df_angle_rad",
+    "ctf/accel_kv",
+    "ctf/cs_mm",
+    "ctf/amp_contrast",
+    "ctf/phase_shift_rad",
+    "alignments3D/shift",
+    "alignments3D/psize_A"
+]
 
 ## prepare an enum-like structure for how we anticipate to store data for each particle
 PARTICLE_DATA_STRUCTURE = (
@@ -130,6 +155,15 @@ def usage():
     print("      --o (mrcs_stacks) : Set target directory name to save particle stacks into")
     print("                --j (4) : Allow multiprocessing using indicated number of cores")
     print("              --dry-run : Read the .cs file and give a report on what the script will do")
+    print("               --resume : Keep the stacks completed by a previous run and only write missing/partial stacks")
+    print("               --verify : With --resume, also reread each completed stack and rewrite it if its checksum")
+    print("                          does not match the one recorded when it was written (slower)")
+    print("                 --norm : Normalize the particles as done by relion_preprocess --norm during export")
+    print("  --bg_radius (0.37*box) : Radius (px) outside which pixels are used as background for normalization")
+    print("              --no_ramp : Only subtract the background mean when normalizing, instead of a fitted ramp")
+    print("              --float16 : Write the particle stacks in half precision (MRC mode 12)")
+    print("   --single-stack (0) : Write all particles into one .MRCS file instead of one per micrograph, or into")
+    print("                        shards of at most the given size (GB) if a size is given")
     print("===================================================================================================")
     sys.exit()
 
@@ -144,20 +178,10 @@ def sanity_check_inputs(cs_dataset, cs_project_dir):
         cs_project_dir = cs_project_dir + '/'
 
     #### check if we can locate the .MRC file for the first particle 
-    ## first open the dataset & get the path 
-    cs_headers = get_cs_headers(cs_dataset) 
-    for i in range(1):
-        particle_cs_data = cs_dataset[i]
-        try:
-            particle_path = particle_cs_data[cs_headers['blob/path']].decode('utf-8').strip()
-            ## CS likes to add a chevron to indicate the start of the project in some files, remove it incase it is present!
-            if particle_path[0] == '>':
-                particle_path = particle_path[1:]
-            mrc_path = cs_project_dir + particle_path
-
-        except:
-            print(" ERROR :: Input .CS file lacks a 'blob/path' field pointing to the extracted particle stack! Try using an exported stack of particles via the output tab in cryoSPARC")
-            sys.exit()
+    if not cs_handler.has_fields(cs_dataset, ['blob/path']) or len(cs_dataset) == 0:
+        print(" ERROR :: Input .CS file lacks a 'blob/path' field pointing to the extracted particle stack! Try using an exported stack of particles via the output tab in cryoSPARC")
+        sys.exit()
+    mrc_path = cs_project_dir + cs_handler.get_paths(cs_dataset[:1], 'blob/path')[0]
         
     ## use the path to check file exists 
     if not os.path.isfile(mrc_path):
@@ -167,130 +191,101 @@ def sanity_check_inputs(cs_dataset, cs_project_dir):
     
     return cs_project_dir
 
-def get_cs_headers(dataset):
-    """
-        Unpack the rec array headers keeping into account the header strings and their corresponding indexes 
-    """
-    ## Unpack the header data into a dictionary we can refer to later ( 'header_name' : index/column )  
-    headers = dataset.dtype.names ## 'headers' for each index position can be retrieved from the main array
-    header_dict = {} 
-    for i in range(len(headers)):
-        header_dict[headers[i]] = i
-    return header_dict
-
 def parse_cs_dataset(cs_particles):
+    """ Read the cs dataset into a compact structure of per-particle columns, sorted such that the particles of each output 
+        .MRCS stack are a contiguous range of rows:
+            particle_data = { 
+                'stack_fnames' : np.array(str); name of each output .MRCS stack,
+                'stack_offsets' : np.array(int); particles of stack i are rows stack_offsets[i] : stack_offsets[i+1] of each column,
+                'source_paths' : np.array(str); CS project path of each input .MRC stack, indexed by the 'cs_mrc_path' column,
+                'columns' : { 'cs_mrc_path' : np.array(int), 'cs_mrc_index' : np.array(int), 'dZ_U' : np.array(float), ... },
+                'shards' : None, or the layout of the stacks in merged .MRCS files (see: assign_shards) 
+            }
+    """
     ## 1. Unpack the header data into a dictionary we can refer to later   
-    cs_headers = get_cs_headers(cs_particles) ## dict ( 'header_name' : index/column, ... )
+    cs_headers = cs_handler.get_cs_headers(cs_particles) ## dict ( 'header_name' : index/column, ... )
     # print(" CS recarray headers = ", cs_headers)
 
-    ## 2. Iterate over each particle in the cs dataset and cast it into an easy format to manipulate later  
-    ## We will use a dictionary structure to match all particles from a common micrograph with their metadata, we can then use that structure to write out many small .MRCS files with the correct metadata in the .STAR file 
-    particle_data = {}  
-    particle_count = 0
-    for i in range(len(cs_particles)):
-        ## pull out the specific particle info
-        particle_cs_data = cs_particles[i]
-        particle_count += 1
-        
-        ## find the corresponding .MRC file for that particle 
-        mrc_path = particle_cs_data[cs_headers['blob/path']].decode('utf-8').strip()
-        ## CS likes to add a chevron to indicate the start of the project in some files, remove it incase it is present!
-        if mrc_path[0] == '>':
-            mrc_path = mrc_path[1:]
-
-        ## since multiple extract jobs can exist, use the base name of the .mrc file as the dictionary, removing the UID
-        # mrc_fname = os.path.splitext(os.path.basename(mrc_path))[0].split('_', 1)[1] + '.mrcs'
-        mrc_fname = os.path.basename(mrc_path).split('_', 1)[1]
-        mrc_fname = os.path.splitext(mrc_fname)[0] + '.mrcs'
-
-        ## Use the first particle to set the optics table data 
-        if i == 0:
-            print(" ... preparing optics table info from first particle entry")
-            optics_data = populate_relion_optics_table(particle_cs_data, cs_headers)
-            particle_data.setdefault(mrc_fname,[]).append(get_particle_data(particle_cs_data, cs_headers, DEBUG = DEBUG))
-        else:
-            ## For every particle, retrieve the necessary data and cast it into a familiar format for downstream use 
-            particle_data.setdefault(mrc_fname,[]).append(get_particle_data(particle_cs_data, cs_headers))
-    
-    print(" ... read %s micrographs from file (%s particles)" % (len(particle_data), particle_count))
+    ## Use the first particle to set the optics table data 
+    print(" ... preparing optics table info from first particle entry")
+    optics_data = populate_relion_optics_table(cs_particles[0], cs_headers)
+
+    ## 2. Encode the input .MRC stack of each particle as an integer and map each input stack to its output .MRCS stack 
+    source_paths, source_codes = cs_handler.get_unique_codes(cs_handler.get_column(cs_particles, 'blob/path'), cs_handler.clean_paths)
+    ## since multiple extract jobs can exist, use the base name of the .mrc file to name the output stack, removing the UID
+    stack_fnames, source_stack_codes = np.unique(cs_handler.get_stack_fnames(source_paths), return_inverse = True)
+
+    ## 3. Sort the particles by output stack, so each stack is a contiguous slice of every column. Within a stack, sort by 
+    ## input stack and frame so each input stack is read once, front to back (see: write_mrcs_files)
+    particle_order, stack_offsets = cs_handler.get_group_index(source_stack_codes[source_codes], len(stack_fnames), 
+                                        sort_keys = [source_codes, cs_handler.get_column(cs_particles, 'blob/idx')])
+    columns = get_particle_data(cs_particles, particle_order)
+    columns['cs_mrc_path'] = source_codes[particle_order]
+
+    particle_data = {
+        'stack_fnames' : stack_fnames,
+        'stack_offsets' : stack_offsets,
+        'source_paths' : source_paths,
+        'columns' : columns,
+        'shards' : None
+    }
     
-    ## make the particle lists in the dictionary immutable
-    for m in particle_data:
-        particle_data[m] = tuple(particle_data[m])
+    print(" ... read %s micrographs from file (%s particles)" % (len(stack_fnames), len(cs_particles)))
     
     if DEBUG:
         print("==================================")
         print(" Example particle data extracted:")
         print("----------------------------------")
-        random_micrograph = choice(list(particle_data.keys())) 
-        print("  >> %s (%s particles)" % (random_micrograph, len(particle_data[random_micrograph])))
-        random_particles = []
-        if len(particle_data[random_micrograph]) < 3:
-            for _ in range(len(particle_data[random_micrograph]) - 1):
-                random_particles.append(_)
-                print("    ... particle #%s data: " % _, particle_data[random_micrograph][random_particles[-1]])
-        else:
-            for _ in range(3):
-                random_particle_number = randint(0, len(particle_data[random_micrograph]) - 1)
-                while random_particle_number in random_particles:
-                    random_particle_number = randint(0, len(particle_data[random_micrograph]) - 1)
-                random_particles.append(random_particle_number)
-                print("    ... particle #%s data: " % random_particle_number, particle_data[random_micrograph][random_particles[-1]])
+        random_micrograph = randint(0, len(stack_fnames) - 1)
+        stack_start, stack_end = stack_offsets[random_micrograph], stack_offsets[random_micrograph + 1]
+        print("  >> %s (%s particles)" % (stack_fnames[random_micrograph], stack_end - stack_start))
+        for i in sorted(sample(range(stack_start, stack_end), min(3, stack_end - stack_start))):
+            print("    ... particle #%s data: " % (i - stack_start), get_particle(particle_data, i))
         print("    ...")
         print("==================================")
 
     return optics_data, particle_data
 
-def get_particle_data(particle_cs, header_list, DEBUG = False):
-    ## prepare all expected values and their defaults 
-    cs_mrc_path = None # path of the original CS .MRC stack 
-    cs_mrc_index = None # the position of the particle image in the .MRC stack 
-    dZ_U = None 
-    dZ_V = None
-    dZ_angle = None
-    kV = None
-    Cs = None
-    amplitude_contrast = None
-    phase_shift = None
-    originX_trans = None
-    originY_trans = None
-
-    ## assign each variable from the cs input data point 
-    cs_mrc_path = particle_cs[header_list['blob/path']].decode('utf-8').strip()
-    cs_mrc_index = particle_cs[header_list['blob/idx']] 
-    dZ_U = particle_cs[header_list['ctf/df1_A']] 
-    dZ_V = particle_cs[header_list['ctf/df2_A']]
-    dZ_angle = particle_cs[header_list['ctf/df_angle_rad']]
-    kV = particle_cs[header_list['ctf/accel_kv']]
-    Cs = particle_cs[header_list['ctf/cs_mm']]
-    amplitude_contrast = particle_cs[header_list['ctf/amp_contrast']]
-    phase_shift = particle_cs[header_list['ctf/phase_shift_rad']]
+def get_particle_data(cs_particles, particle_order):
+    """ Read the necessary headers of all particles as whole columns in the given order, returned as a dictionary using the
+        keys of the PARTICLE_DATA_STRUCTURE (fields not available from the .CS file are left out)
+    """
+    columns = {}
+
+    ## assign each variable from the cs input columns 
+    columns['cs_mrc_index'] = cs_handler.get_column(cs_particles, 'blob/idx')[particle_order]
+    columns['dZ_U'] = cs_handler.get_column(cs_particles, 'ctf/df1_A')[particle_order]
+    columns['dZ_V'] = cs_handler.get_column(cs_particles, 'ctf/df2_A')[particle_order]
+    columns['dZ_angle'] = cs_handler.get_column(cs_particles, 'ctf/df_angle_rad')[particle_order]
+    columns['kV'] = cs_handler.get_column(cs_particles, 'ctf/accel_kv')[particle_order]
+    columns['Cs'] = cs_handler.get_column(cs_particles, 'ctf/cs_mm')[particle_order]
+    columns['amplitude_contrast'] = cs_handler.get_column(cs_particles, 'ctf/amp_contrast')[particle_order]
+    columns['phase_shift'] = cs_handler.get_column(cs_particles, 'ctf/phase_shift_rad')[particle_order]
     ## cs origin shifts are given in fractional pixels, need to convert them to angstroms by multiplying by angpix
     ## however, in case there is no 3D alignment data (i.e. cs file is from an export job, we need to provide a shift of 0)
-    try:
-        originX_trans = particle_cs[header_list['alignments3D/shift']][0] * particle_cs[header_list['alignments3D/psize_A']]
-        originY_trans = particle_cs[header_list['alignments3D/shift']][1] * particle_cs[header_list['alignments3D/psize_A']]
-    except:
-        originX_trans = 0
-        originY_trans = 0
-
-    ## package the data into a tuple using the global enum
-    particle_data = list(None for _ in range(len(PARTICLE_DATA_STRUCTURE))) # begin by making a mutable list
-    # populate the list by index 
-    particle_data[PARTICLE_DATA_STRUCTURE.index('cs_mrc_path')] = cs_mrc_path
-    particle_data[PARTICLE_DATA_STRUCTURE.index('cs_mrc_index')] = cs_mrc_index
-    particle_data[PARTICLE_DATA_STRUCTURE.index('dZ_U')] = dZ_U
-    particle_data[PARTICLE_DATA_STRUCTURE.index('dZ_V')] = dZ_V
-    particle_data[PARTICLE_DATA_STRUCTURE.index('dZ_angle')] = dZ_angle
-    particle_data[PARTICLE_DATA_STRUCTURE.index('kV')] = kV
-    particle_data[PARTICLE_DATA_STRUCTURE.index('Cs')] = Cs
-    particle_data[PARTICLE_DATA_STRUCTURE.index('amplitude_contrast')] = amplitude_contrast
-    particle_data[PARTICLE_DATA_STRUCTURE.index('phase_shift')] = phase_shift
-    particle_data[PARTICLE_DATA_STRUCTURE.index('origin_shift_x')] = originX_trans
-    particle_data[PARTICLE_DATA_STRUCTURE.index('origin_shift_y')] = originY_trans
-    # re-cast data as a fixed tuple 
-    particle_data = tuple(particle_data)
-    return particle_data
+    if cs_handler.has_fields(cs_particles, ['alignments3D/shift', 'alignments3D/psize_A']):
+        shifts = cs_particles['alignments3D/shift'][particle_order]
+        psize = cs_particles['alignments3D/psize_A'][particle_order]
+        columns['origin_shift_x'] = shifts[:, 0] * psize
+        columns['origin_shift_y'] = shifts[:, 1] * psize
+    else:
+        columns['origin_shift_x'] = np.zeros(len(cs_particles), dtype = int)
+        columns['origin_shift_y'] = np.zeros(len(cs_particles), dtype = int)
+
+    return columns
+
+def get_particle(particle_data, i):
+    """ Return the data of a single particle (row i) as a tuple in the order of the PARTICLE_DATA_STRUCTURE
+    """
+    particle = []
+    for k in PARTICLE_DATA_STRUCTURE:
+        if k == 'cs_mrc_path':
+            particle.append(particle_data['source_paths'][particle_data['columns'][k][i]])
+        elif k in particle_data['columns']:
+            particle.append(particle_data['columns'][k][i])
+        else:
+            particle.append(None)
+    return tuple(particle)
 
 def populate_relion_optics_table(particle_cs, header_list):
     """
@@ -351,98 +346,213 @@ def write_optics_table(optics_data, output_star_fname):
 
     return 
 
-def write_particle_table_headers(output_star_fname):
-    ## use append option to add to end of file 
-    with open('%s' % (output_star_fname), 'a' ) as f :
-        f.write("\n")
-        f.write("\n")
-        f.write("# version 30001")
-        f.write("\n\n")
-        f.write("data_particles\n")
-        f.write("\n")
-        f.write("loop_\n")
-        for j in range(len(RELION_PARTICLE_HEADERS)):
-            f.write("%s #%s\n" % (RELION_PARTICLE_HEADERS[j], j+1))
-
-    return 
-
-def write_particle_to_star(f, particle_data, particle_star_path):
-    s = ""
+def get_particle_star_row(particle_data, particle_star_path):
+    """ Prepare the values of a particle's data row, in the order of the RELION_PARTICLE_HEADERS
+    """
+    row = []
     ## use the globally defined particle data structure to correctly place each element in sequence with the relion headers 
     for i in range(len(RELION_PARTICLE_HEADERS)):
-        if RELION_PARTICLE_HEADERS[i] == "_rlnImageName": s = s + particle_star_path + "\t"
-        if RELION_PARTICLE_HEADERS[i] == "_rlnDefocusU": s = s + str(particle_data[PARTICLE_DATA_STRUCTURE.index('dZ_U')]) + "\t"
-        if RELION_PARTICLE_HEADERS[i] == "_rlnDefocusV": s = s + str(particle_data[PARTICLE_DATA_STRUCTURE.index('dZ_V')]) + "\t"
-        if RELION_PARTICLE_HEADERS[i] == "_rlnDefocusAngle": s = s + str(particle_data[PARTICLE_DATA_STRUCTURE.index('dZ_angle')]) + "\t"
-        if RELION_PARTICLE_HEADERS[i] == "_rlnVoltage": s = s + str(particle_data[PARTICLE_DATA_STRUCTURE.index('kV')]) + "\t"
-        if RELION_PARTICLE_HEADERS[i] == "_rlnSphericalAberration": s = s + str(particle_data[PARTICLE_DATA_STRUCTURE.index('Cs')]) + "\t"
-        if RELION_PARTICLE_HEADERS[i] == "_rlnAmplitudeContrast": s = s + str(particle_data[PARTICLE_DATA_STRUCTURE.index('amplitude_contrast')]) + "\t"
-        if RELION_PARTICLE_HEADERS[i] == "_rlnPhaseShift": s = s + str(particle_data[PARTICLE_DATA_STRUCTURE.index('phase_shift')]) + "\t"
-        if RELION_PARTICLE_HEADERS[i] == "_rlnOpticsGroup": s = s + str(1) + "\t"
-        if RELION_PARTICLE_HEADERS[i] == "_rlnOriginXAngst": s = s + str(particle_data[PARTICLE_DATA_STRUCTURE.index('origin_shift_x')]) + "\t" + "\t"
-        if RELION_PARTICLE_HEADERS[i] == "_rlnOriginYAngst": s = s + str(particle_data[PARTICLE_DATA_STRUCTURE.index('origin_shift_y')]) + "\t" + "\t"
-
-    ## add the particle metadata line to the star file 
-    f.write("%s\n" % s)
-    return 
+        if RELION_PARTICLE_HEADERS[i] == "_rlnImageName": row.append(particle_star_path)
+        if RELION_PARTICLE_HEADERS[i] == "_rlnDefocusU": row.append(str(particle_data[PARTICLE_DATA_STRUCTURE.index('dZ_U')]))
+        if RELION_PARTICLE_HEADERS[i] == "_rlnDefocusV": row.append(str(particle_data[PARTICLE_DATA_STRUCTURE.index('dZ_V')]))
+        if RELION_PARTICLE_HEADERS[i] == "_rlnDefocusAngle": row.append(str(particle_data[PARTICLE_DATA_STRUCTURE.index('dZ_angle')]))
+        if RELION_PARTICLE_HEADERS[i] == "_rlnVoltage": row.append(str(particle_data[PARTICLE_DATA_STRUCTURE.index('kV')]))
+        if RELION_PARTICLE_HEADERS[i] == "_rlnSphericalAberration": row.append(str(particle_data[PARTICLE_DATA_STRUCTURE.index('Cs')]))
+        if RELION_PARTICLE_HEADERS[i] == "_rlnAmplitudeContrast": row.append(str(particle_data[PARTICLE_DATA_STRUCTURE.index('amplitude_contrast')]))
+        if RELION_PARTICLE_HEADERS[i] == "_rlnPhaseShift": row.append(str(particle_data[PARTICLE_DATA_STRUCTURE.index('phase_shift')]))
+        if RELION_PARTICLE_HEADERS[i] == "_rlnOpticsGroup": row.append(str(1))
+        if RELION_PARTICLE_HEADERS[i] == "_rlnOriginXAngst": row.append(str(particle_data[PARTICLE_DATA_STRUCTURE.index('origin_shift_x')]))
+        if RELION_PARTICLE_HEADERS[i] == "_rlnOriginYAngst": row.append(str(particle_data[PARTICLE_DATA_STRUCTURE.index('origin_shift_y')]))
+    return row
+
+def get_particle_star_rows(particle_data, output_mrcs_dir):
+    """ Yield the .STAR data row of every particle, stack by stack, pointing to its frame in the output .MRCS stack 
+    """
+    from itertools import repeat
+    columns = particle_data['columns']
+    stack_offsets = particle_data['stack_offsets']
+    ## the source path is not needed for the .STAR file, so avoid looking it up for every particle
+    particle_columns = [ columns[k] if k in columns and k != 'cs_mrc_path' else repeat(None) for k in PARTICLE_DATA_STRUCTURE ]
+    particles = zip(*particle_columns)
+    shards = particle_data['shards']
+    for n in range(len(particle_data['stack_fnames'])):
+        output_mrcs_path = get_output_path(particle_data, n, output_mrcs_dir)
+        ## RELION numbers the images of a stack from 1 (i.e. 1@stack.mrcs is the first frame)
+        first_image = 1
+        if shards != None:
+            first_image += shards['stack_start'][n]
+        for i in range(stack_offsets[n + 1] - stack_offsets[n]):
+            particle_star_path = "%s@%s" % (first_image + i, output_mrcs_path)
+            yield get_particle_star_row(next(particles), particle_star_path)
+    return
 
-def make_empty_mrcs(stack_size, mrc_dimensions, mrc_mode, fname, apix, DEBUG = False):
-    """ Prepare an empty .MRCS in memory of the correct dimensionality
+def read_particles_from_mrcs(input_mrcs_path, input_mrcs_indexes, output_frames, DEBUG = False):
+    """ Gather frames from an input .MRC stack into a block of output frames with a single fancy-indexed read.
+        The input stack is memory-mapped, so only the requested frames are read from disk.
     PARAMETERS 
-        stack_size = int(), how many images will be stacked into this .MRCS 
-        mrc_dimensions = list( int(), int() ), size of individual .MRC files to be stacked in the form: [ x, y ]
-        mrc_mode = int(), mode of the mrc (necessary to set proper data type)
-        fname = str(), full absolution or relative path of the output .MRCS file 
-        apix = float(), the voxel size to set the mrcs file to 
+        input_mrcs_path = str(), path of the input .MRC stack 
+        input_mrcs_indexes = np.array(int), frame of each particle in the input stack (ideally sorted, for sequential reads) 
+        output_frames = np.array(), block of shape (len(input_mrcs_indexes), y, x) to hold the frames 
+    RETURNS 
+        all_read = bool(), False if any requested frame was out of range of the input stack (its frame is left as is)
     """
     import mrcfile
     import numpy as np
-    if mrc_mode in [0, 1, 2, 4, 6, 12]:
-        ## we have a compatible mode detected
+    with mrcfile.mmap(input_mrcs_path, mode='r') as input_mrcs:
+        input_data = input_mrcs.data
+        ## a stack with a single frame may be read as a 2D image
+        if input_data.ndim == 2:
+            input_data = input_data[np.newaxis]
+
+        ## sanity check each frame is in the expected range
+        in_range = (input_mrcs_indexes >= 0) & (input_mrcs_indexes < input_data.shape[0])
+        if not np.all(in_range):
+            for input_mrcs_index in input_mrcs_indexes[~in_range]:
+                print(" Input frame value requested (%s) not in expected range of .MRCS input file: (%s; [%s, %s])" % (input_mrcs_index, input_mrcs_path, 1, input_data.shape[0]))
+            output_frames[in_range] = input_data[input_mrcs_indexes[in_range]]
+        else:
+            output_frames[:] = input_data[input_mrcs_indexes]
+
         if DEBUG:
-            print(" ... using MRC mode #%s -> dtype = %s " % (mrc_mode, MRC_MODES[int(mrc_mode)])) 
+            print(" Read %s frames from: %s >> (min, max) -> (%s, %s), dtype = %s" % (len(input_mrcs_indexes), input_mrcs_path, np.min(output_frames), np.max(output_frames), input_data.dtype))
+    return bool(np.all(in_range))
+
+def prepare_normalization(box_size, bg_radius):
+    """ Precompute everything needed to normalize a block of frames of a given box size, so it is done once rather than 
+        per particle: the background mask (pixels outside a circle of bg_radius around the box center, as in 
+        relion_preprocess --bg_radius) and the least-squares fit of a plane (ramp) to the background pixels 
+    """
+    import numpy as np
+    coords = np.arange(box_size) - box_size // 2
+    bg_mask = (coords[np.newaxis, :] ** 2 + coords[:, np.newaxis] ** 2) > bg_radius ** 2
+    if not np.any(bg_mask):
+        print(" ERROR :: No background pixels left for normalization with bg_radius = %s px (box size = %s px)" % (bg_radius, box_size))
+        sys.exit()
+
+    ## a plane a*x + b*y + c evaluated over the full box, and the linear map from background pixels to (a, b, c)
+    yy, xx = np.indices((box_size, box_size))
+    ramp_basis = np.stack([ xx.ravel(), yy.ravel(), np.ones(box_size * box_size) ]).astype(np.float32)
+    ramp_fit = np.linalg.pinv(ramp_basis[:, bg_mask.ravel()].T).astype(np.float32)
+    return { 'bg_mask' : bg_mask, 'ramp_basis' : ramp_basis, 'ramp_fit' : ramp_fit }
+
+def normalize_frames(frames, normalization, subtract_ramp = True):
+    """ Normalize a block of frames in place, as relion_preprocess --norm: subtract a plane fitted to the background (unless
+        subtract_ramp = False), then scale each frame to zero mean and unit standard deviation over the background pixels 
+    PARAMETERS 
+        frames = np.array(float), block of shape (n, box, box) 
+        normalization = dict(), as returned by prepare_normalization()
+    """
+    import numpy as np
+    num_frames, box_y, box_x = frames.shape
+    flat_frames = frames.reshape(num_frames, box_y * box_x)
+    bg_pixels = normalization['bg_mask'].ravel()
+    if subtract_ramp:
+        ramp_coefficients = flat_frames[:, bg_pixels] @ normalization['ramp_fit'].T
+        flat_frames -= ramp_coefficients @ normalization['ramp_basis']
+    background = flat_frames[:, bg_pixels]
+    bg_mean = background.mean(axis = 1, dtype = np.float64)
+    bg_std = background.std(axis = 1, dtype = np.float64)
+    ## avoid dividing blank frames (e.g. frames that could not be read) by zero
+    bg_std[bg_std == 0] = 1
+    flat_frames -= bg_mean[:, np.newaxis].astype(frames.dtype)
+    flat_frames /= bg_std[:, np.newaxis].astype(frames.dtype)
+    return frames
+
+def assign_shards(particle_data, box_size, shard_size = 0):
+    """ Lay out the output stacks (per micrograph) consecutively in one or more merged .MRCS files (shards). Stacks are 
+        never split over two shards, a new shard is started once adding the next stack would exceed shard_size (GB) 
+    RETURNS 
+        shards = dict() of the form: 
+            { 'fnames' : [ 'particles_001.mrcs', ... ], ## name of each shard 
+              'num_frames' : np.array(int), ## number of frames in each shard 
+              'stack_shard' : np.array(int), ## shard index of each output stack 
+              'stack_start' : np.array(int) } ## position (0-based) of the first frame of each output stack in its shard
+    """
+    import numpy as np
+    num_particles = np.diff(particle_data['stack_offsets'])
+    frame_bytes = box_size * box_size * np.dtype(MRC_MODES[OUTPUT_MODE]).itemsize
+    max_frames = int(shard_size * 1024**3 / frame_bytes) if shard_size > 0 else 0
+
+    stack_shard = np.zeros(len(num_particles), dtype = int)
+    stack_start = np.zeros(len(num_particles), dtype = np.int64)
+    shard_frames = [0]
+    for n in range(len(num_particles)):
+        if max_frames > 0 and shard_frames[-1] > 0 and shard_frames[-1] + num_particles[n] > max_frames:
+            shard_frames.append(0)
+        stack_shard[n] = len(shard_frames) - 1
+        stack_start[n] = shard_frames[-1]
+        shard_frames[-1] += num_particles[n]
+
+    if len(shard_frames) == 1:
+        fnames = [ 'particles.mrcs' ]
     else:
-        ## we do not have a compatible mode! 
-        print("!! ERROR :: Unknown mode read from input file, %s -> mode %s" % (fname, mrc_mode))
-        exit()
+        fnames = [ 'particles_%03d.mrcs' % (i + 1) for i in range(len(shard_frames)) ]
 
-    with mrcfile.new(fname, overwrite=True) as mrc:
-        mrc.set_data(np.zeros(( stack_size, ## stack size
-                                mrc_dimensions[1], ## pixel height, 'Y'
-                                mrc_dimensions[0]  ## pixel length, 'X'
-                            ), dtype=np.dtype(MRC_MODES[int(mrc_mode)])))
-                            # ), dtype=np.float32))
+    return { 'fnames' : fnames, 'num_frames' : np.array(shard_frames, dtype = np.int64), 'stack_shard' : stack_shard, 'stack_start' : stack_start }
 
+def get_output_path(particle_data, n, output_mrcs_dir):
+    """ Return the path of the .MRCS file that holds the frames of output stack n 
+    """
+    shards = particle_data['shards']
+    if shards != None:
+        return output_mrcs_dir + shards['fnames'][shards['stack_shard'][n]]
+    return output_mrcs_dir + str(particle_data['stack_fnames'][n])
+
+def get_shard_size_on_disk(num_frames, box_size):
+    """ Expected file size of a preallocated shard: the standard 1024 byte header followed by the frames 
+    """
+    import numpy as np
+    return 1024 + int(num_frames) * box_size * box_size * np.dtype(MRC_MODES[OUTPUT_MODE]).itemsize
+
+def preallocate_shards(shards, optics_data, output_mrcs_dir, resume = False):
+    """ Create each shard at its full size as a memory-mapped .MRCS, so workers can write their frames to disjoint ranges 
+        of it concurrently. When resuming, shards that already have their full size are kept
+    RETURNS 
+        new_shards = list(int), indexes of the shards that were (re)created 
+    """
+    import mrcfile
+    box_size = optics_data['_rlnImageSize']
+    new_shards = []
+    for i in range(len(shards['fnames'])):
+        fname, num_frames = shards['fnames'][i], shards['num_frames'][i]
+        shard_path = output_mrcs_dir + fname
+        if resume and os.path.isfile(shard_path) and os.path.getsize(shard_path) == get_shard_size_on_disk(num_frames, box_size):
+            continue
+        new_shards.append(i)
+        print(" ... preallocating %s (%s particles)" % (shard_path, num_frames))
+        with mrcfile.new_mmap(shard_path, shape = (int(num_frames), box_size, box_size), mrc_mode = OUTPUT_MODE, overwrite = True) as mrc:
+            ## mark the file as an image stack first, so the pixel size is not spread over the stack depth 
+            mrc.set_image_stack()
+            mrc.voxel_size = optics_data['_rlnImagePixelSize']
+            ## the image statistics are not known until all frames are written, mark them as undetermined
+            mrc.reset_header_stats()
+    return new_shards
+
+def open_shard(shard_path):
+    """ Open the data block of a preallocated shard as a plain writable memory map, so concurrent workers only ever touch 
+        their own frames and never rewrite the shared header 
+    """
+    import mrcfile
+    import numpy as np
+    with mrcfile.mmap(shard_path, mode = 'r') as mrc:
+        dtype = mrc.data.dtype
+        ## take the shape from the header, mrcfile drops the stack axis of a shard holding a single frame 
+        shape = (int(mrc.header.nz), int(mrc.header.ny), int(mrc.header.nx))
+        data_offset = mrc.header.nbytes + int(mrc.header.nsymbt)
+    return np.memmap(shard_path, dtype = dtype, mode = 'r+', offset = data_offset, shape = shape)
+
+def write_mrcs(frames, fname, apix):
+    """ Write a block of frames to a new .MRCS stack in one write
+    """
+    import mrcfile
+    with mrcfile.new(fname, overwrite=True) as mrc:
+        mrc.set_data(frames)
         ## set pixel size data 
         mrc.voxel_size = apix
         mrc.update_header_from_data()
         mrc.update_header_stats()
         ## set the mrcfile with the correct header values to indicate it is an image stack
         mrc.set_image_stack()
-        if DEBUG:
-            print(" ... writing new .MRCS stack (%s, mode %s) with dimensions (x, y, z) = (%s, %s, %s)" % (fname, mrc_mode, mrc.data.shape[2], mrc.data.shape[1], mrc.data.shape[0]))
-    return
-
-def write_particle_to_mrcs(input_mrcs, output_mrcs, input_mrcs_path, input_mrcs_index, output_mrcs_path, output_mrcs_index, DEBUG = False):
-    if DEBUG:
-        print(" Get image from: %s @ %s" % (input_mrcs_index, input_mrcs_path))
-        print(" Save image to mrcs: %s @ %s" % (output_mrcs_index, output_mrcs_path))
-        print(" ... grabbing frame %s" % (input_mrcs_index + 1))
-
-    ## sanity check there is a frame expected
-    if input_mrcs_index in range(0, input_mrcs.data.shape[0]):
-        particle_img = input_mrcs.data[input_mrcs_index]
-        if DEBUG:
-            print(" >> Data read from file = (min, max) -> (%s, %s), dtype = %s" % (np.min(particle_img), np.max(particle_img), particle_img.dtype))
-
-        ## check if the output mrcs is a single frame, in which case we need to deal with appending the frame as a special case 
-        if len(output_mrcs.data.shape) == 2:
-            output_mrcs.data[0:] = particle_img
-        else:
-            output_mrcs.data[output_mrcs_index] = particle_img
-    else:
-        print(" Input frame value requested (%s) not in expected range of .MRCS input file: (%s; [%s, %s])" % (input_mrcs_index, input_mrcs_path, 1, input_mrcs.data.shape[0]))
-
     return 
 
 def write_star_file(optics_data, particle_data, output_dir, output_star_fname, mrcs_output_dir):
@@ -451,35 +561,46 @@ def write_star_file(optics_data, particle_data, output_dir, output_star_fname, m
     
     write_optics_table(optics_data, output_star_fname)
 
-    write_particle_table_headers(output_star_fname)
-
-    with open('%s' % (output_dir + output_star_fname), 'a' ) as f :
-        for mic in particle_data:
-            # output_mrcs_fname = os.path.splitext(os.path.basename(mic))[0].split('_', 1)[1] + '.mrcs'
-            output_mrcs_fname = mic
-            output_mrcs_path = output_dir + mrcs_output_dir + output_mrcs_fname
-
-            for i in range(len(particle_data[mic])):
-                particle_info = particle_data[mic][i]
-                particle_star_path = "%s@%s" % (i, output_mrcs_path)
-
-                write_particle_to_star(f, particle_info, particle_star_path)
+    ## append the particle table with a buffered writer, so the header is written once and rows are formatted in batches 
+    with star_handler.StarWriter(output_dir + output_star_fname, 'a') as star :
+        star.write("\n")
+        star.write_table_header('data_particles', RELION_PARTICLE_HEADERS, version = 30001)
+        star.write_rows(get_particle_star_rows(particle_data, output_dir + mrcs_output_dir))
     return 
 
-def write_mrcs_files(optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir):
+def write_mrcs_files(optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir, stack_indexes = None, manifest_fname = None):
+    """ Write the output .MRCS stacks (all stacks, or only those given by stack_indexes). Each completed stack is recorded 
+        in the manifest file (if given), so an interrupted run can be resumed 
+    RETURNS 
+        failed_stacks = list(str), names of the stacks that could not be written, or are missing particles that could not be read 
+    """
     import os
-    import mrcfile
+    import zlib
+    import numpy as np
     
     mics_w_one_particle = []
     mics_w_less_than_five = []
     mics_w_less_than_ten = []
 
-    for output_mrcs_fname in particle_data:
+    if NORMALIZE and not DRY_RUN:
+        normalization = prepare_normalization(optics_data['_rlnImageSize'], BG_RADIUS)
+
+    stack_offsets = particle_data['stack_offsets']
+    if stack_indexes is None:
+        stack_indexes = range(len(particle_data['stack_fnames']))
+    open_shards = {}
+    failed_stacks = []
+    for n in stack_indexes:
+        output_mrcs_fname = str(particle_data['stack_fnames'][n])
+        ## the particles of each output stack are a contiguous slice of the particle columns 
+        stack_slice = slice(stack_offsets[n], stack_offsets[n + 1])
+        source_codes = particle_data['columns']['cs_mrc_path'][stack_slice]
+        source_indexes = particle_data['columns']['cs_mrc_index'][stack_slice]
+        num_particles = len(source_codes)
 
         if DRY_RUN:
             output_mrcs_path = output_dir + mrcs_output_dir + output_mrcs_fname
             box_size = optics_data['_rlnImageSize']
-            num_particles = len(particle_data[output_mrcs_fname])
             # print(" ... empty .MRCS file will be created :: (%s, %s, %s) @ %s" % (box_size, box_size, num_particles, output_mrcs_path))
             # print(" WIP write out first three particles, their metadata, their source mrc and output mrc!!")
             
@@ -494,67 +615,61 @@ def write_mrcs_files(optics_data, particle_data, cs_project_dir, output_dir, mrc
         # ## crude solution, but hardcode the name change, later make this an input (i.e. fix the input dictionary during parsing?)
         # output_mrcs_fname = os.path.splitext(output_mrcs_fname)[0] + '.mrcs'
 
-        ## prepare an empty .mrcs file to hold all the frames we want to eventually write
-        output_mrcs_path = output_dir + mrcs_output_dir + output_mrcs_fname
+        ## prepare a block in memory to hold all the frames we want to write to the output .mrcs file 
+        output_mrcs_path = get_output_path(particle_data, n, output_dir + mrcs_output_dir)
         box_size = optics_data['_rlnImageSize']
-        try:
-            make_empty_mrcs(len(particle_data[output_mrcs_fname]), [box_size, box_size], 2, output_mrcs_path, optics_data['_rlnImagePixelSize'])
-            print(" .. processing %s (%s) particles" % (output_mrcs_fname, len(particle_data[output_mrcs_fname])))
-        except:
-            s = " ERROR! Could not make an empty mrcs for %s (%s) particles" % (output_mrcs_fname, len(particle_data[output_mrcs_fname]))
-            log_error(s)
-        
-        ## open the empty .mrcs file we intend to populate 
-        output_mrcs = mrcfile.open(output_mrcs_path, mode='r+')
-
-        input_mrcs = None 
-
-        for i in range(len(particle_data[output_mrcs_fname])):
-            ## get the particle data 
-            particle_info = particle_data[output_mrcs_fname][i]
-            ## retrieve the path to the current particle's mrc file in the CS project and its index in the .mrc stack 
-            ## some cs files include a chevron to indicate the root of the CS project, we need to remove it
-            cs_project_path_to_mrc = particle_info[PARTICLE_DATA_STRUCTURE.index('cs_mrc_path')]
-            if cs_project_path_to_mrc[0] == '>':
-                cs_project_path_to_mrc = cs_project_path_to_mrc[1:]
-            
-            cs_mrc_path = cs_project_dir + cs_project_path_to_mrc
-            
-            cs_mrc_particle_index = particle_info[PARTICLE_DATA_STRUCTURE.index('cs_mrc_index')]
-
-            ## open the input_mrc file if none is yet open 
-            if input_mrcs == None:
-                input_mrcs = mrcfile.open(cs_mrc_path, mode='r')
-
-            ## otherwise, check if the open file is different than one we want 
-            elif input_mrcs._iostream.name != cs_mrc_path:
-                ## since the open mrc file is not the one we want, first we close it
-                input_mrcs.close()
-                ## then we open the new one we want  
-                input_mrcs = mrcfile.open(cs_mrc_path, mode='r')
-
-            ## otherwise, we already have the appropriate open input mrc file 
-            else:
-                # print(" Input MRC file already open! ")
-                pass 
-
+        output_frames = np.zeros((num_particles, box_size, box_size), dtype = np.dtype(MRC_MODES[2]))
+        print(" .. processing %s (%s) particles" % (output_mrcs_fname, num_particles))
+
+        ## particles are sorted by input stack and frame, so each input stack is a contiguous run of particles we can read in one go
+        run_starts = np.flatnonzero(np.concatenate(([True], source_codes[1:] != source_codes[:-1])))
+        run_ends = np.append(run_starts[1:], num_particles)
+        ## a stack missing any of its particles is still written, but not recorded as complete so --resume rebuilds it 
+        ALL_READ = True
+        for run_start, run_end in zip(run_starts, run_ends):
+            ## retrieve the path to the input .mrc file in the CS project 
+            ## (the chevron some cs files use to indicate the root of the CS project was already removed while parsing)
+            cs_mrc_path = cs_project_dir + particle_data['source_paths'][source_codes[run_start]]
             try:
-                write_particle_to_mrcs(input_mrcs, output_mrcs, cs_mrc_path, cs_mrc_particle_index, output_mrcs_path, i)
+                if not read_particles_from_mrcs(cs_mrc_path, source_indexes[run_start : run_end], output_frames[run_start : run_end]):
+                    s = " ERROR! Particle frame(s) out of range of the input stack:\n %s --> %s" % (cs_mrc_path, output_mrcs_path)
+                    log_error(s)
+                    ALL_READ = False
             except:
-                s = " ERROR! Could not properly extract particles:\n %s (%s particles) --> %s" % (cs_mrc_path, len(particle_data[output_mrcs_fname]), output_mrcs_path)
+                s = " ERROR! Could not properly extract particles:\n %s (%s particles) --> %s" % (cs_mrc_path, run_end - run_start, output_mrcs_path)
                 log_error(s)
                 print(" ERROR :: Skipping particles from micrograph: %s" % output_mrcs_fname)
-                input_mrcs.close()
+                ALL_READ = False
 
-        if input_mrcs != None: 
-            input_mrcs.close()
+        ## normalize the whole stack at once and cast it to the output data type 
+        if NORMALIZE:
+            normalize_frames(output_frames, normalization, subtract_ramp = SUBTRACT_RAMP)
+        output_frames = output_frames.astype(np.dtype(MRC_MODES[OUTPUT_MODE]), copy = False)
 
-        
-        ## update & close the now-filled .mrcs file we created 
-        output_mrcs.voxel_size = optics_data['_rlnImagePixelSize']
-        output_mrcs.update_header_from_data()
-        output_mrcs.update_header_stats()
-        output_mrcs.close()
+        ## write the filled .mrcs file in one go, or copy the frames into their range of the preallocated shard 
+        try:
+            if particle_data['shards'] != None:
+                shard = particle_data['shards']['stack_shard'][n]
+                if shard not in open_shards:
+                    open_shards[shard] = open_shard(output_mrcs_path)
+                stack_start = particle_data['shards']['stack_start'][n]
+                open_shards[shard][stack_start : stack_start + num_particles] = output_frames
+                open_shards[shard].flush()
+            else:
+                write_mrcs(output_frames, output_mrcs_path, optics_data['_rlnImagePixelSize'])
+        except:
+            s = " ERROR! Could not write mrcs for %s (%s) particles" % (output_mrcs_fname, num_particles)
+            log_error(s)
+            failed_stacks.append(output_mrcs_fname)
+            continue 
+
+        if not ALL_READ:
+            failed_stacks.append(output_mrcs_fname)
+            continue
+
+        ## only record the stack once it is completely written 
+        if manifest_fname != None:
+            append_manifest_entry(manifest_fname, output_mrcs_fname, num_particles, output_mrcs_path, zlib.crc32(output_frames))
 
     if DRY_RUN:
         print(" # micrographs with:")
@@ -562,7 +677,9 @@ def write_mrcs_files(optics_data, particle_data, cs_project_dir, output_dir, mrc
         print("   < 5 particles = %s" % len(mics_w_less_than_five))
         print("  < 10 particles = %s" % len(mics_w_less_than_ten))
 
-    return 
+    ## release the memory maps of any shards we wrote to 
+    open_shards.clear()
+    return failed_stacks
 
 def log_error(err, out_fname = 'err.log', reset = False):
     if err == '':
@@ -579,31 +696,200 @@ def log_error(err, out_fname = 'err.log', reset = False):
 
     return
 
-def prep_working_dir(mrcs_output_dir_name):
+def prep_working_dir(mrcs_output_dir_name, resume = False):
     ## prepare the root directory for all .mrcs files and clean it up if anything already exists in it 
     if os.path.isdir(mrcs_output_dir_name):
         # print(" ERROR :: An existing folder already is present at the target output location for particle .MRCS stacks: %s" % mrcs_output_dir)
         # print("  ... doublecheck & delete this folder before proceeding")
         # exit()
 
+        ## when resuming, keep the stacks (and manifest) of the previous run, incomplete stacks are overwritten later 
+        if resume:
+            return 
+
         ## check the directory for .mrcs files and delete them 
         dir_contents = os.listdir(mrcs_output_dir_name)
         for f in dir_contents:
             f_path = mrcs_output_dir_name + f
             if os.path.isfile(f_path):
-                if os.path.splitext(f_path)[1] in ['.mrcs', '.MRCS']:
+                if os.path.splitext(f_path)[1] in ['.mrcs', '.MRCS'] or f == MANIFEST_FNAME:
                     os.remove(f_path)
     else:
         os.mkdir(mrcs_output_dir_name)
 
     return
 
-def split_dict(d, n):
-    """ prepare a method to break the dataset into smaller chunks based on number of threads 
+def get_output_settings():
+    """ Summarize the settings that change the content of the output stacks, so stacks written with other settings are 
+        not kept when resuming 
+    """
+    settings = { 'mode' : OUTPUT_MODE, 'norm' : None, 'single_stack' : None }
+    if NORMALIZE:
+        settings['norm'] = [ BG_RADIUS, SUBTRACT_RAMP ]
+    if SINGLE_STACK:
+        settings['single_stack'] = SHARD_SIZE
+    return settings
+
+def append_manifest_entry(manifest_fname, stack_fname, num_particles, stack_path, checksum):
+    """ Record a completed .MRCS stack as one line of JSON: its expected particle count, file size in bytes, the CRC32 
+        checksum of its image data and the output settings used to write it
+    """
+    import json
+    entry = { 'stack' : stack_fname, 'particles' : int(num_particles), 'bytes' : os.path.getsize(stack_path), 'crc32' : checksum }
+    entry.update(get_output_settings())
+    ## each entry is a single short write in append mode, so entries from parallel workers do not interleave 
+    with open(manifest_fname, 'a') as f:
+        f.write(json.dumps(entry) + "\n")
+    return 
+
+def load_manifest(manifest_fname):
+    """ Read the manifest of a previous run into a dictionary of the form: { 'stack_fname' : entry, ... } 
+    """
+    import json
+    manifest = {}
+    if not os.path.isfile(manifest_fname):
+        return manifest
+    with open(manifest_fname, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                ## e.g. a truncated final line if the previous run was killed mid-write 
+                continue
+            manifest[entry['stack']] = entry
+    return manifest
+
+def save_manifest(manifest_fname, entries):
+    """ Overwrite the manifest with the given entries, e.g. to drop stale or truncated entries before resuming 
+    """
+    import json
+    with open(manifest_fname, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+    return 
+
+def get_stack_checksum(particle_data, n, stack_path):
+    """ CRC32 checksum of the image data of an output stack as written on disk, i.e. of its own frames if it is part of a shard 
+    """
+    import zlib
+    import mrcfile
+    if particle_data['shards'] != None:
+        shard = open_shard(stack_path)
+        stack_start = particle_data['shards']['stack_start'][n]
+        num_particles = particle_data['stack_offsets'][n + 1] - particle_data['stack_offsets'][n]
+        return zlib.crc32(shard[stack_start : stack_start + num_particles])
+    with mrcfile.mmap(stack_path, mode = 'r') as mrc:
+        return zlib.crc32(mrc.data)
+
+def get_remaining_stacks(particle_data, manifest, output_mrcs_dir, verify = False):
+    """ Find the stacks that still need to be written: stacks missing from the manifest, stacks whose particle count or output
+        settings no longer match, and stacks whose file is missing or has a different size than recorded (i.e. partial).
+        With verify = True, stacks whose image data no longer matches the recorded checksum (i.e. corrupted) are rewritten too
+    RETURNS 
+        stack_indexes = np.array(int), indexes of the stacks to (re)write
+    """
+    import numpy as np
+    num_particles = np.diff(particle_data['stack_offsets'])
+    output_settings = get_output_settings()
+    stack_indexes = []
+    for n in range(len(particle_data['stack_fnames'])):
+        stack_fname = str(particle_data['stack_fnames'][n])
+        stack_path = get_output_path(particle_data, n, output_mrcs_dir)
+        if stack_fname in manifest:
+            entry = manifest[stack_fname]
+            same_settings = all(entry.get(k) == output_settings[k] for k in output_settings)
+            if same_settings and entry['particles'] == num_particles[n] and os.path.isfile(stack_path) and os.path.getsize(stack_path) == entry['bytes']:
+                if not verify or get_stack_checksum(particle_data, n, stack_path) == entry['crc32']:
+                    continue
+                print(" ... checksum mismatch, rewriting: %s" % stack_fname)
+        stack_indexes.append(n)
+    return np.array(stack_indexes, dtype = int)
+
+def get_stack_schedule(particle_data, box_size, stack_indexes):
+    """ Order the output stacks for parallel processing from the heaviest to the lightest (longest-processing-time-first), 
+        weighing each stack by its particle count x box area (i.e. the number of pixels to read & write)
+    RETURNS 
+        schedule = np.array(int), stack indexes in processing order 
+        weights = np.array(float), weight of each stack 
+    """
+    import numpy as np
+    weights = np.diff(particle_data['stack_offsets']) * float(box_size) ** 2
+    stack_indexes = np.asarray(stack_indexes, dtype = int)
+    schedule = stack_indexes[np.argsort(-weights[stack_indexes], kind = 'stable')]
+    return schedule, weights
+
+def init_worker(optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir, manifest_fname):
+    """ Give each worker process the full dataset once, so tasks only need to carry stack indexes 
+    """
+    global WORKER_ARGS
+    WORKER_ARGS = (optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir, manifest_fname)
+    return 
+
+def write_mrcs_task(stack_indexes):
+    """ Write a batch of output stacks in a worker process 
+    RETURNS 
+        (worker process id, # stacks written, # particles written, time spent working (sec), names of stacks that failed)
     """
-    keys = list(d.keys())
-    for i in range(0, len(keys), n):
-        yield {k: d[k] for k in keys[i: i + n]}
+    import os, time
+    start_time = time.time()
+    optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir, manifest_fname = WORKER_ARGS
+    failed_stacks = write_mrcs_files(optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir, stack_indexes, manifest_fname)
+    stack_offsets = particle_data['stack_offsets']
+    num_particles = int(sum(stack_offsets[n + 1] - stack_offsets[n] for n in stack_indexes))
+    return os.getpid(), len(stack_indexes), num_particles, time.time() - start_time, failed_stacks
+
+def write_mrcs_files_parallel(optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir, threads, stack_indexes, manifest_fname = None):
+    """ Distribute the output stacks over a pool of workers. Batches of stacks are handed out heaviest first, and each 
+        worker pulls the next batch as soon as it is idle, so the small stacks at the end fill in any imbalance  
+    RETURNS 
+        failed_stacks = list(str), names of the stacks that could not be written, or are missing particles that could not be read 
+    """
+    import time
+    schedule, weights = get_stack_schedule(particle_data, optics_data['_rlnImageSize'], stack_indexes)
+    ## keep batches small enough for load balancing, but large enough to avoid per-task overhead on many tiny stacks
+    batch_size = max(1, int(len(schedule) / (threads * 16)))
+    batches = [ schedule[i : i + batch_size] for i in range(0, len(schedule), batch_size) ]
+
+    worker_stats = {}
+    failed_stacks = []
+    start_time = time.time()
+    ## prepare pool of workers
+    pool = Pool(threads, initializer = init_worker, initargs = (optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir, manifest_fname))
+    try:
+        ## assign workload to pool dynamically 
+        for pid, num_stacks, num_particles, busy_time, batch_failed_stacks in pool.imap_unordered(write_mrcs_task, batches):
+            failed_stacks.extend(batch_failed_stacks)
+            stats = worker_stats.setdefault(pid, [0, 0, 0.0])
+            stats[0] += num_stacks
+            stats[1] += num_particles
+            stats[2] += busy_time
+        ## close the pool from recieving any other tasks
+        pool.close()
+        ## merge with the main thread, stopping any further processing until workers are complete
+        pool.join()
+    except KeyboardInterrupt:
+        print("Multiprocessing run killed")
+        pool.terminate()
+        sys.exit()
+    wall_time = time.time() - start_time
+
+    print_worker_utilization(worker_stats, wall_time)
+    return failed_stacks
+
+def print_worker_utilization(worker_stats, wall_time):
+    """ Report the share of the parallel run each worker spent working, a well-balanced run has all workers near 100%
+    PARAMETERS 
+        worker_stats = dict( pid : [ # stacks, # particles, time spent working (sec) ] )
+        wall_time = float(), total time of the parallel run (sec)
+    """
+    print(" --------------------------------------------------------------------------------------------------")
+    print(" Worker utilization (wall time = %.2f sec):" % wall_time)
+    print("   %10s %10s %12s %12s %12s" % ('worker', 'stacks', 'particles', 'busy (sec)', 'utilization'))
+    for pid in sorted(worker_stats):
+        num_stacks, num_particles, busy_time = worker_stats[pid]
+        utilization = 100 * busy_time / wall_time if wall_time > 0 else 0
+        print("   %10s %10s %12s %12.2f %11.1f%%" % (pid, num_stacks, num_particles, busy_time, utilization))
+    return 
 
 #endregion
 
@@ -614,7 +900,7 @@ def split_dict(d, n):
 if __name__ == "__main__":
     import sys, os
     import numpy as np
-    from random import randint, choice
+    from random import randint, sample
     try:
         import mrcfile
     except:
@@ -624,10 +910,26 @@ if __name__ == "__main__":
     from multiprocessing import Pool 
     import time
 
+    ## star_handler lives in the star_file_tools folder of this repository 
+    script_path = os.path.dirname(os.path.realpath(sys.argv[0]))
+    try:
+        sys.path.append(os.path.join(script_path, '..', 'star_file_tools'))
+        import star_handler
+    except:
+        print(" ERROR :: Could not import star_handler.py, check the star_file_tools folder is present next to this script's folder")
+        sys.exit()
+    try:
+        sys.path.append(script_path)
+        import cs_handler
+    except:
+        print(" ERROR :: Could not import cs_handler.py, check it is present in the same folder as this script")
+        sys.exit()
+
     start_time = time.time()
 
     cmd_line = sys.argv
     PARALLEL_PROCESSING = False
+    RESUME = False
 
     ## read all entries and check if the help flag is called at any point
     for cmd in cmd_line:
@@ -652,6 +954,32 @@ if __name__ == "__main__":
         if cmd_line[i] in ['--dry-run', '--dry_run']:
             DRY_RUN = True
             print(" Running in dry-run mode... no files will be written")
+        if cmd_line[i] == '--resume':
+            RESUME = True
+            print(" Resuming previous run... only missing or incomplete stacks will be written")
+        if cmd_line[i] == '--verify':
+            VERIFY = True
+        if cmd_line[i] == '--norm':
+            NORMALIZE = True
+        if cmd_line[i] == '--bg_radius':
+            ## try parsing the background radius 
+            try:
+                BG_RADIUS = int(cmd_line[i+1])
+            except:
+                print(" Could not parse background radius (--bg_radius flag), check command line" )
+                usage()
+        if cmd_line[i] == '--no_ramp':
+            SUBTRACT_RAMP = False
+        if cmd_line[i] == '--float16':
+            OUTPUT_MODE = 12
+            print(" Writing particle stacks in float16 (MRC mode 12)")
+        if cmd_line[i] in ['--single-stack', '--single_stack']:
+            SINGLE_STACK = True
+            ## try parsing an optional maximum shard size 
+            try:
+                SHARD_SIZE = float(cmd_line[i+1])
+            except:
+                SHARD_SIZE = 0
         if cmd_line[i] in ['--o']:
             ## try parsing the desired output folder name  
             try:
@@ -700,7 +1028,8 @@ if __name__ == "__main__":
     print("------------------------------------------------------------------")
 
     ## cs data is stored as a numpy structured array (recarrays), it can be opened with numpy 
-    cs_dataset = np.load(cs_file)
+    ## memory-map it and only load the headers we use, large pose/alignment headers can otherwise take up most of the RAM 
+    cs_dataset = cs_handler.load_cs(cs_file, fields = CS_PARTICLE_FIELDS + [h for h in CS_OPTICS_HEADERS if h != None], DEBUG = DEBUG)
 
     cs_project_dir = sanity_check_inputs(cs_dataset, cs_project_dir)
 
@@ -710,48 +1039,63 @@ if __name__ == "__main__":
     ## run through the CS dataset to prepare the necessary data for creating .MRCS and .STAR files
     optics_data, particle_data = parse_cs_dataset(cs_dataset)
 
-    if not DRY_RUN:
-        prep_working_dir(output_dir + mrcs_output_dir_name)
-
-    write_star_file(optics_data, particle_data, output_dir, output_star_fname, mrcs_output_dir_name)
+    if NORMALIZE:
+        if BG_RADIUS == None:
+            BG_RADIUS = int(0.37 * optics_data['_rlnImageSize'])
+        print(" Normalizing particles using background radius = %s px%s" % (BG_RADIUS, '' if SUBTRACT_RAMP else ' (no ramp)'))
 
-    if PARALLEL_PROCESSING:
-        ## multithreading set up
-        tasks = []
-        for subset in split_dict(particle_data, int(len(particle_data) / threads)):
-            tasks.append(subset)
+    if SINGLE_STACK:
+        particle_data['shards'] = assign_shards(particle_data, optics_data['_rlnImageSize'], SHARD_SIZE)
+        print(" Writing all particles into %s merged stack(s): %s" % (len(particle_data['shards']['fnames']), ', '.join(particle_data['shards']['fnames'])))
 
-        ## generate the working input functions
-        try:
-            dataset = []
-            for task in tasks:
-                dataset.append((optics_data, task, cs_project_dir, output_dir, mrcs_output_dir_name))
-            ## prepare pool of workers
-            pool = Pool(threads)
-            ## assign workload to pool
-            results = pool.starmap(write_mrcs_files, dataset)
-            ## close the pool from recieving any other tasks
-            pool.close()
-            ## merge with the main thread, stopping any further processing until workers are complete
-            pool.join()
-
-        except KeyboardInterrupt:
-            print("Multiprocessing run killed")
-            pool.terminate()
+    if not DRY_RUN:
+        prep_working_dir(output_dir + mrcs_output_dir_name, resume = RESUME)
+        if SINGLE_STACK:
+            new_shards = preallocate_shards(particle_data['shards'], optics_data, output_dir + mrcs_output_dir_name, resume = RESUME)
 
+    write_star_file(optics_data, particle_data, output_dir, output_star_fname, mrcs_output_dir_name)
 
+    ## find which stacks need to be written, when resuming skip the stacks recorded as complete by the previous run
+    manifest_fname = output_dir + mrcs_output_dir_name + MANIFEST_FNAME
+    stack_indexes = np.arange(len(particle_data['stack_fnames']))
+    if RESUME and not DRY_RUN:
+        manifest = load_manifest(manifest_fname)
+        if SINGLE_STACK:
+            ## stacks that belong to a freshly preallocated shard have to be rewritten, whatever the manifest says 
+            for n in np.flatnonzero(np.isin(particle_data['shards']['stack_shard'], new_shards)):
+                manifest.pop(str(particle_data['stack_fnames'][n]), None)
+        stack_indexes = get_remaining_stacks(particle_data, manifest, output_dir + mrcs_output_dir_name, verify = VERIFY)
+        ## keep only the entries of complete stacks, so new entries are appended to a clean file 
+        complete_stacks = np.setdiff1d(np.arange(len(particle_data['stack_fnames'])), stack_indexes)
+        save_manifest(manifest_fname, [ manifest[str(particle_data['stack_fnames'][n])] for n in complete_stacks ])
+        print(" ... %s of %s stacks already complete, %s stacks left to write" % (len(particle_data['stack_fnames']) - len(stack_indexes), len(particle_data['stack_fnames']), len(stack_indexes)))
+
+    ## in dry-run mode nothing is written, so there is no need to spin up workers
+    if PARALLEL_PROCESSING and not DRY_RUN:
+        failed_stacks = write_mrcs_files_parallel(optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir_name, threads, stack_indexes, manifest_fname)
     else:
-        write_mrcs_files(optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir_name)
+        failed_stacks = write_mrcs_files(optics_data, particle_data, cs_project_dir, output_dir, mrcs_output_dir_name, stack_indexes, None if DRY_RUN else manifest_fname)
 
     if DRY_RUN:
         print(" --------------------------------------------------------------------------------------------------")
         print(" ... DRY-RUN COMPLETE")
+    elif len(failed_stacks) > 0:
+        print(" --------------------------------------------------------------------------------------------------")
+        print(" ... FAILED :: %s of %s stacks could not be written completely (see err.log), e.g.: %s" % (len(failed_stacks), len(stack_indexes), ', '.join(failed_stacks[:5])))
+        print("   Rerun with --resume to write only the missing stacks")
+        print(" --------------------------------------------------------------------------------------------------")
+        sys.exit(1)
     else:
         print(" --------------------------------------------------------------------------------------------------")
         print(" ... COMPLETE")
         print("   Written: %s" % output_dir + output_star_fname)
         print("   MRCS files written in: %s" % output_dir + mrcs_output_dir_name)
         print(" --------------------------------------------------------------------------------------------------")
+    if not DRY_RUN and NORMALIZE:
+        print(" Particles were normalized during export (bg_radius = %s px), import the particle stack in RELION and use" % BG_RADIUS)
+        print(" the corresponding cryoSPARC volume to generate initial Euler angles for each particle to run subsequent jobs")
+        print("===================================================================================================")
+    elif not DRY_RUN:
         print(" NOTE: Will likely need to normalize the particles for processing in RELION (this is done on extraction job)")
         print(" To do this, save a back up of the particle stack and run normalization, e.g.:")
         print("     $ mv mrcs_stacks mrcs_backup; mkdir mrcs_stacks")
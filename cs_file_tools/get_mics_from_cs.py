@@ -9,6 +9,12 @@
 #############################
 DEBUG = False
 
+## headers we need to read from the recarray, there are inconsistencies in the headers used to indicate paths so keep a fallback
+MIC_PATH_HEADER = 'micrograph_blob/path'
+MIC_PATH_HEADER_ALT = 'micrograph_blob_non_dw/path'
+DZ_1_HEADER = 'ctf/df1_A'
+DZ_2_HEADER = 'ctf/df2_A'
+
 #############################
 ###     DEFINITION BLOCK
 #############################
@@ -113,7 +119,8 @@ def parse_flags(cmdline):
 
 def load_data_from_cs_file(fname):
     print(" Loading cs file: %s" % cs_fname)
-    cs_data = np.load(cs_fname)
+    ## only the path & defocus headers are needed, so avoid loading the rest of the file into memory 
+    cs_data = cs_handler.load_cs(cs_fname, fields = [MIC_PATH_HEADER, MIC_PATH_HEADER_ALT, DZ_1_HEADER, DZ_2_HEADER], DEBUG = DEBUG)
     print(" ... %s entries found" % len(cs_data))
     return cs_data
 
@@ -123,35 +130,21 @@ def get_mics_from_cs_data(cs_data):
        [ ('img_name', dZ_avg), ('img_name', dZ_avg), ... ]
 
     """
-    mics = []
-
-    ## assign the headers we need to read from for each entry in the recarray 
-    mic_path_header = 'micrograph_blob/path'
-    mic_path_header_alt = 'micrograph_blob_non_dw/path'
-    dZ_1_header = 'ctf/df1_A'
-    dZ_2_header = 'ctf/df2_A'
     ## load the headers from the recarray 
     headers = cs_data.dtype.names
-    NO_CTF = False
-    if dZ_1_header not in headers:
-        NO_CTF = True
-
-    ## iterate over each entry in the recarray and extract the relevant data 
-    for entry in cs_data:
-        ## there are inconsistencies in the headers used to indicate paths, so use fallback headers to try and shore up gaps 
-        try: 
-            mic_path = str(entry[headers.index(mic_path_header)], 'UTF-8')
-        except:
-            mic_path = str(entry[headers.index(mic_path_header_alt)], 'UTF-8')
-
-        if not NO_CTF:
-            dZ_1 = entry[headers.index(dZ_1_header)]
-            dZ_2 = entry[headers.index(dZ_2_header)]
-            dZ_avg = ((dZ_1 + dZ_2) / 2)/10000
-        else:
-            dZ_avg = -1
 
-        mics.append((mic_path, dZ_avg))
+    ## there are inconsistencies in the headers used to indicate paths, so use fallback headers to try and shore up gaps 
+    if MIC_PATH_HEADER in headers:
+        mic_paths = cs_handler.apply_to_runs(cs_data[MIC_PATH_HEADER], cs_handler.decode_strings)
+    else:
+        mic_paths = cs_handler.apply_to_runs(cs_handler.get_column(cs_data, MIC_PATH_HEADER_ALT), cs_handler.decode_strings)
+
+    if cs_handler.has_fields(cs_data, [DZ_1_HEADER, DZ_2_HEADER]):
+        dZ_avgs = ((cs_data[DZ_1_HEADER] + cs_data[DZ_2_HEADER]) / 2)/10000
+    else:
+        dZ_avgs = [-1] * len(cs_data)
+
+    mics = list(zip(mic_paths.tolist(), dZ_avgs))
 
     if DEBUG:
         print(" Extracted .CS data:")
@@ -323,10 +316,18 @@ def get_cs_headers(dataset):
 #############################
 
 if __name__ == '__main__':
-    import numpy as np
     import os, sys
     import random 
 
+    ## cs_handler lives in the same folder as this script 
+    script_path = os.path.dirname(os.path.realpath(sys.argv[0]))
+    try:
+        sys.path.append(script_path)
+        import cs_handler
+    except:
+        print(" ERROR :: Could not import cs_handler.py, check it is present in the same folder as this script")
+        sys.exit()
+
 
     cs_fname, subset_size, out_fname, omit_list = parse_flags(sys.argv)
 
@@ -6,6 +6,17 @@
 #############################
 DEBUG = False
 
+## headers to read from the .cs file, the 2D alignment headers are only used if present to recenter the particles 
+CS_LOCATION_HEADERS = [
+    'location/micrograph_path',
+    'location/micrograph_shape',
+    'location/center_x_frac',
+    'location/center_y_frac',
+    'blob/psize_A',
+    'alignments2D/psize_A',
+    'alignments2D/shift'
+]
+
 
 #############################
 ###     DEFINITION BLOCK
@@ -67,7 +78,8 @@ def parse_flags(cmdline):
 
 def load_data_from_cs_file(fname):
     print(" Loading cs file: %s" % cs_fname)
-    cs_data = np.load(cs_fname)
+    ## only the location headers (and 2D shifts, if present) are needed, so avoid loading the rest of the file into memory 
+    cs_data = cs_handler.load_cs(cs_fname, fields = CS_LOCATION_HEADERS, DEBUG = DEBUG)
     print(" ... %s entries found" % len(cs_data))
     return cs_data
 
@@ -78,79 +90,39 @@ def parse_particles_from_cs_data(cs_data):
     """
     mic_particle_data = dict()
 
-    ## assign the headers we need to read from for each entry in the recarray 
-    header_mic_path = 'location/micrograph_path'
-    header_mic_shape = 'location/micrograph_shape'
-    header_mic_angpix = 'blob/psize_A'
-
-    header_x_location_frac = 'location/center_x_frac'
-    header_y_location_frac = 'location/center_y_frac'
-    header_class2D_angpix = 'alignments2D/psize_A'
-    header_class2D_shift = 'alignments2D/shift'
-
-    ## load the headers from the recarray 
-    headers = cs_data.dtype.names
-
     ## check if there is 2D alignment data present to determine shifts 
-    RECENTER = False
-    if header_class2D_shift in headers:
-        RECENTER = True
-
-    ## iterate over each entry in the recarray and extract the relevant data
-    i = 0 
-    for entry in cs_data:
-        i += 1
-        mic_path = str(entry[headers.index(header_mic_path)], 'UTF-8')
-        mic_name = extract_mic_name(mic_path)
-        micrograph_ny  = entry[headers.index(header_mic_shape)][0]
-        micrograph_nx  = entry[headers.index(header_mic_shape)][1]
-
-        ## calulate the current locations of the particles in pixels
-        initial_x = entry[headers.index(header_x_location_frac)] * micrograph_nx
-        initial_y = entry[headers.index(header_y_location_frac)] * micrograph_ny
-
+    RECENTER = cs_handler.has_fields(cs_data, ['alignments2D/shift', 'alignments2D/psize_A', 'blob/psize_A'])
+
+    ## read the relevant headers as whole columns from the recarray 
+    mic_names = cs_handler.get_basenames(cs_handler.get_paths(cs_data, 'location/micrograph_path'))
+    initial_x, initial_y = cs_handler.get_pixel_coordinates(cs_data, recenter = False)
+    if RECENTER:
+        recentered_x, recentered_y = cs_handler.get_pixel_coordinates(cs_data, recenter = True)
+        x_coords = recentered_x.astype(int)
+        y_coords = recentered_y.astype(int)
+    else:
+        x_coords = initial_x.astype(int)
+        y_coords = initial_y.astype(int)
+
+    ## report the first few particles 
+    micrograph_shape = cs_data['location/micrograph_shape']
+    for i in range(min(4, len(cs_data))):
+        print(" Processing particle #%s" % (i + 1))
+        print("   mic = %s" % mic_names[i])
+        print("   mic_shape = (%s, %s) : (x, y)" % (micrograph_shape[i][1], micrograph_shape[i][0]))
         if RECENTER:
-            micrograph_pixel_size = entry[headers.index(header_mic_angpix)]
-
-            ## transform the pixel shifts from the 2D classification scale to the micrograph scale 
-            class2D_pixel_size = entry[headers.index(header_class2D_angpix)]
-            shift_x = entry[headers.index(header_class2D_shift)][0] * class2D_pixel_size / micrograph_pixel_size
-            shift_y = entry[headers.index(header_class2D_shift)][1] * class2D_pixel_size / micrograph_pixel_size
-
-            recentered_x = initial_x - shift_x 
-            recentered_y = initial_y - shift_y 
-
-            x = int(recentered_x)
-            y = int(recentered_y)
-        else:
-            x = int(initial_x)
-            y = int(initial_y)
-
-        
-        if mic_name not in mic_particle_data:
-            mic_particle_data[mic_name] = [(x, y)]
+            print("   shifts (px) = (x, y) -> (%s, %s)" % (initial_x[i] - recentered_x[i], initial_y[i] - recentered_y[i]))
+            print("   initial pixel coordinate = (x, y) -> (%s, %s)" % (initial_x[i], initial_y[i]))
+            print("   recentered pixel coordinate = (x, y) -> (%s, %s)" % (x_coords[i], y_coords[i]))
         else:
-            mic_particle_data[mic_name].append((x, y))
-
-        if i < 5: 
-            # print(" -------------------------------------------------------")
-            print(" Processing particle #%s" % i)
-            print("   mic = %s" % mic_name)
-            print("   mic_shape = (%s, %s) : (x, y)" % (micrograph_nx, micrograph_ny))
-            if RECENTER:
-                print("   shifts (px) = (x, y) -> (%s, %s)" % (shift_x, shift_y))
-                print("   initial pixel coordinate = (x, y) -> (%s, %s)" % (initial_x, initial_y))
-
-            # print("   recenter with shifts = (%.2f, %.2f) -> (%.2f, %.2f)" % (location_x, location_y, location_xs, location_ys))
-                print("   recentered pixel coordinate = (x, y) -> (%s, %s)" % (x, y))
-            else:
-                print("   pixel coordinate = (x, y) -> (%s, %s)" % (initial_x, initial_y))
-            print(" -------------------------------------------------------")
+            print("   pixel coordinate = (x, y) -> (%s, %s)" % (initial_x[i], initial_y[i]))
+        print(" -------------------------------------------------------")
 
-        else:
-            print(f"\r Processing particle #%s" % i, end="")
+    ## group the coordinates by micrograph 
+    for mic_name, x, y in zip(mic_names.tolist(), x_coords.tolist(), y_coords.tolist()):
+        mic_particle_data.setdefault(mic_name, []).append((x, y))
 
-    print("")
+    print(" Processed %s particles across %s micrographs" % (len(cs_data), len(mic_particle_data)))
 
     if DEBUG:
         print(" Extracted .CS particle data:")
@@ -194,7 +166,15 @@ def write_manpick_files(data_dict):
 
 if __name__ == "__main__":
     import os, sys
-    import numpy as np
+
+    ## cs_handler lives in the same folder as this script 
+    script_path = os.path.dirname(os.path.realpath(sys.argv[0]))
+    try:
+        sys.path.append(script_path)
+        import cs_handler
+    except:
+        print(" ERROR :: Could not import cs_handler.py, check it is present in the same folder as this script")
+        sys.exit()
 
     cs_fname = parse_flags(sys.argv)
 
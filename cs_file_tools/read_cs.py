@@ -67,25 +67,14 @@ def get_data_from_cs_by_headers(dataset, target_headers):
     """
     extracted_data = {}
 
-    ## 1. Unpack the header data into a dictionary we can refer to later ( 'header_name' : index/column )  
-    headers = dataset.dtype.names ## 'headers' for each index position can be retrieved from the main array
-    header_dict = {} 
-    for i in range(len(headers)):
-        header_dict[headers[i]] = i
-    
-    ## 2. iterate over the dataset and extract the values of interest 
-    for i in range(len(dataset)):
-        for key in header_dict:
-            header_name = key
-            header_index = header_dict[key]
-
-            if header_name == 'uid':
-                UID = dataset[i][header_index]
-                extracted_data[UID] = []
+    ## 1. read the UIDs and each header of interest as whole columns (in the order they appear in the dataset) 
+    uids = cs_handler.get_column(dataset, 'uid').tolist()
+    headers = [header for header in dataset.dtype.names if header in target_headers]
+    columns = [dataset[header] for header in headers]
 
-            if header_name in target_headers:
-                data_point = (header_name, dataset[i][header_index])
-                extracted_data[UID].append(data_point)
+    ## 2. pair the values of each entry with their header names 
+    for UID, values in zip(uids, zip(*columns)):
+        extracted_data[UID] = list(zip(headers, values))
 
     # print(extracted_data)
 
@@ -148,8 +137,18 @@ def save_cs(fname, dataset):
 
 if __name__ == "__main__":
     import sys
+    import os
     import numpy as np
 
+    ## cs_handler lives in the same folder as this script 
+    script_path = os.path.dirname(os.path.realpath(sys.argv[0]))
+    try:
+        sys.path.append(script_path)
+        import cs_handler
+    except:
+        print(" ERROR :: Could not import cs_handler.py, check it is present in the same folder as this script")
+        sys.exit()
+
     cs_file = sys.argv[1]
 
     ## hardcode the files for now:
@@ -163,7 +162,8 @@ if __name__ == "__main__":
 
 
     ## cs data is stored as a numpy structured array (recarrays), it can be opened with numpy 
-    cs_dataset = np.load(cs_file)
+    ## memory-map it so only the entries we print are read from disk 
+    cs_dataset = cs_handler.load_cs(cs_file)
 
     ## choose which headers we are interested in 
     # target_headers = ['uid', 'ctf/path', 'ctf/df1_A', 'ctf/df2_A', 'ctf/df_angle_rad', 'ctf/ctf_fit_to_A']
@@ -172,6 +172,9 @@ if __name__ == "__main__":
     # read_cs_data(cs_dataset, headers_of_interest = target_headers)
     read_cs_data(cs_dataset)
 
+    ## report how much memory each header costs, useful to decide which headers to load for large files 
+    cs_handler.print_field_sizes(cs_dataset)
+
     ## we next need to open the other dataset and iterate over it to grab the relevant data we want to swap in... 
     # cs_dataset_2 = np.load(cs_file2)
     # extracted_data = get_data_from_cs_by_headers(cs_dataset_2, target_headers)
@@ -8,6 +8,7 @@ def usage():
     print("=================================================================================================================")
     print(" Optional flags:")
     print("     --h : ignore all other flags, print usage and quit")
+    print("     --cache : keep parsed model tables next to each .STAR file for faster re-runs")
     print("=================================================================================================================")
     print(" To use, run this script in a Class3D/run directory.")
     print("=================================================================================================================")
@@ -43,7 +44,7 @@ def find_and_sort_all_model_files():
 
     return (sorted_file_list, star_file_dictionary)
 
-def parse_star_file(file):
+def parse_star_file(file, cache = False):
     """ For a given *_model.star file, parse the data for each class corresponding to its distribution and resolution.
         Returns a list of tuples:
                 [ (str(class001.mrc), float(distribution), float(resolution), int(iteration_value) ), ... ]
@@ -54,58 +55,12 @@ def parse_star_file(file):
     ## by RELION 3.1 convention, the interation value is always just before the model.star in the name
     itr_value = int(file_name_split[-2][2:])
 
-    with open(file, 'r') as f :
-        line_num = 0
-        table_start = 0
-        table_end = 0
-        class_name_col = -1
-        class_distribution_col = -1
-        class_resolution_col = -1
-        parsed_entries = []
-
-        for line in f :
-            line_num += 1
-            first_character = ""
-            line = line.strip() # remove empty spaces around line
-            line_to_list = line.split() # break words into indexed list format
-            # ignore empty lines
-            if len(line) == 0 :
-                continue
-
-            ## find the start of the data table we are interested in
-            if 'data_model_classes' in line:
-                # print(" >> Table found at line num: ", line_num)
-                table_start = line_num
-
-            ## if we are in the data section of the table, look for the column number for each entry we desire to parse
-            if (line_num > table_start):
-                if '_rlnReferenceImage' in line:
-                    class_name_col = get_star_column_number(line)
-                    # print('class column = ', line, class_name_col)
-                if '_rlnClassDistribution' in line:
-                    class_distribution_col = get_star_column_number(line)
-                    # print('distribution column = ', line, class_distribution_col)
-                if '_rlnEstimatedResolution' in line:
-                    class_resolution_col = get_star_column_number(line)
-                    # print('resolution column = ', line, class_resolution_col)
-
-            ## catch the end of the table to end this function early
-            if (line_num > table_start) and (table_end < table_start):
-                if 'data_' in line:
-                    # print(" >> subsequent table found at line num: " , line_num)
-                    table_end = line_num
-                    # if VERBOSE:
-                    #     print(parsed_entries)
-                    return parsed_entries
-
-            ## if we made it this far into the function, we might be on a data entry, run a check and if it passes parse the data for each entry
-            if (class_name_col > 0) and (class_distribution_col > 0) and (class_resolution_col > 0):
-                ## filter out any lines that are not data entries based on if they contain '_' or '#' as their first character
-                first_character = ""
-                first_character = list(line_to_list[0])[0]
-                if first_character == '_' or first_character == '#':
-                    continue
-                parsed_entries.append( ( get_star_column_info(line, class_name_col).split('/')[-1].split('_')[-1], float(get_star_column_info(line, class_distribution_col)), float(get_star_column_info(line, class_resolution_col)), int(itr_value) ) )
+    data = star_handler.read_table(file, 'data_model_classes', columns = ['_rlnReferenceImage', '_rlnClassDistribution', '_rlnEstimatedResolution'], cache = cache)
+
+    parsed_entries = []
+    for class_name, class_distribution, class_resolution in zip(data['_rlnReferenceImage'], data['_rlnClassDistribution'], data['_rlnEstimatedResolution']):
+        parsed_entries.append( ( str(class_name).split('/')[-1].split('_')[-1], float(class_distribution), float(class_resolution), int(itr_value) ) )
+    return parsed_entries
 
 def get_star_column_number(line):
     """ For a line in a star file describing a column entry (e.g., '_rlnEstimatedResolution #5'), retrieve the value of that column (e.g. 5)
@@ -224,12 +179,21 @@ if __name__ == "__main__":
     import os
     import sys
 
+    ## Get the execution path of this script so we can find local modules
+    script_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    try:
+        sys.path.append(script_path)
+        import star_handler 
+    except :
+        print(" ERROR :: Check if star_handler.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
+
 
     ##################################################
     ### SET UP GLOBAL VARIABLES & EXPORT THOSE REQUIERD FOR IMPORTED MODULES
     ##################################################
     VERBOSE = True
     PLOT_DATA = True
+    CACHE = False
     ## define VERBOSE as an environment variable so it can be found by my custom imported modules
     os.environ['VERBOSE'] = str(VERBOSE)
 
@@ -254,6 +218,9 @@ if __name__ == "__main__":
     #     if sys.argv[n] == '--remove_duplicates' or sys.argv[n] == '--remove_duplicate':
     #         REMOVE_DUPLICATE = True
     #         remove_distance_angstroms = float(sys.argv[n+1])
+    for n in range(len(sys.argv[1:])+1):
+        if sys.argv[n] == '--cache':
+            CACHE = True
     ###################################
 
     print("Running script...")
@@ -271,7 +238,7 @@ if __name__ == "__main__":
     ### PARSE ALL .STAR FILES AND POPULATE DATA STRUCTURES
     ###################################
     for file in ordered_file_list:
-        file_data = parse_star_file(file[1])
+        file_data = parse_star_file(file[1], cache = CACHE)
         # for entry in file_data:
         #     print(entry)
         star_file_data[file[1]] = file_data
@@ -30,6 +30,8 @@ def usage():
     print("                   --gt (n) : Find micrographs with particle counts greater than the value n")
     print("             --bin_size (n) : Plot histogram with a bin size of n particles")
     print("   --o (threshold_mics.txt) : Change the output file name from default")
+    print("                    --cache : Keep parsed columns next to the .STAR file for faster re-runs")
+    print("                    --j (1) : Number of processes used to parse the .STAR file")
     print("===================================================================================================")
     sys.exit()
 
@@ -43,6 +45,8 @@ def parse_cmdline(cmd_line):
     LESS_THAN = None
     GREATER_THAN = None
     BIN_SIZE = 10
+    CACHE = False
+    WORKERS = 1
     out_fname = 'threshold_mics.txt' # set default 
     for i in range(len(cmd_line)):
         if cmd_line[i] == '--lt':
@@ -76,6 +80,17 @@ def parse_cmdline(cmd_line):
             except:
                 print(" Could not parse --o entry or none given, using default: %s" % out_fname)
 
+        if cmd_line[i] == '--cache':
+            CACHE = True
+            print(" Use the sidecar cache for parsed .STAR columns")
+
+        if cmd_line[i] == '--j':
+            try:
+                WORKERS = int(cmd_line[i+1])
+                print(" Parse the .STAR file with %s processes" % WORKERS)
+            except:
+                print(" Could not parse --j entry or none given, using default of %s process" % WORKERS)
+
     ## check for the .STAR file  
     star_file = None
     for i in range(len(cmd_line)):
@@ -89,99 +104,28 @@ def parse_cmdline(cmd_line):
         print(" ERROR :: No .STAR file was detected as input!")
         usage()
 
-    return star_file, LESS_THAN, GREATER_THAN, out_fname, BIN_SIZE
-
-def header_length(file):
-    """ For an input .STAR file, define the length of the header and
-        return the last line in the header. Header length is determined by
-        finding the highest line number starting with '_' character
-    """
-    with open(file, 'r') as f :
-        line_num = 0
-        header_lines = []
-        for line in f :
-            line_num += 1
-            first_character = ""
-            line = line.strip() # remove empty spaces around line
-            line_to_list = line.split() # break words into indexed list format
-            # ignore empty lines
-            if len(line) == 0 :
-                continue
-            first_character = list(line_to_list[0])[0]
-            if first_character == '_':
-                header_lines.append(line_num)
-                # if DEBUG:
-                #     print("Line # %d = " % line_num, end="")
-                #     print(line, " --> ", line_to_list, sep=" ")
-        return max(header_lines)
-
-def find_star_column(file, column_type, header_length) :
-    """ For an input .STAR file, search through the header and find the column numbers assigned to a given column_type (e.g. 'rlnMicrographName', ...)
-    """
-    with open(file, 'r') as f :
-        line_num = 0
-        for line in f :
-            line_num += 1
-            # extract column number for micrograph name
-            if column_type in line :
-                column_num = int(line.split()[1].replace("#",""))
-                ## handle error case where input .STAR file is missing a necessary rlnColumn type
-                if column_num is None :
-                    print(" ERROR: Input .STAR file: %s, is missing a column for: %s" % (file, column_type) )
-                    sys.exit()
-            # search header and no further to find setup values
-            if line_num >= header_length :
-                if DEBUG:
-                    # print("Read though header (%s lines total)" % header_length)
-                    print(" Column value for %s = %d" % (column_type, column_num))
-                return column_num
-
-def find_star_info(line, column):
-    """ For a given .STAR file line entry, extract the data at the given column index.
-        If the column does not exist (e.g. for a header line read in), return 'False'
-    """
-    # break an input line into a list data type for column-by-column indexing
-    line_to_list = line.split()
-    try:
-        column_value = line_to_list[column-1]
-        # if DEBUG:
-        #     print("Data in column #%s = %s" % (column, column_value))
-        return column_value
-    except:
-        return False
-
-def extract_mic_name(input_string):
-    """ Parse the entry for 'rlnMicrographName' to extract only the micrograph name without any path names etc...
-    """
-    mic_name = os.path.basename(input_string)
-    # if DEBUG:
-    #     print("Extract micrograph name from entry: %s -> %s" % (input_string, mic_name))
-    return mic_name
+    return star_file, LESS_THAN, GREATER_THAN, out_fname, BIN_SIZE, CACHE, WORKERS
 
-def parse_star_file(file, columnName, header_size):
+def parse_star_file(file, table_title = 'data_particles', cache = False, workers = 1):
     """ For a given .STAR file, extract the micrograph name, # of coordinates
-        WIP 
+        Returns a dictionary of the form: { mic_name : #_particles, ... }
     """
-    with open(file, 'r') as f :
-        data_parse_list = dict()
-        line_num = 0
-        for line in f :
-            line_num += 1
-            # ignore empty lines
-            if len(line.strip()) == 0 :
-                continue
-            # start working only after the header length
-            if line_num > header_size:
-                # X_coordinate = float(find_star_info(line, columnX))
-                # Y_coordinate = float(find_star_info(line, columnY))
-                mic_name = os.path.splitext(extract_mic_name(find_star_info(line, columnName)))[0]
-                if mic_name not in data_parse_list:
-                    data_parse_list[mic_name] = 1
-                else:
-                    data_parse_list[mic_name] += 1
-                # if DEBUG:
-                #     print("Coordinates found: (%s, %s, %s)" % (mic_name, X_coordinate, Y_coordinate))
-        return data_parse_list
+    star_index = None
+    ## try the cache first, a table found there can be read without indexing the file at all 
+    if not cache or table_title not in star_handler.get_cached_tables(file):
+        star_index = star_handler.StarIndex(file)
+        ## older style files have a single table, in which case use the last table in the file
+        if table_title not in star_index.tables:
+            table_title = list(star_index.tables)[-1]
+    data = star_handler.read_table(file, table_title, columns = ['_rlnMicrographName'], star_index = star_index, cache = cache, workers = workers, DEBUG = DEBUG)
+
+    ## count particles per unique micrograph path first, so the basename is only resolved once per micrograph
+    mic_paths, counts = np.unique(data['_rlnMicrographName'], return_counts = True)
+    mic_names = star_handler.get_basenames(mic_paths)
+    data_parse_list = dict()
+    for mic_name, count in zip(mic_names.tolist(), counts.tolist()):
+        data_parse_list[mic_name] = data_parse_list.get(mic_name, 0) + count
+    return data_parse_list
 
 def write_thresholded_mics(list_of_mics, out_fname):
     """
@@ -380,14 +324,20 @@ if __name__ == "__main__":
     from matplotlib import pyplot as plt
     from matplotlib import rcParams # update the condition for autolayout to ensure proper figure formatting
 
-    star_file, LESS_THAN, GREATER_THAN, out_fname, BIN_SIZE = parse_cmdline(sys.argv)
+    ## Get the execution path of this script so we can find local modules
+    script_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    try:
+        sys.path.append(script_path)
+        import star_handler 
+    except :
+        print(" ERROR :: Check if star_handler.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
+
+    star_file, LESS_THAN, GREATER_THAN, out_fname, BIN_SIZE, CACHE, WORKERS = parse_cmdline(sys.argv)
 
     print("... running")
     print(" .STAR file = %s" % star_file)
 
-    header_size = header_length(star_file)
-    mic_name_column = find_star_column(star_file, '_rlnMicrographName', header_size)
-    particle_data = parse_star_file(star_file, mic_name_column, header_size)
+    particle_data = parse_star_file(star_file, cache = CACHE, workers = WORKERS)
     # write_manpick_files(particle_coordinate_info)
 
     print("==============================================")
@@ -184,31 +184,23 @@ def write_manpick_files(data_dict, FLIPX, FLIPY, x_len, y_len):
         else:
             out_fname = mic+'_manualpick.star'
 
-        ## overwrite a fresh output file with its header 
-        with open('%s' % (out_fname), 'w' ) as f :
-            f.write("\n")
-            f.write("data_\n")
-            f.write("\n")
-            f.write("loop_\n")
-            f.write("_rlnCoordinateX #1\n")
-            f.write("_rlnCoordinateY #2\n")
-            f.write("_rlnParticleSelectionType #3\n")
-            f.write("_rlnAnglePsi #4\n")
-            f.write("_rlnAutopickFigureOfMerit #5\n")
-
-    for mic in data_dict:
-        with open('%s' % (out_fname), 'a' ) as f :                
-            for (X_coord, Y_coord) in data_dict[mic] :
-                if FLIPX:
-                    X_coord = x_len - 1 - X_coord
-                    if X_coord < 0:
-                        print(" WARNING :: Flipped X coordinate is negative!")
-                if FLIPY: 
-                    Y_coord = y_len -1 -Y_coord
-                    if Y_coord < 0:
-                        print(" WARNING :: Flipped Y coordinate is negative!")
-
-                f.write("%s\t%s\t2\t-999.0\t-999.0\n" % (X_coord, Y_coord))
+        ## flip all coordinates of the micrograph at once 
+        coords = np.array(data_dict[mic], dtype = float).reshape(-1, 2)
+        X_coords = coords[:, 0]
+        Y_coords = coords[:, 1]
+        if FLIPX:
+            X_coords = x_len - 1 - X_coords
+            if np.any(X_coords < 0):
+                print(" WARNING :: Flipped X coordinate is negative!")
+        if FLIPY: 
+            Y_coords = y_len - 1 - Y_coords
+            if np.any(Y_coords < 0):
+                print(" WARNING :: Flipped Y coordinate is negative!")
+
+        ## overwrite a fresh output file with its header and all its rows in one buffered pass
+        with star_handler.StarWriter(out_fname, 'w') as f :
+            f.write_table_header('data_', ['_rlnCoordinateX', '_rlnCoordinateY', '_rlnParticleSelectionType', '_rlnAnglePsi', '_rlnAutopickFigureOfMerit'])
+            f.write_columns([ X_coords, Y_coords, np.full(len(coords), 2), np.full(len(coords), -999.0), np.full(len(coords), -999.0) ])
 
     if VERBOSE:
         print(" Saved modified .STAR file as: %s" % out_fname)
@@ -226,6 +218,15 @@ def write_manpick_files(data_dict, FLIPX, FLIPY, x_len, y_len):
 if __name__ == "__main__":
     import os
     import sys
+    import numpy as np
+
+    ## Get the execution path of this script so we can find local modules
+    script_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    try:
+        sys.path.append(script_path)
+        import star_handler 
+    except :
+        print(" ERROR :: Check if star_handler.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
 
     star_file, img_x, img_y, FLIPX, FLIPY = parse_cmdline(sys.argv)
 
@@ -135,21 +135,21 @@ def remap_optics_group(file, column_micName, column_opticsGroup, header_size, op
         print("...")
         print( "{:,}".format(counter) + " particle optical groups were updated")
 
-def update_optics_table(file, out_file, optics_list, is_movie = False):
+def update_optics_table(file, out_file, optics_list, star_index, is_movie = False):
     ## Get landmarks for optics data table so we can copy only this region 
-    OPTICS_TABLE_START, OPTICS_HEADER_START, OPTICS_DATA_START, OPTICS_DATA_END = star_handler.get_table_position(file, 'data_optics', DEBUG = DEBUG)
+    OPTICS_TABLE_START, OPTICS_HEADER_START, OPTICS_DATA_START, OPTICS_DATA_END = star_index.get_table_position('data_optics')
     ## Get the particle data dimensions from input file (so we can faithfully copy the space between tables actually)
     if is_movie:
-        PARTICLE_TABLE_START, PARTICLE_HEADER_START, PARTICLE_START, PARTICLE_END = star_handler.get_table_position(file, 'data_movies', DEBUG = DEBUG)
+        PARTICLE_TABLE_START, PARTICLE_HEADER_START, PARTICLE_START, PARTICLE_END = star_index.get_table_position('data_movies')
     else:
-        PARTICLE_TABLE_START, PARTICLE_HEADER_START, PARTICLE_START, PARTICLE_END = star_handler.get_table_position(file, 'data_particles', DEBUG = DEBUG)
+        PARTICLE_TABLE_START, PARTICLE_HEADER_START, PARTICLE_START, PARTICLE_END = star_index.get_table_position('data_particles')
 
     
     ## Find columns for the relevant optics headers we need to change  
-    COLUMN_rlnOpticsGroupName = star_handler.find_star_column(file, '_rlnOpticsGroupName', OPTICS_HEADER_START, OPTICS_DATA_START, DEBUG = DEBUG)
-    COLUMN_rlnOpticsGroup = star_handler.find_star_column(file, '_rlnOpticsGroup', OPTICS_HEADER_START, OPTICS_DATA_START, DEBUG = DEBUG)
+    COLUMN_rlnOpticsGroupName = star_index.find_star_column('data_optics', '_rlnOpticsGroupName', DEBUG = DEBUG)
+    COLUMN_rlnOpticsGroup = star_index.find_star_column('data_optics', '_rlnOpticsGroup', DEBUG = DEBUG)
 
-    with open(out_file, 'w') as s :
+    with star_handler.StarWriter(out_file, 'w') as s :
 
         with open(file, 'r') as f :
             line_num = 0
@@ -163,17 +163,14 @@ def update_optics_table(file, out_file, optics_list, is_movie = False):
 
                 ## get the first optics data entry as a template to make the new one we want 
                 if line_num == OPTICS_DATA_START :
-                    optics_entry = line.split()
+                    optics_template = line.split()
+                    optics_entries = []
                     for i in range(len(optics_list)):
+                        optics_entry = list(optics_template)
                         optics_entry[COLUMN_rlnOpticsGroup - 1] = str(i + 1) 
                         optics_entry[COLUMN_rlnOpticsGroupName - 1] = str(optics_list[i])
-                        ## create a nicely formatted string to print
-                        formatted_string = ''
-                        for n in optics_entry:
-                            n += " "
-                            formatted_string += '{:11}'.format(n)
-
-                        s.write(formatted_string + "\n")
+                        optics_entries.append(optics_entry)
+                    s.write_rows(optics_entries)
                 
                 ## copy the space after the optics table faithfully 
                 if OPTICS_DATA_END < line_num < PARTICLE_TABLE_START:
@@ -181,154 +178,93 @@ def update_optics_table(file, out_file, optics_list, is_movie = False):
                         
     return 
 
-def update_particles(file, out_file, optics_list, mic_to_optics_dict):
-    ## Get the new optics table dimensions 
-    OPTICS_TABLE_START, OPTICS_HEADER_START, OPTICS_DATA_START, OPTICS_DATA_END = star_handler.get_table_position(out_file, 'data_optics', DEBUG = DEBUG)
-    ## Get the particle data dimensions from input file 
-    PARTICLE_TABLE_START, PARTICLE_HEADER_START, PARTICLE_DATA_START, PARTICLE_DATA_END = star_handler.get_table_position(file, 'data_particles', DEBUG = DEBUG)
-
-    ## Find columns for the relevant particle data entries we need to read or change  
-    COLUMN_rlnMicrographName = star_handler.find_star_column(file, '_rlnMicrographName', PARTICLE_HEADER_START, PARTICLE_DATA_START, DEBUG = DEBUG)
-    COLUMN_rlnOpticsGroup = star_handler.find_star_column(file, '_rlnOpticsGroup', PARTICLE_HEADER_START, PARTICLE_DATA_START, DEBUG = DEBUG)
-
-
-    skipped_particles_count = 0
-    updated_particles_count = 0
-    with open(out_file, 'a') as s :
- 
+def find_optics_index(micrograph_basename, optics_list, mic_to_optics_dict):
+    """ Find the (1-based) optics group index for a micrograph using fuzzy matching against the remapping file entries.
+        Returns None if no match is found 
+    """
+    for mic in list(mic_to_optics_dict): ## allow for fuzzy matching by using the keys are a list of strings we can compare against item-by-item 
+        ## in case there is something like _Fractions on one string and not the other, check only a string of similar length 
+        if len(micrograph_basename) > len(mic):
+            micrograph_basename = micrograph_basename[:len(mic)]
+        if micrograph_basename in mic: 
+            ## get the new optics group assignment for the discovered micrograph based on the input file 
+            updated_optics_group = mic_to_optics_dict[mic]
+            ## find the corresponding index for that optics group 
+            return optics_list.index(updated_optics_group) + 1 
+    return None
+
+def remap_data_table(file, out_file, table_title, column_name, optics_list, mic_to_optics_dict, star_index):
+    """ Copy a data table (e.g. 'data_particles') from the input file onto the end of the output file, 
+        updating the _rlnOpticsGroup of each row according to the micrograph named in the given column 
+    """
+    ## Get the data dimensions from input file 
+    TABLE_START, HEADER_START, DATA_START, DATA_END = star_index.get_table_position(table_title)
+
+    ## Find columns for the relevant data entries we need to read or change  
+    COLUMN_rlnMicrographName = star_index.find_star_column(table_title, column_name, DEBUG = DEBUG)
+    COLUMN_rlnOpticsGroup = star_index.find_star_column(table_title, '_rlnOpticsGroup', DEBUG = DEBUG)
+
+    counts = { 'updated' : 0, 'skipped' : 0 }
+    ## the fuzzy search over the remapping file is only run once per micrograph 
+    optics_index_by_mic = {}
+
+    def remapped_rows(f):
+        line_num = 0
+        for line in f :
+            line_num += 1
+
+            ## copy the table header faithfully into the new file (these lines all precede the first yielded row)
+            if DATA_START > line_num >= TABLE_START : 
+                s.write(line)
+            
+            if DATA_START <= line_num <= DATA_END:
+                particle_data = line.split()
+                particle_micrograph_basename = os.path.splitext(os.path.basename(particle_data[COLUMN_rlnMicrographName - 1]))[0]
+
+                ## check if micrograph is found in the input remapping dictionary
+                if particle_micrograph_basename not in optics_index_by_mic:
+                    optics_index_by_mic[particle_micrograph_basename] = find_optics_index(particle_micrograph_basename, optics_list, mic_to_optics_dict)
+                optics_index = optics_index_by_mic[particle_micrograph_basename]
+
+                if optics_index is None:
+                    print(" !! WARNING :: Particle entry contains micrograph not present in remapping file (%s) -> %s, skipping ..." % (file, particle_micrograph_basename))
+                    print(" Example comparison: ")
+                    print("           Particle mic basename = ", particle_micrograph_basename)
+                    print("    Example mic from optics file = ", list(mic_to_optics_dict)[0])
+                    counts['skipped'] += 1
+                    continue
+
+                ## update the optics group entry in the data line 
+                particle_data[COLUMN_rlnOpticsGroup - 1] = str(optics_index)
+                counts['updated'] += 1
+                if counts['updated'] % 10000 == 0:
+                    print(f"\r Processing particle #%s" % counts['updated'], end="")
+                yield particle_data
+
+    with star_handler.StarWriter(out_file, 'a') as s :
         with open(file, 'r') as f :
-            line_num = 0
-            for line in f :
-                line_num += 1
+            ## the writer formats the updated rows in batches through a large write buffer 
+            s.write_rows(remapped_rows(f))
 
-                ## copy the particle header faithfully into the new file 
-                if PARTICLE_DATA_START > line_num >= PARTICLE_TABLE_START : 
-                    s.write(line)
-                    # print(" ..> ", line_num, line)
-                
-                if PARTICLE_DATA_START <= line_num <= PARTICLE_DATA_END:
-                    # print(" ..> ", line)
-                    particle_data = line.split()
-                    particle_micrograph_basename = os.path.splitext(os.path.basename(particle_data[COLUMN_rlnMicrographName - 1]))[0]
-
-                    ## check if micrograph is found in the input remapping dictionary
-                    MATCH_FOUND = False
-                    for mic in list(mic_to_optics_dict): ## allow for fuzzy matching by using the keys are a list of strings we can compare against item-by-item 
-                        ## in case there is something like _Fractions on one string and not the other, check only a string of similar length 
-                        if len(particle_micrograph_basename) > len(mic):
-                            particle_micrograph_basename = particle_micrograph_basename[:len(mic)]
-                        if particle_micrograph_basename in mic: 
-                            ## get the new optics group assignment for the discovered micrograph based on the input file 
-                            updated_optics_group = mic_to_optics_dict[mic]
-                            ## find the corresponding index for that optics group 
-                            optics_index = optics_list.index(updated_optics_group) + 1 
-                            ## update the optics group entry in the data line 
-                            particle_data[COLUMN_rlnOpticsGroup - 1] = str(optics_index)
-                            ## prepare the output string 
-                            formatted_string = ''
-                            for n in particle_data:
-                                n += " " ## add a leading space in case the string is longer than the arbiray format delimiter 
-                                formatted_string += '{:11}'.format(n)
-                            ## write the new particle line in the output file 
-                            s.write(formatted_string + "\n")
-                            updated_particles_count += 1
-                            print(f"\r Processing particle #%s" % updated_particles_count, end="")
-
-                            MATCH_FOUND = True
-                            break
-
-                    if not MATCH_FOUND:
-                        print(" !! WARNING :: Particle entry contains micrograph not present in remapping file (%s) -> %s, skipping ..." % (file, particle_micrograph_basename))
-                        print(" Example comparison: ")
-                        print("           Particle mic basename = ", particle_micrograph_basename)
-                        print("    Example mic from optics file = ", list(mic_to_optics_dict)[0])
-                        skipped_particles_count += 1
     print("")
     print("=====================================")
     print(" COMPLETE ")
     print("-------------------------------------")
-    print("      %s particles updated " % updated_particles_count)
-    if skipped_particles_count > 0:
-        print("      %s particles skipped" % skipped_particles_count)
+    print("      %s particles updated " % counts['updated'])
+    if counts['skipped'] > 0:
+        print("      %s particles skipped" % counts['skipped'])
     print("-------------------------------------")
     print("  updated file written: %s" % out_file)
     print("=====================================")
 
     return 
 
-def update_movies(file, out_file, optics_list, mic_to_optics_dict):
-    ## Get the new optics table dimensions 
-    OPTICS_TABLE_START, OPTICS_HEADER_START, OPTICS_DATA_START, OPTICS_DATA_END = star_handler.get_table_position(out_file, 'data_optics', DEBUG = DEBUG)
-    ## Get the movie data dimensions from input file 
-    PARTICLE_TABLE_START, PARTICLE_HEADER_START, PARTICLE_DATA_START, PARTICLE_DATA_END = star_handler.get_table_position(file, 'data_movies', DEBUG = DEBUG)
-
-    ## Find columns for the relevant particle data entries we need to read or change  
-    COLUMN_rlnMicrographMovieName = star_handler.find_star_column(file, '_rlnMicrographMovieName', PARTICLE_HEADER_START, PARTICLE_DATA_START, DEBUG = DEBUG)
-    COLUMN_rlnOpticsGroup = star_handler.find_star_column(file, '_rlnOpticsGroup', PARTICLE_HEADER_START, PARTICLE_DATA_START, DEBUG = DEBUG)
-
-
-    skipped_particles_count = 0
-    updated_particles_count = 0
-    with open(out_file, 'a') as s :
- 
-        with open(file, 'r') as f :
-            line_num = 0
-            for line in f :
-                line_num += 1
-
-                ## copy the particle header faithfully into the new file 
-                if PARTICLE_DATA_START > line_num >= PARTICLE_TABLE_START : 
-                    s.write(line)
-                    # print(" ..> ", line_num, line)
-                
-                if PARTICLE_DATA_START <= line_num <= PARTICLE_DATA_END:
-                    # print(" ..> ", line)
-                    particle_data = line.split()
-                    particle_micrograph_basename = os.path.splitext(os.path.basename(particle_data[COLUMN_rlnMicrographMovieName - 1]))[0]
-
-                    ## check if micrograph is found in the input remapping dictionary
-                    MATCH_FOUND = False
-                    for mic in list(mic_to_optics_dict): ## allow for fuzzy matching by using the keys are a list of strings we can compare against item-by-item 
-                        ## in case there is something like _Fractions on one string and not the other, check only a string of similar length 
-                        if len(particle_micrograph_basename) > len(mic):
-                            particle_micrograph_basename = particle_micrograph_basename[:len(mic)]
-                        if particle_micrograph_basename in mic: 
-                            ## get the new optics group assignment for the discovered micrograph based on the input file 
-                            updated_optics_group = mic_to_optics_dict[mic]
-                            ## find the corresponding index for that optics group 
-                            optics_index = optics_list.index(updated_optics_group) + 1 
-                            ## update the optics group entry in the data line 
-                            particle_data[COLUMN_rlnOpticsGroup - 1] = str(optics_index)
-                            ## prepare the output string 
-                            formatted_string = ''
-                            for n in particle_data:
-                                n += " " ## add a leading space in case the string is longer than the arbiray format delimiter 
-                                formatted_string += '{:11}'.format(n)
-                            ## write the new particle line in the output file 
-                            s.write(formatted_string + "\n")
-                            updated_particles_count += 1
-                            print(f"\r Processing particle #%s" % updated_particles_count, end="")
-
-                            MATCH_FOUND = True
-                            break
-
-                    if not MATCH_FOUND:
-                        print(" !! WARNING :: Particle entry contains micrograph not present in remapping file (%s) -> %s, skipping ..." % (file, particle_micrograph_basename))
-                        print(" Example comparison: ")
-                        print("           Particle mic basename = ", particle_micrograph_basename)
-                        print("    Example mic from optics file = ", list(mic_to_optics_dict)[0])
-                        skipped_particles_count += 1
-    print("")
-    print("=====================================")
-    print(" COMPLETE ")
-    print("-------------------------------------")
-    print("      %s particles updated " % updated_particles_count)
-    if skipped_particles_count > 0:
-        print("      %s particles skipped" % skipped_particles_count)
-    print("-------------------------------------")
-    print("  updated file written: %s" % out_file)
-    print("=====================================")
+def update_particles(file, out_file, optics_list, mic_to_optics_dict, star_index):
+    remap_data_table(file, out_file, 'data_particles', '_rlnMicrographName', optics_list, mic_to_optics_dict, star_index)
+    return 
 
+def update_movies(file, out_file, optics_list, mic_to_optics_dict, star_index):
+    remap_data_table(file, out_file, 'data_movies', '_rlnMicrographMovieName', optics_list, mic_to_optics_dict, star_index)
     return 
 
 class PARAMETERS():
@@ -430,11 +366,14 @@ if __name__ == "__main__":
         print("---------------------------")
 
 
-    update_optics_table(params.star_file, params.output_star_file, optics_group_list, is_movie=params.is_movies)
+    ## index all tables of the input file in a single pass, rather than re-scanning it for every lookup 
+    star_index = star_handler.StarIndex(params.star_file, DEBUG = DEBUG)
+
+    update_optics_table(params.star_file, params.output_star_file, optics_group_list, star_index, is_movie=params.is_movies)
 
     if params.is_movies:
-        update_movies(params.star_file, params.output_star_file, optics_group_list, mics_to_optics_dict)
+        update_movies(params.star_file, params.output_star_file, optics_group_list, mics_to_optics_dict, star_index)
     else:
-        update_particles(params.star_file, params.output_star_file, optics_group_list, mics_to_optics_dict)
+        update_particles(params.star_file, params.output_star_file, optics_group_list, mics_to_optics_dict, star_index)
 
 #endregion
\ No newline at end of file
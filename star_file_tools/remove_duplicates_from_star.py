@@ -127,8 +127,9 @@ if __name__ == "__main__":
     print("... running")
     print(" .STAR file = %s" % starfile)
 
-    TABLE_START, HEADER_START, DATA_START, DATA_END = star_handler.get_table_position(starfile, 'data_particles', DEBUG = DEBUG)
-    rlnImageName_COLUMN = star_handler.find_star_column(starfile, "_rlnImageName", HEADER_START, DATA_START - 1, DEBUG = DEBUG)
+    star_index = star_handler.StarIndex(starfile, DEBUG = DEBUG)
+    TABLE_START, HEADER_START, DATA_START, DATA_END = star_index.get_table_position('data_particles')
+    rlnImageName_COLUMN = star_index.find_star_column('data_particles', "_rlnImageName", DEBUG = DEBUG)
 
     parse_star_file(starfile, out_fname, DATA_START, DATA_END, rlnImageName_COLUMN)
 
@@ -47,13 +47,16 @@ def remove_mics_from_star(PARAMS):
     mics_to_remove = parse_mic_list_file(mic_list_file)
 
     ## use star_handler module to parse the input file correctly
-    TABLE_START, HEADER_START, DATA_START, DATA_END = star_handler.get_table_position(input_star, table_title, DEBUG)
+    star_index = star_handler.StarIndex(input_star, DEBUG)
     column_name = '_rlnMicrographName'
-    column_num = star_handler.find_star_column(input_star, column_name, HEADER_START, (DATA_START - 1), DEBUG)
-    data_range = (DATA_START, DATA_END)
+    data = star_handler.read_table(input_star, table_title, columns = [column_name], star_index = star_index, DEBUG = DEBUG)
+
+    ## flag every data row whose micrograph basename is in the removal list 
+    mic_basenames = star_handler.get_basenames(data[column_name])
+    rows_to_remove = np.isin(mic_basenames, mics_to_remove)
 
     ## open the input star file and use the parsed information to write out a new one with the requested changes
-    read_write_star(input_star, mics_to_remove, data_range, column_num, output_star)
+    read_write_star(input_star, star_index, table_title, rows_to_remove, output_star)
     return
 
 def parse_mic_list_file(file):
@@ -75,70 +78,43 @@ def parse_mic_list_file(file):
         print(" ... %s micrograph(s) found in '%s'" % (len(mic_list), file) )
     return mic_list
 
-def read_write_star(file, mics_to_remove, line_range, star_column_num, output_fname) :
-    """ Open a .star file and read it line-by-line. Evaluate each line with conditional functions.
+def read_write_star(file, star_index, table_title, rows_to_remove, output_fname) :
+    """ Copy a .star file into a new file, dropping the flagged data rows of one table.
         ============================================
         PARAMETERS:
         ============================================
             file = str(); name of .STAR file to read from
-            mics_to_remove = list(); list of str() representing micrograph base names
-            line_range = tuple(a,b); where a, b are int() representing start and end line # for data to be worked on
-            star_column_num = int(); from table header, which column corresponds to 'rlnMicrographName'
+            star_index = star_handler.StarIndex(); index of the .STAR file
+            table_title = str(); name of the table to edit (e.g. 'data_micrographs')
+            rows_to_remove = np.ndarray(bool); one entry per data row in the table, True for rows to drop
             output_fname = str(); name of the file that will be saved on disk
         ===========================================
         OUTPUT:
         ============================================
             No output. Creates a new .STAR file.
     """
-    ## create an empty file with the target name (erase previous file if present)
-    f = open(output_fname, 'w+')
-    f.close()
-
-    ## parse through input file and run algorithm on target lines
-    with open(file, 'r') as f :
-        line_num = 0 # keep track of line number
-        mics_removed = 0 # keep track of mics identified for removal
-        for line in f :
-            # keep track of what line number is being read
-            line_num += 1
-
-            # copy any lines that are out of range without any edit/change
-            if line_num < line_range[0] or line_num > line_range[1]:
-                write_line(output_fname, line)
-                continue
-            # deal with empty lines (usually found at the end of the .STAR file)
-            if len(line.strip()) == 0 :
-                write_line(output_fname, line)
-                continue
-
-            ## if reached this part of loop, we are in the data lines of the .STAR file
-
-            # extract micrograph basename from the relevant column
-            current_name = star_handler.remove_path(star_handler.get_star_data(line, star_column_num))
-            current_basename = os.path.splitext(current_name)[0]
-
-            if current_basename in mics_to_remove:
-                mics_removed += 1
-                # if DEBUG:
-                #     print(" >> Remove micrograph from .STAR file: %s" % current_name)
+    table = star_index.get_table(table_title)
+    with open(output_fname, 'wb') as o :
+        with open(file, 'rb') as f :
+            if table.num_rows == 0:
+                shutil.copyfileobj(f, o)
             else:
-                write_line(output_fname, line)
+                ## copy everything before the data rows without any edit/change
+                o.write(f.read(table.data_offset))
+                ## copy only the data rows we keep, straight from the memory-mapped input 
+                with star_handler.StarRows(file, table_title, star_index = star_index) as rows :
+                    rows.write_rows(np.flatnonzero(~rows_to_remove), o)
+                ## copy the remainder of the file (e.g. trailing empty lines or other tables)
+                f.seek(table.data_end_offset)
+                shutil.copyfileobj(f, o)
+
     if DEBUG:
         print("-------------------------------------------------------------------------")
-        print("  >> %s micrograph lines removed from %s file." % (mics_removed, file))
+        print("  >> %s micrograph lines removed from %s file." % (int(rows_to_remove.sum()), file))
         print("=========================================================================")
     return None
 
 
-def write_line(file, l) :
-    """ Open the file and write the line into it as a new line string
-    """
-    with open(file, 'a') as f :  # mode 'a' opens the file for editing, without truncating the file first
-        f.write(l)
-    return
-
-
-
 #############################
 ###     RUN BLOCK
 #############################
@@ -147,6 +123,8 @@ if __name__ == "__main__":
     import string
     import os
     import sys
+    import shutil
+    import numpy as np
     import cmdline_parser
     import star_handler
 
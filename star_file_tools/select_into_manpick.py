@@ -104,31 +104,31 @@ def extract_mic_name(input_string):
     return mic_name
 
 
-def parse_star_file(file, columnName, columnX, columnY, header_size):
+def parse_star_file(file, table_title = 'data_particles'):
     """ For a given .STAR file, extract the micrograph name, X Y coordinates, and class of all particles present.
-            >> Input (i) .STAR file name as str; (ii) column Name,X,Y as int; (iii) header_size as int
-            >> Returns a dictionary of tuples: { mic1 : [(x1,y1),(x2,y2),...], mic2 : [(x1,y1),...] ...}
+            >> Input (i) .STAR file name as str; (ii) name of the table with the particle data
+            >> Returns a dictionary of coordinate arrays: { mic1 : (X_array, Y_array), mic2 : (X_array, Y_array) ...}
     """
-    with open(file, 'r') as f :
-        data_parse_list = dict()
-        line_num = 0
-        for line in f :
-            line_num += 1
-            # ignore empty lines
-            if len(line.strip()) == 0 :
-                continue
-            # start working only after the header length
-            if line_num > header_size:
-                X_coordinate = float(find_star_info(line, columnX))
-                Y_coordinate = float(find_star_info(line, columnY))
-                mic_name = os.path.splitext(extract_mic_name(find_star_info(line, columnName)))[0]
-                if mic_name not in data_parse_list:
-                    data_parse_list[mic_name] = [(X_coordinate, Y_coordinate)]
-                else:
-                    data_parse_list[mic_name].append((X_coordinate, Y_coordinate))
-                # if VERBOSE:
-                #     print("Coordinates found: (%s, %s, %s)" % (mic_name, X_coordinate, Y_coordinate))
-        return data_parse_list
+    star_index = star_handler.StarIndex(file)
+    ## older style files have a single table, in which case use the last table in the file (as header_length would)
+    if table_title not in star_index.tables:
+        table_title = list(star_index.tables)[-1]
+    data = star_handler.read_table(file, table_title, columns = ['_rlnMicrographName', '_rlnCoordinateX', '_rlnCoordinateY'], dtypes = { '_rlnCoordinateX' : float, '_rlnCoordinateY' : float }, star_index = star_index)
+
+    ## group the rows of each micrograph together with a single sort, keeping their original order within a micrograph 
+    mic_names = star_handler.get_basenames(data['_rlnMicrographName'])
+    unique_mics, first_rows, mic_index = np.unique(mic_names, return_index = True, return_inverse = True)
+    order = np.argsort(mic_index, kind = 'stable')
+    group_sizes = np.bincount(mic_index, minlength = len(unique_mics))
+    group_ends = np.cumsum(group_sizes)
+    group_starts = group_ends - group_sizes
+
+    data_parse_list = dict()
+    ## keep micrographs in the order they first appear in the file 
+    for m in np.argsort(first_rows).tolist():
+        rows = order[group_starts[m] : group_ends[m]]
+        data_parse_list[str(unique_mics[m])] = (data['_rlnCoordinateX'][rows], data['_rlnCoordinateY'][rows])
+    return data_parse_list
 
 
 # def write_star_file(coordinates, output_file):
@@ -166,22 +166,10 @@ def write_manpick_files(data_dict):
     """
 
     for mic in data_dict:
-        with open('%s' % (mic+'_manualpick.star'), 'a' ) as f :
-            f.write("\n")
-            f.write("data_\n")
-            f.write("\n")
-            f.write("loop_\n")
-            f.write("_rlnCoordinateX #1\n")
-            f.write("_rlnCoordinateY #2\n")
-            f.write("_rlnClassNumber #3\n")
-            f.write("_rlnAnglePsi #4\n")
-            f.write("_rlnAutopickFigureOfMerit #5\n")
-            f.write("_rlnParticleSelectionType #6\n")
-
-    for mic in data_dict:
-        with open('%s' % (mic+'_manualpick.star'), 'a' ) as f :
-            for (X_coord, Y_coord) in data_dict[mic] :
-                f.write("%s\t%s\t-999\t-999.0\t-999.0\t2\n" % (X_coord, Y_coord))
+        X_coords, Y_coords = data_dict[mic]
+        with star_handler.StarWriter('%s' % (mic+'_manualpick.star'), 'a' ) as f :
+            f.write_table_header('data_', ['_rlnCoordinateX', '_rlnCoordinateY', '_rlnClassNumber', '_rlnAnglePsi', '_rlnAutopickFigureOfMerit', '_rlnParticleSelectionType'])
+            f.write_columns([ X_coords, Y_coords, np.full(len(X_coords), -999), np.full(len(X_coords), -999.0), np.full(len(X_coords), -999.0), np.full(len(X_coords), 2) ])
 
 
 #############################
@@ -192,6 +180,15 @@ if __name__ == "__main__":
     import string
     import os
     import sys
+    import numpy as np
+
+    ## Get the execution path of this script so we can find local modules
+    script_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    try:
+        sys.path.append(script_path)
+        import star_handler 
+    except :
+        print(" ERROR :: Check if star_handler.py script is in same folder as this script and runs without error (i.e. can be compiled)!")
 
     usage()
 
@@ -200,11 +197,7 @@ if __name__ == "__main__":
 
     print("... running")
 
-    header_size = header_length(star_file)
-    X_coord_column = find_star_column(star_file, '_rlnCoordinateX', header_size)
-    Y_coord_column = find_star_column(star_file, '_rlnCoordinateY', header_size)
-    mic_name_column = find_star_column(star_file, '_rlnMicrographName', header_size)
-    particle_coordinate_info = parse_star_file(star_file, mic_name_column, X_coord_column, Y_coord_column, header_size)
+    particle_coordinate_info = parse_star_file(star_file)
     write_manpick_files(particle_coordinate_info)
 
     print("... job completed.")
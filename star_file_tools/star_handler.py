@@ -7,7 +7,24 @@
 	Or import the module and call functions by extension, e.g.:
 		import star_handler
 		star_handler.get_table_position('filename.star', 'data_model_classes')
+	For large files, build a single-pass index once and reuse it for every table/column lookup:
+		index = star_handler.StarIndex('particles.star')
+		index.get_table_position('data_particles')
+		index.find_star_column('data_particles', '_rlnMicrographName')
 """
+import os
+import re
+import mmap
+import json
+import time
+import hashlib
+from multiprocessing import Pool
+
+## opt-in sidecar cache for read_table (see: read_table(..., cache = True))
+CACHE_SUFFIX = '.npy_cache' ## e.g. particles.star -> particles.star.npy_cache/
+CACHE_SIZE_LIMIT = 4 * 1024 * 1024 * 1024 ## bytes per cache folder, least-recently used columns are evicted beyond this
+## data blocks smaller than this are always parsed in a single process (see: read_table(..., workers = N))
+PARALLEL_MIN_BYTES = 32 * 1024 * 1024
 
 def get_table_position(file, table_title, DEBUG = True):
     """ Find the line numbers for key elements in a relion .STAR table.
@@ -148,6 +165,637 @@ def remove_path(file_w_path):
     file_wo_path = os.path.basename(file_w_path)
     return file_wo_path
 
+## a data block ends on the first blank (or whitespace-only) line, or where a new block title starts without one
+DATA_BLOCK_END = re.compile(rb'\n(?:[ \t\r]*\n|(?=data_))')
+
+class StarTable():
+    """ Landmarks of a single `data_*' block in a .STAR file, as recorded by StarIndex.
+        Line numbers follow the same (1-based) convention as get_table_position, byte offsets are
+        absolute positions in the file that can be used directly with seek()
+    """
+    def __init__(self, title, table_start, table_offset):
+        self.title = title
+        self.table_start = table_start ## line number of the `data_*' title
+        self.table_offset = table_offset ## byte offset of the `data_*' title
+        self.is_loop = False
+        self.header_start = -1 ## line number of the first column entry after `loop_'
+        self.data_start = -1 ## line number of the first data row
+        self.data_end = -1 ## line number of the last data row
+        self.data_offset = -1 ## byte offset of the first data row
+        self.data_end_offset = -1 ## byte offset just past the last data row
+        self.num_rows = 0
+        self.columns = {} ## { '_rlnColumnName' : column_number (1-based), ... }
+        self.values = {} ## for simple (non-loop) tables: { '_rlnName' : 'value', ... }
+        return
+
+    def get_table_position(self):
+        return self.table_start, self.header_start, self.data_start, self.data_end
+
+    def __str__(self):
+        return " %s :: %s columns, %s rows (lines %s-%s; bytes %s-%s)" % (self.title, len(self.columns), self.num_rows, self.data_start, self.data_end, self.data_offset, self.data_end_offset)
+
+class StarIndex():
+    """ Read a .STAR file once and record the position, header columns and row range of every `data_*' block.
+        Data rows are skipped over in bulk (never tokenized), so building the index costs a single pass
+        over the file even for multi-GB particle files.
+		---------------------------------------------------------------
+		PARAMETERS
+		---------------------------------------------------------------
+			file = str(); name of .STAR file to index (e.g. "particles.star") \n
+			DEBUG = bool(); optionally print a summary of the tables found \n
+		---------------------------------------------------------------
+		USAGE
+		---------------------------------------------------------------
+			index = StarIndex('particles.star') \n
+			TABLE_START, HEADER_START, DATA_START, DATA_END = index.get_table_position('data_particles') \n
+			COLUMN_rlnMicrographName = index.find_star_column('data_particles', '_rlnMicrographName') \n
+    """
+    def __init__(self, file, DEBUG = False):
+        self.file = file
+        self.file_size = os.path.getsize(file)
+        self.tables = {} ## { 'data_name' : StarTable(), ... } in the order they appear in the file
+        self._build()
+        if DEBUG:
+            print(self)
+        return
+
+    def _build(self):
+        if self.file_size == 0:
+            return
+        with open(self.file, 'rb') as f :
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm :
+                table = None
+                line_num = 0
+                while True:
+                    line_offset = mm.tell()
+                    line = mm.readline()
+                    if not line:
+                        break
+                    line_num += 1
+                    line_to_list = line.split()
+                    ## ignore empty lines and comments in the header regions
+                    if len(line_to_list) == 0 or line_to_list[0][:1] == b'#':
+                        continue
+                    first_word = line_to_list[0].decode('utf-8')
+                    ## catch a new table title
+                    if first_word[:5] == 'data_':
+                        table = StarTable(first_word, line_num, line_offset)
+                        ## keep the first occurence of a table, as get_table_position would
+                        if first_word not in self.tables:
+                            self.tables[first_word] = table
+                        continue
+                    if table is None:
+                        continue
+                    if first_word == 'loop_':
+                        table.is_loop = True
+                        table.header_start = line_num + 1
+                        continue
+                    ## header entries, e.g. '_rlnCoordinateX #3' (loop) or '_rlnReferenceDimensionality 2' (simple table)
+                    if first_word[0] == '_':
+                        if table.is_loop:
+                            column_num = len(table.columns) + 1
+                            if len(line_to_list) > 1 and line_to_list[1][:1] == b'#':
+                                column_num = int(line_to_list[1][1:])
+                            table.columns[first_word] = column_num
+                        elif len(line_to_list) > 1:
+                            table.values[first_word] = line_to_list[1].decode('utf-8')
+                        continue
+                    ## the first non-header line of a loop table is the first data row, jump over the whole block at once
+                    if table.is_loop and table.data_start < 0:
+                        table.data_start = line_num
+                        table.data_offset = line_offset
+                        end_match = DATA_BLOCK_END.search(mm, line_offset)
+                        if end_match is None:
+                            table.data_end_offset = self.file_size
+                        else:
+                            table.data_end_offset = end_match.start() + 1
+                        table.num_rows = count_lines(mm, table.data_offset, table.data_end_offset)
+                        table.data_end = table.data_start + table.num_rows - 1
+                        line_num = table.data_end
+                        mm.seek(table.data_end_offset)
+                        table = None
+        return
+
+    def get_table(self, table_title):
+        if table_title not in self.tables:
+            print(" ERROR :: Input .STAR file: %s, is missing the table: %s" % (self.file, table_title))
+            exit()
+        return self.tables[table_title]
+
+    def get_table_position(self, table_title):
+        """ Equivalent to the module-level get_table_position, without re-reading the file
+        """
+        return self.get_table(table_title).get_table_position()
+
+    def find_star_column(self, table_title, column_name, DEBUG = False):
+        """ Equivalent to the module-level find_star_column, without re-reading the file
+        """
+        table = self.get_table(table_title)
+        if column_name not in table.columns:
+            print(" ERROR :: Input .STAR file: %s, is missing a column for: %s" % (self.file, column_name) )
+            exit()
+        if DEBUG:
+            print("  ... %s column value: #%s" % (column_name, table.columns[column_name]))
+        return table.columns[column_name]
+
+    def __str__(self):
+        s = "=============================================================\n"
+        s += " StarIndex :: %s (%s tables)\n" % (self.file, len(self.tables))
+        s += "-------------------------------------------------------------\n"
+        for title in self.tables:
+            s += str(self.tables[title]) + "\n"
+        s += "============================================================="
+        return s
+
+def count_lines(mm, start, end, chunk_size = 64 * 1024 * 1024):
+    """ Count the lines in a byte range of an open file/mmap in large chunks (i.e. without a python-level loop per line).
+        A final line lacking a newline character is still counted.
+    """
+    num_lines = 0
+    for chunk_start in range(start, end, chunk_size):
+        num_lines += mm[chunk_start : min(chunk_start + chunk_size, end)].count(b'\n')
+    if end > start and mm[end - 1 : end] != b'\n':
+        num_lines += 1
+    return num_lines
+
+def iter_data_chunks(file, start, end, chunk_size = 64 * 1024 * 1024):
+    """ Yield the raw bytes of a byte range of a data block (start/end on row boundaries) in large pieces that always end on a full row
+    """
+    with open(file, 'rb') as f :
+        f.seek(start)
+        while f.tell() < end:
+            chunk = f.read(min(chunk_size, end - f.tell()))
+            ## complete a row cut in half by the chunk boundary
+            if chunk[-1:] != b'\n' and f.tell() < end:
+                chunk += f.readline()
+            yield chunk
+    return
+
+def split_data_block(file, table, n):
+    """ Split a table's data block into (at most) n byte ranges of similar size, each starting and ending on a row boundary
+    """
+    boundaries = [ table.data_offset ]
+    with open(file, 'rb') as f :
+        for i in range(1, n):
+            f.seek(table.data_offset + i * (table.data_end_offset - table.data_offset) // n)
+            ## move forward to the start of the next row
+            f.readline()
+            boundary = min(f.tell(), table.data_end_offset)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    if table.data_end_offset > boundaries[-1]:
+        boundaries.append(table.data_end_offset)
+    return [ (boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1) ]
+
+def parse_data_range(file, start, end, column_indexes, num_columns, column_dtypes):
+    """ Tokenize a byte range of a data block and cast each requested column (see: cast_column).
+        Runs as a worker process when read_table is given workers > 1
+    """
+    import numpy as np
+    raw_columns = [ [] for _ in column_indexes ]
+    for chunk in iter_data_chunks(file, start, end):
+        chunk_columns = tokenize_chunk(chunk, column_indexes, num_columns)
+        for i in range(len(column_indexes)):
+            raw_columns[i].append(chunk_columns[i])
+    columns = []
+    for i in range(len(column_indexes)):
+        raw_column = np.concatenate(raw_columns[i]) if len(raw_columns[i]) > 0 else np.array([], dtype = bytes)
+        columns.append(cast_column(raw_column, column_dtypes[i]))
+    return columns
+
+def tokenize_chunk(chunk, column_indexes, num_columns):
+    """ Split a block of data rows in one call and return the raw (bytes) NumPy array for each requested column index (0-based)
+    """
+    import numpy as np
+    tokens = chunk.split()
+    if len(tokens) % num_columns != 0:
+        print(" ERROR :: Data block has an inconsistent number of entries per row (expected %s columns)" % num_columns)
+        exit()
+    return [ np.array(tokens[i::num_columns]) for i in column_indexes ]
+
+def cast_column(raw_column, dtype = None):
+    """ Convert a raw bytes column to its natural type: int32 (or int64 if needed), float64, or str
+    """
+    import numpy as np
+    if dtype is not None:
+        if dtype is str:
+            return raw_column.astype(str)
+        return raw_column.astype(dtype)
+    try:
+        values = raw_column.astype(np.int64)
+        if len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+            values = values.astype(np.int32)
+        return values
+    except ValueError:
+        pass
+    try:
+        return raw_column.astype(np.float64)
+    except ValueError:
+        return raw_column.astype(str)
+
+def read_table(file, table_title, columns = None, dtypes = {}, star_index = None, cache = False, workers = 1, DEBUG = False):
+    """ Read the requested columns of a .STAR data table into typed NumPy arrays.
+        The data block is tokenized in bulk (large chunks at a time) rather than line-by-line, and only
+        the requested columns are kept. With cache = True, parsed columns are saved next to the source
+        file (<file>.npy_cache/) and memory-mapped back on later runs while the file is unchanged.
+        With workers > 1, the data block is split on row boundaries and the pieces are tokenized in a process pool.
+		---------------------------------------------------------------
+		PARAMETERS
+		---------------------------------------------------------------
+			file = str(); name of .STAR file (e.g. "particles.star") \n
+			table_title = str(); name of the table to read (e.g. "data_particles") \n
+			columns = list( str(), ... ); column names to read (e.g. ['_rlnCoordinateX', ...]), or None for all columns \n
+			dtypes = dict( str() : type ); optionally force the type of a column (e.g. { '_rlnOpticsGroup' : str }) \n
+			star_index = StarIndex(); optionally reuse an index of the file already built \n
+			cache = bool(); optionally read/write parsed columns from/to the sidecar cache \n
+			workers = int(); number of processes used to tokenize the data block \n
+			DEBUG = bool(); optionally print a summary of the columns read \n
+		---------------------------------------------------------------
+		RETURNS
+		---------------------------------------------------------------
+			data = dict( str() : np.ndarray ); { '_rlnColumnName' : array of int32/float64/str, ... } \n
+    """
+    import numpy as np
+    cached_data = {}
+    if cache and columns is not None:
+        ## try to satisfy the request entirely from the cache, without indexing the source file 
+        ## columns with a forced dtype are always parsed (and never cached) so the cache only holds naturally-typed columns
+        metadata = load_cache_metadata(file)
+        cached_data = load_cached_columns(file, table_title, [ c for c in columns if c not in dtypes ], metadata)
+        if len(cached_data) == len(columns):
+            ## persist the last-use times just updated, so eviction stays least-recently used
+            try:
+                save_cache_metadata(file, metadata)
+            except OSError as e:
+                print(" WARNING :: Could not update cache metadata for %s (%s)" % (file, e))
+            if DEBUG:
+                print(" Loaded %s columns of table '%s' from cache: %s" % (len(columns), table_title, file + CACHE_SUFFIX))
+            return cached_data
+
+    if star_index is None:
+        star_index = StarIndex(file)
+    table = star_index.get_table(table_title)
+    if columns is None:
+        columns = list(table.columns)
+        if cache:
+            metadata = load_cache_metadata(file)
+            cached_data = load_cached_columns(file, table_title, [ c for c in columns if c not in dtypes ], metadata)
+    requested_columns = columns
+    ## only parse the columns we could not find in the cache 
+    columns = [ c for c in requested_columns if c not in cached_data ]
+    column_indexes = [ star_index.find_star_column(table_title, c) - 1 for c in columns ]
+
+    ## small tables are not worth the start-up cost of a process pool
+    if table.data_end_offset - table.data_offset < PARALLEL_MIN_BYTES:
+        workers = 1
+    data_ranges = split_data_block(file, table, workers) if table.num_rows > 0 else []
+    column_dtypes = [ dtypes.get(c) for c in columns ]
+    tasks = [ (file, start, end, column_indexes, len(table.columns), column_dtypes) for (start, end) in data_ranges ]
+    if len(tasks) > 1:
+        with Pool(min(workers, len(tasks))) as pool :
+            ## starmap returns the results in the order of the tasks, so rows keep their order in the file 
+            results = pool.starmap(parse_data_range, tasks)
+    else:
+        results = [ parse_data_range(*task) for task in tasks ]
+
+    data = {}
+    for i in range(len(columns)):
+        if len(results) == 0:
+            data[columns[i]] = cast_column(np.array([], dtype = bytes), column_dtypes[i])
+            continue
+        pieces = [ r[i] for r in results ]
+        kinds = set([ p.dtype.kind for p in pieces if len(p) > 0 ])
+        if 'U' in kinds and len(kinds) > 1:
+            ## each worker typed its own piece, if only some found text the whole column must be re-read as text 
+            pieces = [ parse_data_range(file, start, end, [column_indexes[i]], len(table.columns), [str])[0] for (start, end) in data_ranges ]
+        data[columns[i]] = np.concatenate(pieces)
+
+    if cache:
+        try:
+            save_cached_columns(file, table, { c : data[c] for c in data if c not in dtypes }, metadata)
+        except OSError as e:
+            print(" WARNING :: Could not write cache for %s (%s)" % (file, e))
+        data.update(cached_data)
+    data = { c : data[c] for c in requested_columns }
+
+    if DEBUG:
+        print(" Read %s rows from table '%s' in %s" % (table.num_rows, table_title, file))
+        for c in data:
+            print("   >> %s :: %s" % (c, data[c].dtype))
+        print("-------------------------------------------------------------")
+    return data
+
+def get_table_header_hash(file, table_offset, data_offset):
+    """ Hash the raw header of a table (from its `data_*' title to its first data row)
+    """
+    with open(file, 'rb') as f :
+        f.seek(table_offset)
+        return hashlib.sha1(f.read(data_offset - table_offset)).hexdigest()
+
+def get_cache_fname(table_title, column_name):
+    return "%s%s.npy" % (table_title, column_name)
+
+def load_cache_metadata(file):
+    """ Read the sidecar cache metadata for a .STAR file, clearing the whole cache if the source file changed since it was written
+    """
+    cache_dir = file + CACHE_SUFFIX
+    meta_fname = os.path.join(cache_dir, 'metadata.json')
+    stat = os.stat(file)
+    try:
+        with open(meta_fname, 'r') as f :
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        metadata = None
+    if metadata is None or metadata['file_size'] != stat.st_size or metadata['file_mtime_ns'] != stat.st_mtime_ns:
+        if metadata is not None:
+            print(" ... source file changed, clearing cache: %s" % cache_dir)
+        clear_cache(file)
+        metadata = { 'file_size' : stat.st_size, 'file_mtime_ns' : stat.st_mtime_ns, 'tables' : {} }
+    return metadata
+
+def get_cached_tables(file):
+    """ Titles of the tables with columns in the sidecar cache of a .STAR file, i.e. tables known to exist in the file without indexing it
+    """
+    return list(load_cache_metadata(file)['tables'])
+
+def save_cache_metadata(file, metadata):
+    cache_dir = file + CACHE_SUFFIX
+    meta_fname = os.path.join(cache_dir, 'metadata.json')
+    with open(meta_fname + '.tmp', 'w') as f :
+        json.dump(metadata, f, indent = 1)
+    os.replace(meta_fname + '.tmp', meta_fname)
+    return
+
+def clear_cache(file):
+    cache_dir = file + CACHE_SUFFIX
+    if os.path.isdir(cache_dir):
+        for fname in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, fname))
+    return
+
+def load_cached_columns(file, table_title, columns, metadata):
+    """ Memory-map every requested column found in the cache for a table, after checking the table header is unchanged.
+        Returns a dict of the columns found ( { '_rlnColumnName' : np.memmap, ... } ), which may be incomplete or empty
+    """
+    import numpy as np
+    cache_dir = file + CACHE_SUFFIX
+    if table_title not in metadata['tables']:
+        return {}
+    table_metadata = metadata['tables'][table_title]
+    if get_table_header_hash(file, table_metadata['table_offset'], table_metadata['data_offset']) != table_metadata['header_hash']:
+        print(" ... header of table '%s' changed, dropping its cached columns" % table_title)
+        for column_name in table_metadata['columns']:
+            column_fname = os.path.join(cache_dir, get_cache_fname(table_title, column_name))
+            if os.path.exists(column_fname):
+                os.remove(column_fname)
+        del metadata['tables'][table_title]
+        return {}
+
+    data = {}
+    for column_name in columns:
+        if column_name not in table_metadata['columns']:
+            continue
+        try:
+            data[column_name] = np.load(os.path.join(cache_dir, get_cache_fname(table_title, column_name)), mmap_mode = 'r')
+            table_metadata['columns'][column_name] = time.time() ## last used
+        except (OSError, ValueError):
+            del table_metadata['columns'][column_name]
+    return data
+
+def save_cached_columns(file, table, data, metadata):
+    """ Write parsed columns into the sidecar cache folder, then evict least-recently used columns if over CACHE_SIZE_LIMIT
+    """
+    import numpy as np
+    cache_dir = file + CACHE_SUFFIX
+    os.makedirs(cache_dir, exist_ok = True)
+    table_metadata = metadata['tables'].setdefault(table.title, {
+        'table_offset' : table.table_offset,
+        'data_offset' : table.data_offset,
+        'header_hash' : get_table_header_hash(file, table.table_offset, table.data_offset),
+        'columns' : {}
+        })
+    for column_name in data:
+        column_fname = os.path.join(cache_dir, get_cache_fname(table.title, column_name))
+        ## write to a temporary name first so an interrupted run never leaves a truncated column behind
+        with open(column_fname + '.tmp', 'wb') as f :
+            np.save(f, np.asarray(data[column_name]))
+        os.replace(column_fname + '.tmp', column_fname)
+        table_metadata['columns'][column_name] = time.time()
+    evict_cached_columns(file, metadata)
+    save_cache_metadata(file, metadata)
+    return
+
+def evict_cached_columns(file, metadata, size_limit = None):
+    if size_limit is None:
+        size_limit = CACHE_SIZE_LIMIT
+    cache_dir = file + CACHE_SUFFIX
+    cached_columns = [] ## [ (last_used, table_title, column_name, fname, size), ... ]
+    for table_title in metadata['tables']:
+        for column_name, last_used in metadata['tables'][table_title]['columns'].items():
+            fname = os.path.join(cache_dir, get_cache_fname(table_title, column_name))
+            if os.path.exists(fname):
+                cached_columns.append((last_used, table_title, column_name, fname, os.path.getsize(fname)))
+    total_size = sum([ c[4] for c in cached_columns ])
+    for last_used, table_title, column_name, fname, size in sorted(cached_columns):
+        if total_size <= size_limit:
+            break
+        os.remove(fname)
+        del metadata['tables'][table_title]['columns'][column_name]
+        total_size -= size
+    return
+
+def get_row_offsets(file, table, chunk_size = 64 * 1024 * 1024):
+    """ Build a compact row-offset index of a table's data block: an int64 array of the byte offset at which every
+        row starts, plus a final entry for the end of the block (i.e. row i spans offsets[i]:offsets[i+1]).
+        Newlines are located with vectorized comparisons over a memory map of the file, one chunk at a time.
+    """
+    import numpy as np
+    if table.num_rows == 0:
+        return np.array([], dtype = np.int64)
+    data = np.memmap(file, dtype = np.uint8, mode = 'r')
+    offsets = [ np.array([table.data_offset], dtype = np.int64) ]
+    for chunk_start in range(table.data_offset, table.data_end_offset, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, table.data_end_offset)
+        offsets.append(np.flatnonzero(data[chunk_start : chunk_end] == ord('\n')).astype(np.int64) + chunk_start + 1)
+    offsets = np.concatenate(offsets)
+    ## handle a last row without a newline (i.e. end of file)
+    if offsets[-1] != table.data_end_offset:
+        offsets = np.append(offsets, np.int64(table.data_end_offset))
+    return offsets
+
+class StarRows():
+    """ Random access to the rows of a .STAR data table via a row-offset index and a memory map of the file,
+        so arbitrary subsets of a large file can be pulled without reading it from line 1.
+		---------------------------------------------------------------
+		USAGE
+		---------------------------------------------------------------
+			with StarRows('particles.star', 'data_particles') as rows: \n
+				lines = rows.get_rows([10, 5000000, 42]) ## list of row strings (without newline) \n
+				rows.write_rows(np.flatnonzero(keep), f) ## copy raw rows into an open binary file \n
+    """
+    def __init__(self, file, table_title, star_index = None):
+        if star_index is None:
+            star_index = StarIndex(file)
+        self.file = file
+        self.table = star_index.get_table(table_title)
+        self.offsets = get_row_offsets(file, self.table)
+        self.f = open(file, 'rb')
+        self.mm = None
+        if self.table.num_rows > 0:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+        return
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def get_row(self, i):
+        return self.mm[self.offsets[i] : self.offsets[i + 1]].decode('utf-8').rstrip('\r\n')
+
+    def get_rows(self, indices):
+        return [ self.get_row(i) for i in indices ]
+
+    def write_rows(self, indices, f):
+        """ Write the raw bytes of the given rows (in the given order) into an open binary file,
+            copying each run of consecutive rows with a single slice of the memory map
+        """
+        import numpy as np
+        indices = np.asarray(indices, dtype = np.int64)
+        if len(indices) == 0:
+            return
+        run_breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        run_starts = np.concatenate(([0], run_breaks))
+        run_ends = np.concatenate((run_breaks, [len(indices)]))
+        for run_start, run_end in zip(run_starts.tolist(), run_ends.tolist()):
+            first_row = indices[run_start]
+            last_row = indices[run_end - 1]
+            f.write(self.mm[self.offsets[first_row] : self.offsets[last_row + 1]])
+            ## a last row without a trailing newline (end of file) still needs one when followed by other rows
+            if self.mm[self.offsets[last_row + 1] - 1 : self.offsets[last_row + 1]] != b'\n':
+                f.write(b'\n')
+        return
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.f.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class StarWriter():
+    """ Buffered writer for .STAR files: each table header is written once, then rows are formatted in large
+        batches (one str.format call per row, joined in C) and pushed through a large write buffer.
+        Columns are left-aligned in fields of COLUMN_WIDTH + 1 characters, matching '{:11}'.format(value + ' ').
+		---------------------------------------------------------------
+		USAGE
+		---------------------------------------------------------------
+			with StarWriter('particles.star') as star: \n
+				star.write_table_header('data_particles', ['_rlnCoordinateX', '_rlnCoordinateY', '_rlnMicrographName']) \n
+				star.write_columns([ x_array, y_array, mic_names ]) ## NumPy columns, or: \n
+				star.write_rows([ (x, y, mic), ... ]) ## any iterable of rows \n
+    """
+    COLUMN_WIDTH = 10
+    BATCH_SIZE = 100000 ## rows formatted per write call
+
+    def __init__(self, file, mode = 'w', buffer_size = 16 * 1024 * 1024, float_format = ''):
+        self.file = file
+        self.f = open(file, mode, buffering = buffer_size)
+        self.float_format = float_format ## e.g. '.6f', applied to float columns given to write_columns
+        self.num_columns = 0
+        self.rows_written = 0
+        return
+
+    def write(self, text):
+        """ Write raw text (e.g. comments, blank lines or tables copied from another file)
+        """
+        self.f.write(text)
+        return
+
+    def write_table_header(self, table_title, column_names, version = None):
+        s = "\n"
+        if version is not None:
+            s += "# version %s\n\n" % version
+        s += "%s\n\nloop_\n" % table_title
+        for i in range(len(column_names)):
+            s += "%s #%s\n" % (column_names[i], i + 1)
+        self.f.write(s)
+        self.num_columns = len(column_names)
+        return
+
+    def get_row_format(self, field_formats):
+        return ''.join([ '{:<%s%s} ' % (self.COLUMN_WIDTH, field_format) for field_format in field_formats ]) + '\n'
+
+    def write_rows(self, rows):
+        """ Write an iterable of rows, each a sequence of values (str, int, float, ...) in column order
+        """
+        batch = []
+        row_format = None
+        for row in rows:
+            if row_format is None or len(row) != self.num_columns:
+                self.num_columns = len(row)
+                row_format = self.get_row_format([ '' ] * self.num_columns)
+            batch.append(row_format.format(*row))
+            if len(batch) >= self.BATCH_SIZE:
+                self.f.write(''.join(batch))
+                self.rows_written += len(batch)
+                batch = []
+        self.f.write(''.join(batch))
+        self.rows_written += len(batch)
+        return
+
+    def write_columns(self, columns):
+        """ Write rows from a list of equal-length columns (NumPy arrays or lists) given in column order
+        """
+        import numpy as np
+        columns = [ np.asarray(c) for c in columns ]
+        num_rows = len(columns[0]) if len(columns) > 0 else 0
+        field_formats = []
+        for c in columns:
+            if len(c) != num_rows:
+                print(" ERROR :: Columns of unequal length given to StarWriter (%s vs. %s rows)" % (len(c), num_rows))
+                exit()
+            if c.dtype.kind == 'f':
+                field_formats.append(self.float_format)
+            else:
+                field_formats.append('')
+        row_format = self.get_row_format(field_formats)
+        for batch_start in range(0, num_rows, self.BATCH_SIZE):
+            ## tolist() converts a whole batch to python values at once, map() then formats every row in C
+            batch = [ c[batch_start : batch_start + self.BATCH_SIZE].tolist() for c in columns ]
+            self.f.write(''.join(map(row_format.format, *batch)))
+        self.rows_written += num_rows
+        self.num_columns = len(columns)
+        return
+
+    def close(self):
+        self.f.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+def get_basenames(paths, remove_extension = True):
+    """ Vectorized equivalent of os.path.basename (and optionally os.path.splitext) over an array of paths,
+        e.g. the '_rlnMicrographName' column returned by read_table: 'MotionCorr/job002/mic_001.mrc' -> 'mic_001'
+    """
+    import numpy as np
+    names = np.char.rpartition(np.asarray(paths, dtype = str), '/')[:, 2]
+    if remove_extension:
+        parts = np.char.rpartition(names, '.')
+        ## names without a '.' (or with only a leading '.', e.g. '.hidden') are kept whole, as in os.path.splitext
+        has_extension = np.char.str_len(parts[:, 0]) > 0
+        names = np.where(has_extension, parts[:, 0], names)
+    return names
+
 # ## example script to read a star file for specific entries 
 #     with open(fname, 'r') as f :
 #         parsed = []